@@ -322,7 +322,13 @@ class Config:
             # Cache settings for import filters
             'filter-options': {},
             # Use UUIDs for element ids. If false, generate readable ids.
-            'use-uuid': True
+            'use-uuid': True,
+            # Number of concurrent pipelines for montage rendering.
+            # 0 means the number of processors.
+            'montage-jobs': 0,
+            # Store long numeric value signals as binary resources in
+            # AZP packages. Previous versions cannot read them.
+            'binary-values': False,
             }
 
         # Player options
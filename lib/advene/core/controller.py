@@ -60,6 +60,7 @@ import advene.core.plugin
 from advene.core.mediacontrol import PlayerFactory
 from advene.core.imagecache import ImageCache
 import advene.core.idgenerator
+from advene.core.elementcache import ElementCache
 
 from advene.rules.elements import RuleSet, RegisteredAction, SimpleQuery, Quicksearch
 import advene.rules.ecaengine
@@ -230,6 +231,12 @@ class AdveneController:
         # Imagecache indexed by media
         self.imagecache = {}
 
+        # Prototype TALES contexts, indexed by base url. Values are
+        # (key, context) tuples, where key holds the information
+        # used to build the context.
+        self._context_prototypes = {}
+        self._context_prototypes_lock = threading.Lock()
+
         # Unknown arguments (neither a package nor a video file)
         self.unknown_args = []
 
@@ -773,37 +780,36 @@ class AdveneController:
     def build_context(self, here=None, alias=None, baseurl=None):
         """Build a context object with additional information.
 
-        The information is cached if no additional parameter (alias,
-        baseurl) is specified.
+        The context is derived from a prototype context (with its
+        method table already built), which is created once for each
+        base url and rebuilt only when its information is outdated.
         """
         if here is None:
             here=self.package
-        if alias is None and baseurl is None:
-            try:
-                c = here._cached_context
-                c.restore()
-                return c
-            except AttributeError:
-                pass
         if baseurl is None:
             baseurl=self.get_default_url(root=True, alias=alias)
-        c=advene.model.tal.context.AdveneContext(here,
-                                                 options={
-                                                     'package_url': baseurl,
-                                                     'snapshot': self.package.imagecache,
-                                                     'namespace_prefix': config.data.namespace_prefix,
-                                                     'config': config.data.web,
-                                                     'aliases': self.aliases,
-                                                     'controller': self,
-                                                 })
-        c.addGlobal('package', self.package)
-        c.addGlobal('packages', self.packages)
-        c.addGlobal('player', self.player)
-        for name, method in config.data.global_methods.items():
-            c.addMethod(name, method)
-        # Preserve a copy of globals/locals for later restoring
-        c.checkpoint()
-        return c
+        key = (self.package, self.package.imagecache if self.package is not None else None,
+               self.player, tuple(config.data.global_methods.items()))
+        prototype = self._context_prototypes.get(baseurl)
+        if prototype is None or prototype[0] != key:
+            with self._context_prototypes_lock:
+                c=advene.model.tal.context.AdveneContext(None,
+                                                         options={
+                                                             'package_url': baseurl,
+                                                             'snapshot': key[1],
+                                                             'namespace_prefix': config.data.namespace_prefix,
+                                                             'config': config.data.web,
+                                                             'aliases': self.aliases,
+                                                             'controller': self,
+                                                         })
+                c.addGlobal('package', self.package)
+                c.addGlobal('packages', self.packages)
+                c.addGlobal('player', self.player)
+                for name, method in config.data.global_methods.items():
+                    c.addMethod(name, method)
+                prototype = (key, c)
+                self._context_prototypes[baseurl] = prototype
+        return prototype[1].derive(here)
 
     def busy_port_info(self):
         """Display the processes using the webserver port.
@@ -1017,6 +1023,10 @@ class AdveneController:
                 # We created an element. Make sure its id is registered in the _idgenerator
                 p._idgenerator.add(el.id)
 
+        if event_name in ElementCache.element_events or event_name in ElementCache.package_events:
+            # Invalidate cached titles/colors before any view gets notified
+            self.update_element_cache(event_name, **kw)
+
         if 'immediate' in kw:
             self.event_handler.notify(event_name, *param, **kw)
         else:
@@ -1100,6 +1110,33 @@ class AdveneController:
         else:
             return "http:///"
 
+    def get_element_cache(self, package=None):
+        """Return the title/color cache for the given package.
+        """
+        if package is None:
+            package = self.package
+        try:
+            return package._element_cache
+        except AttributeError:
+            package._element_cache = ElementCache()
+            return package._element_cache
+
+    def update_element_cache(self, event_name, **kw):
+        """Invalidate the cached titles/colors affected by the given event.
+        """
+        element = kw.get('annotation') or kw.get('relation')
+        if element is not None:
+            package = element.ownerPackage
+        else:
+            container = kw.get('annotationtype') or kw.get('relationtype') or kw.get('schema')
+            if container is not None:
+                package = container.ownerPackage
+            else:
+                package = kw.get('package') or self.package
+        cache = getattr(package, '_element_cache', None)
+        if cache is not None:
+            cache.update(event_name, element)
+
     def get_title(self, element, representation=None, max_size=None):
         """Return the title for the given element.
         """
@@ -1109,29 +1146,37 @@ class AdveneController:
             else:
                 return s
 
-        def cleanup(s):
+        def cleanup_line(s):
             if not isinstance(s, str):
                 s = str(s)
             i=s.find('\n')
             if i > 0:
-                return trim_size(s[:i])
+                return s[:i]
             else:
-                return trim_size(s)
+                return s
+
+        def cleanup(s):
+            return trim_size(cleanup_line(s))
 
         if element is None:
             return _("None")
         if isinstance(element, str):
             return trim_size(element)
         if isinstance(element, (Annotation, Relation)):
-            if representation is not None and representation != "":
+            def evaluate(expr):
                 c=self.build_context(here=element)
                 try:
-                    r=c.evaluateValue(representation)
+                    r=c.evaluateValue(expr)
                 except AdveneTalesException:
                     r=element.content.data
                 if not r:
                     r=element.id
-                return cleanup(r)
+                return cleanup_line(r)
+
+            if representation is not None and representation != "":
+                cache = self.get_element_cache(element.ownerPackage)
+                return trim_size(cache.get(element, 'title', representation,
+                                           lambda: evaluate(representation)))
 
             expr=element.type.getMetaData(config.data.namespace, "representation")
             if expr is None or expr == '' or re.match(r'^\s+', expr):
@@ -1144,14 +1189,9 @@ class AdveneController:
                     r=element.id
                 return cleanup(r)
             else:
-                c=self.build_context(here=element)
-                try:
-                    r=c.evaluateValue(expr)
-                except AdveneTalesException:
-                    r=element.content.data
-                if not r:
-                    r=element.id
-                return cleanup(r)
+                cache = self.get_element_cache(element.ownerPackage)
+                return trim_size(cache.get(element, 'title', expr,
+                                           lambda: evaluate(expr)))
         if isinstance(element, RelationType):
             arrow = helper.chars.arrow_to
             return arrow + str(cleanup(element.title))
@@ -1414,16 +1454,11 @@ class AdveneController:
             # modified during the loop
             self.notify('EditSessionStart', element=el, immediate=True, undone=undone)
             for r in el.relations[:]:
-                for a in r.members:
-                    if r in a.relations:
-                        a.relations.remove(r)
                 self.delete_element(r, immediate_notify=immediate_notify, batch=batch, undone=undone)
             p.annotations.remove(el)
             self.notify('AnnotationDelete', annotation=el, immediate=immediate_notify, batch=batch, undone=undone)
         elif isinstance(el, Relation):
-            for a in el.members:
-                if el in a.relations:
-                    a.relations.remove(el)
+            # The relation index ignores relations removed from the package
             p.relations.remove(el)
             self.notify('RelationDelete', relation=el, immediate=immediate_notify, undone=undone)
         elif isinstance(el, AnnotationType):
@@ -1857,6 +1892,19 @@ class AdveneController:
         If not defined (or evaluating to None), it will try to use the
         'color' metadata of the container (annotation-type for
         annotations, schema for types).
+
+        Results are cached per package, see get_element_cache.
+        """
+        package = getattr(element, 'ownerPackage', None)
+        if package is None or getattr(element, 'id', None) is None:
+            return self._compute_element_color(element, metadata)
+        return self.get_element_cache(package).get(element, 'color', metadata,
+                                                   lambda: self._compute_element_color(element, metadata))
+
+    def _compute_element_color(self, element, metadata='color'):
+        """Compute the color for the given element.
+
+        See get_element_color for the lookup rules.
         """
 
         def shortcut_evaluateValue(element, expr):
@@ -2206,6 +2254,10 @@ class AdveneController:
                 if uri:
                     self.set_default_media(uri)
 
+        # Store the id counters, so that ids do not have to be
+        # scanned on next load
+        p._idgenerator.store(p)
+
         p.save(name=name)
         p._modified = False
 
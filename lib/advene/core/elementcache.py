@@ -0,0 +1,100 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Element value cache module.
+
+It stores the result of costly per-element evaluations (titles,
+colors) so that views redrawing many elements do not have to
+evaluate TALES expressions again.
+"""
+
+class ElementCache:
+    """Per-package cache of computed element values.
+
+    Values are indexed by element id, then by a (kind, expression)
+    key. None is a valid cached value.
+    """
+    # Events invalidating the values of the element they hold
+    element_events = ('AnnotationEditEnd', 'AnnotationDelete',
+                      'RelationEditEnd', 'RelationDelete')
+    # Events invalidating the whole cache
+    package_events = ('AnnotationTypeEditEnd', 'AnnotationTypeDelete',
+                      'RelationTypeEditEnd', 'RelationTypeDelete',
+                      'SchemaEditEnd', 'SchemaDelete',
+                      'PackageEditEnd', 'PackageActivate',
+                      'TagUpdate')
+
+    def __init__(self):
+        self._values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, element, kind, expression, compute):
+        """Return the cached value, computing it with compute() if needed.
+        """
+        try:
+            values = self._values[element.id]
+        except KeyError:
+            values = self._values[element.id] = {}
+        key = (kind, expression)
+        try:
+            value = values[key]
+        except KeyError:
+            self.misses += 1
+            value = values[key] = compute()
+        else:
+            self.hits += 1
+        return value
+
+    def invalidate(self, element=None):
+        """Invalidate the values for the element, or the whole cache if None.
+        """
+        if element is None:
+            self._values.clear()
+        else:
+            self._values.pop(element.id, None)
+
+    def update(self, event_name, element=None):
+        """Invalidate the values affected by the given event.
+        """
+        if event_name in self.package_events:
+            self.invalidate()
+        elif event_name in self.element_events and element is not None:
+            self.invalidate(element)
+            if event_name.startswith('Annotation'):
+                # Relation titles may be computed from their members
+                for r in element.relations:
+                    self.invalidate(r)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / total
+
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(len(v) for v in self._values.values())
+
+    def __str__(self):
+        return "ElementCache: %d values, %d hits, %d misses (%.1f%% hit ratio)" % (
+            len(self), self.hits, self.misses, 100 * self.hit_ratio)
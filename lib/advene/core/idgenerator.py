@@ -18,7 +18,11 @@
 #
 """Identifier generator module."""
 
+import logging
+logger = logging.getLogger(__name__)
+
 import re
+import urllib.parse
 import uuid
 
 import advene.core.config as config
@@ -35,6 +39,12 @@ class Generator:
     """Identifier generator.
 
     It keeps a track of ids for all elements from the package.
+
+    For each prefix, the last used index (high-water mark) is stored
+    in the package metadata when saving, so that it does not have to
+    be computed from the package ids when loading. Since stored
+    values may be outdated (package modified by another application),
+    generated ids are always checked against the package elements.
     """
     prefix = {
         Package: "p",
@@ -49,69 +59,125 @@ class Generator:
         ResourceData: "res_",
         }
 
+    # Name of the package metadata holding the high-water marks
+    metadata = 'id_counters'
+
     def __init__(self, package=None):
-        self.last_used={}
-        self.existing=[]
-        for k in self.prefix:
-            self.last_used[k]=0
+        self.package = None
+        self.last_used = None
+        # Known ids that may not (yet) be in the package
+        self.existing = set()
         if package is not None:
             self.init(package)
+        else:
+            self.last_used = dict.fromkeys(self.prefix.values(), 0)
 
     def exists(self, id_):
         """Check if an id already exists.
         """
-        return id_ in self.existing
+        return (id_ in self.existing
+                or (self.package is not None
+                    and self.package.get_element_by_id(id_) is not None))
 
     def add(self, id_):
         """Add a new known id.
         """
-        self.existing.append(id_)
+        self.existing.add(id_)
 
     def remove(self, id_):
         """Remove an id from the existing set.
         """
-        try:
-            self.existing.remove(id_)
-        except ValueError:
-            pass
+        self.existing.discard(id_)
 
     def init(self, package):
-        """Initialize the indexes for the given package."""
+        """Initialize the indexes for the given package.
+
+        The high-water marks are read from the package metadata. If
+        they are not present, they will be computed on first use.
+        """
+        self.package = package
+        self.existing = set()
+        self.last_used = None
+        data = package.getMetaData(config.data.namespace, self.metadata)
+        if data:
+            try:
+                last_used = dict.fromkeys(self.prefix.values(), 0)
+                last_used.update((k, int(v)) for (k, v) in urllib.parse.parse_qsl(data))
+                self.last_used = last_used
+            except ValueError:
+                logger.warning("Invalid id counters metadata: %s", data)
+
+    def scan(self):
+        """Compute the high-water marks from the package ids.
+        """
         prefixes=list(self.prefix.values())
         re_id = re.compile("^(" + "|".join(prefixes) + ")([0-9]+)")
-        last_id={}
-        for k in prefixes:
-            last_id[k]=0
-
-        # FIXME: find all package ids
-        for l in (package.annotations, package.relations,
-                  package.schemas,
-                  package.annotationTypes, package.relationTypes,
-                  package.views, package.queries):
-            for i in l.ids():
-                self.existing.append(i)
-                m=re_id.match(i)
-                if m:
-                    n=int(m.group(2))
-                    k=m.group(1)
-                    if last_id[k] < n:
-                        last_id[k] = n
+        last_id = dict.fromkeys(prefixes, 0)
+        if self.package is not None:
+            package = self.package
+            for l in (package.annotations, package.relations,
+                      package.schemas,
+                      package.annotationTypes, package.relationTypes,
+                      package.views, package.queries):
+                for i in l.ids():
+                    m=re_id.match(i)
+                    if m:
+                        n=int(m.group(2))
+                        k=m.group(1)
+                        if last_id[k] < n:
+                            last_id[k] = n
         # last_id contains the last index used for each prefix
-        self.last_used = dict(last_id)
+        self.last_used = last_id
 
-    def get_id(self, elementtype):
-        """Return a not-yet used id.
+    def store(self, package=None):
+        """Store the high-water marks in the package metadata.
+        """
+        if package is None:
+            package = self.package
+        if self.last_used is None:
+            self.scan()
+        package.setMetaData(config.data.namespace, self.metadata,
+                            urllib.parse.urlencode(sorted((k, v)
+                                                          for (k, v) in self.last_used.items()
+                                                          if v)))
+
+    def reserve(self, elementtype, count):
+        """Reserve a block of count not-yet used ids.
+
+        The high-water mark is updated once for the whole block.
         """
         if config.data.preferences['use-uuid']:
-            id_ = str(uuid.uuid1())
-        else:
-            prefix=self.prefix[elementtype]
-            index=self.last_used[prefix] + 1
-            self.last_used[prefix]=index
+            return [ str(uuid.uuid1()) for i in range(count) ]
+        if self.last_used is None:
+            self.scan()
+        prefix=self.prefix[elementtype]
+        index=self.last_used[prefix]
+        result = []
+        while len(result) < count:
+            index += 1
             id_ = prefix + str(index)
-            # Do not append yet.
-            #self.existing.append(id_)
-        return id_
+            if not self.exists(id_):
+                result.append(id_)
+        self.last_used[prefix]=index
+        # Do not add them to existing: they will be registered upon creation
+        return result
+
+    def release(self, elementtype, ids):
+        """Release reserved ids that were not used.
+
+        This is possible only if they are the last reserved ids for
+        the element type.
+        """
+        prefix=self.prefix[elementtype]
+        indexes = [ int(i[len(prefix):]) for i in ids
+                    if i.startswith(prefix) and i[len(prefix):].isdigit() ]
+        if indexes and max(indexes) == self.last_used.get(prefix):
+            self.last_used[prefix] = min(indexes) - 1
+
+    def get_id(self, elementtype):
+        """Return a not-yet used id.
+        """
+        return self.reserve(elementtype, 1)[0]
 
     def new_from_title(self, title):
         """Generate a new (title, identifier) from a given title.
@@ -119,7 +185,7 @@ class Generator:
         root=helper.title2id(title)
         index=1
         i="%s%d" % (root, index)
-        while i in self.existing:
+        while self.exists(i):
             index += 1
             i="%s%d" % (root, index)
         if index != 1:
@@ -1099,7 +1099,8 @@ class AdveneGUI:
             label = _("Exporting %(duration)s video to\n%(filename)s") % { 'filename': filename,
                                                                            'duration': duration }
 
-        m = MontageRenderer(self.controller, elements)
+        m = MontageRenderer(self.controller, elements,
+                            jobs=config.data.preferences['montage-jobs'])
 
         w = Gtk.Window()
         w.set_title(title)
@@ -1476,6 +1477,10 @@ class AdveneGUI:
                 self.controller.notify('RelationTypeEditEnd', relationtype=element)
             elif isinstance(element, Schema):
                 self.controller.notify('SchemaEditEnd', schema=element)
+            elif isinstance(element, Annotation):
+                self.controller.notify('AnnotationEditEnd', annotation=element)
+            elif isinstance(element, Relation):
+                self.controller.notify('RelationEditEnd', relation=element)
         else:
             col=None
         d.destroy()
@@ -4268,6 +4273,7 @@ Image cache information: %(imagecache)s
                         'player-shortcuts-in-edit-windows', 'player-shortcuts-modifier',
                         'apply-edited-elements-on-save', 'use-uuid',
                         'frameselector-count', 'frameselector-width',
+                        'montage-jobs', 'binary-values',
         )
         # Direct options needing a restart to be taken into account.
         restart_needed_options = ('tts-engine', 'language', 'timestamp-format', 'expert-mode')
@@ -4328,9 +4334,11 @@ Image cache information: %(imagecache)s
         ew.add_label(_("Frame selector (shotvalidation...)"))
         ew.add_spin(_("Frameselector snapshot width"), 'frameselector-width', _("Width of the snapshots in frameselector"), 50, 600)
         ew.add_spin(_("Frameselector count"), 'frameselector-count', _("Number of frames displayed in frameselector."), 3, 25)
+        ew.add_spin(_("Montage rendering jobs"), 'montage-jobs', _("Number of concurrent pipelines for montage rendering (0 for the number of processors)."), 0, 32)
 
         ew.add_title(_("General"))
         ew.add_checkbox(_("Use UUIDs"), 'use-uuid', _("Use UUIDs for identifying elements instead of more readable shortnames"))
+        ew.add_checkbox(_("Binary values"), 'binary-values', _("Store long numeric value signals as binary data in packages (they cannot be read by previous Advene versions)"))
         ew.add_checkbox(_("Weekly update check"), 'update-check', _("Weekly check for updates on the Advene website"))
         ew.add_option(_("On exit,"), 'imagecache-save-on-exit',
                       _("How to handle screenshots on exit"), OrderedDict((
@@ -44,6 +44,7 @@ from advene.gui.util import png_to_pixbuf, enable_drag_source, window_to_png
 from advene.gui.util import decode_drop_parameters, MODIFIER_MASK
 from advene.gui.util.completer import Completer
 import advene.util.helper as helper
+from advene.util.align import align_annotations
 from advene.gui.util import dialog, name2color, get_small_stock_button, get_pixmap_button, get_pixmap_toolbutton
 from advene.gui.views.annotationdisplay import AnnotationDisplay
 from advene.gui.widget import AnnotationWidget, AnnotationTypeWidget
@@ -1525,91 +1526,20 @@ class TimeLine(AdhocView):
 
         def DTWalign_annotations(i, at, typ, mode, delete=True):
             sa = at.annotations
-            sa.sort(key=lambda a: a.fragment.begin)
             da = typ.annotations
-            da.sort(key=lambda a: a.fragment.begin)
-            bestpath = []
-            bestdist = []
-
-            mindist = (abs(sa[0].fragment.begin - da[0].fragment.begin)
-                       + abs(sa[0].fragment.end - da[0].fragment.end)
-                       + abs((sa[0].fragment.end - sa[0].fragment.begin)
-                             - (da[0].fragment.end - da[0].fragment.begin)))
-            bestdist.append(mindist)
-            bestpath.append([])
-            bestpath[0].append(0)
-
-            for j in range(1,len(sa)):
-                bestpath.append([])
-                bestpath[j].append(j)
-
-                dist = (abs(sa[j].fragment.begin - da[0].fragment.begin)
-                        + abs(sa[j].fragment.end - da[0].fragment.end)
-                        + abs((sa[j].fragment.end - sa[j].fragment.begin)
-                              - (da[0].fragment.end - da[0].fragment.begin)))
-                if dist < mindist:
-                    mindist = dist
-                    bestpath[j] = [j]
-                    bestdist.append(dist)
-                else:
-                    bestpath[j] = list(bestpath[j-1])
-                    bestdist.append(bestdist[j-1] + dist)
-
-            for i in range(1,len(da)):
-                currentdist = 0
-                prevsubdist = 0
-                currentpath = []
-                prevsubpath = []
-                for j in range(0,len(sa)):
-                    dist = (abs(sa[j].fragment.begin - da[i].fragment.begin)
-                            + abs(sa[j].fragment.end - da[i].fragment.end)
-                            + abs((sa[j].fragment.end - sa[j].fragment.begin)
-                                  - (da[i].fragment.end - da[i].fragment.begin)))
-
-                    if j == 0:
-                        currentpath = list(bestpath[0])
-                        currentdist = bestdist[0]
-
-                        bestpath[0].append(0)
-                        bestdist[0] = bestdist[0] + dist
-
-                    else:
-                        insdist = bestdist[j] + dist
-                        deldist = bestdist[j-1] + dist
-                        subdist = prevsubdist + dist*1.5
-
-                        currentdist =  bestdist[j]
-                        currentpath = list(bestpath[j])
-
-                        if insdist < deldist :
-                            if insdist < subdist:
-                                bestpath[j].append(j)
-                                bestdist[j] = insdist
-                            else :
-                                prevsubpath.append(j)
-                                bestpath[j] = prevsubpath
-                                bestdist[j] = subdist
-                        elif subdist < deldist :
-                            prevsubpath.append(j)
-                            bestpath[j] = prevsubpath
-                            bestdist[j] = subdist
-                        else:
-                            bestpath[j] = list(bestpath[j-1])
-                            bestdist[j] = deldist
-
-                    prevsubdist = currentdist
-                    prevsubpath = list(currentpath)
+            if not sa or not da:
+                return True
+            alignment = align_annotations(sa, da)
 
             # Update annotation timestamp/contents
             batch_id=object()
-            for (i,j) in enumerate(bestpath[len(sa)-1]):
-                annotation=da[i]
+            for (annotation, reference) in alignment:
                 self.controller.notify('EditSessionStart', element=annotation, immediate=True)
                 if mode == 'time':
-                    annotation.fragment.begin = sa[j].fragment.begin
-                    annotation.fragment.end = sa[j].fragment.end
+                    annotation.fragment.begin = reference.fragment.begin
+                    annotation.fragment.end = reference.fragment.end
                 elif mode == 'content':
-                    annotation.content.data = sa[j].content.data
+                    annotation.content.data = reference.content.data
                 self.controller.notify('AnnotationEditEnd', annotation=annotation, batch=batch_id)
                 self.controller.notify('EditSessionEnd', element=annotation)
             return True
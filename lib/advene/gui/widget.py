@@ -503,18 +503,16 @@ class AnnotationWidget(GenericColorButtonWidget):
             # The annotation contains a list of space-separated values
             # that should be treated as percentage (between 0.0 and
             # 100.0) of the height (FIXME: define a scale somewhere)
-            l=[ v / 100.0 for v in self.annotation.content.parsed() ]
+            # There may be more samples than available pixels: use
+            # the value pyramid to get at most one value per pixel
+            # (peak for waves, mean for bars).
+            mins, maxs, means = self.annotation.content.getValuePyramid().summary(int(width))
+            l=[ v / 100.0 for v in (maxs if renderer == 'wave' else means) ]
             s=len(l)
             if not s:
                 # Nothing to draw
                 return
 
-            if width < s:
-                # There are more samples than available pixels. Downsample the data
-                # FIXME: downsample by picking values or take the mean?
-                l=l[::int(s/width)+1]
-                s=len(l)
-
             w = 1.0 * width / s
             c = 0
             context.set_source_rgba(0, 0, 0, .5)
@@ -70,8 +70,6 @@ class Annotation(modeled.Importable, content.WithContent,
         _impl.Uried.__init__(self, parent=parent)
         self.__fragment = None
 
-        self._relations = [] # backrefs cache for relations
-
         self._cached_type = type
 
         if element is not None:
@@ -228,30 +226,7 @@ class Annotation(modeled.Importable, content.WithContent,
         If parameter =order= is given, only the relations with exactly =order=
         members are returned.
         """
-        # ensure that relation objects have been created,
-        # since it's them who populate self._relations
-        self.getRootPackage ().getRelations ()
-
-        if rank is None:
-            if order is None:
-                return self._relations
-            else:
-                return [
-                    r for r in self._relations if len (r.getMembers ()) == order
-                ]
-        else:
-            if order is None:
-                return [
-                    r for r in self._relations if r.getMembers ()[rank] is self
-                ]
-            else:
-                return [
-                    r for r in self._relations
-                    if r.getMembers ()[rank] is self
-                    and len (r.getMembers ()) == order
-                ]
-        # Cannot happen
-        return []
+        return self.getRootPackage ().getRelationIndex ().get (self, rank=rank, order=order)
 
     def getRelationsWith (self, other, rank=None, order=None):
         """
@@ -259,12 +234,11 @@ class Annotation(modeled.Importable, content.WithContent,
         given annotation. Parameters =rank= and =order=, if provided, are
         applied for this annotation as they would be for =getRelation=.
         """
-        r = []
-        for rel in self.getRelations (rank=rank, order=order):
-            for m in rel.getMembers ():
-                if m == other:
-                    r.append (rel)
-        return r
+        index = self.getRootPackage ().getRelationIndex ()
+        return [ rel
+                 for rel in index.get (self, rank=rank, order=order)
+                 for m in index.members (rel)
+                 if m == other ]
 
     def getOutgoingRelations (self):
         """
@@ -283,20 +257,12 @@ class Annotation(modeled.Importable, content.WithContent,
     def getTypedOutgoingRelations(self):
         """Return the outgoing relations  sorted by relation type ids.
         """
-
-        d=DefaultDict(default=[])
-        for r in self.outgoingRelations:
-            d[r.type.id].append(r)
-        return d
+        return self.getRootPackage ().getRelationIndex ().typed (self, rank=0, order=2)
 
     def getTypedIncomingRelations(self):
         """Return the incoming relations  sorted by relation type ids.
         """
-
-        d=DefaultDict(default=[])
-        for r in self.incomingRelations:
-            d[r.type.id].append(r)
-        return d
+        return self.getRootPackage ().getRelationIndex ().typed (self, rank=1, order=2)
 
     def getRelated(self):
         """Return the related annotation.
@@ -328,19 +294,12 @@ class Annotation(modeled.Importable, content.WithContent,
     def getTypedRelatedOut(self):
         """Return the related outgoing annotations sorted by relation type ids.
         """
-
-        d=DefaultDict(default=[])
-        for r in self.outgoingRelations:
-            d[r.type.id].append(r.members[-1])
-        return d
+        return self.getRootPackage ().getRelationIndex ().typed (self, rank=0, order=2, related=-1)
 
     def getTypedRelatedIn(self):
         """Return the related incoming annotations sorted by relation type ids.
         """
-        d=DefaultDict(default=[])
-        for r in self.incomingRelations:
-            d[r.type.id].append(r.members[0])
-        return d
+        return self.getRootPackage ().getRelationIndex ().typed (self, rank=1, order=2, related=0)
 
 class Relation(modeled.Importable, content.WithContent,
                viewable.Viewable.withClass('relation', '_get_type_uri'),
@@ -394,8 +353,7 @@ class Relation(modeled.Importable, content.WithContent,
             # mode 1 initialization
             modeled.Importable.__init__(self, element, parent)
             _impl.Uried.__init__(self, parent=self.getOwnerPackage())
-            for a in self.getMembers ():
-                a._relations.append (self)
+            self.getRootPackage ()._indexRelation (self)
 
         else:
             # should be mode 2, checking parameter consistency
@@ -421,7 +379,7 @@ class Relation(modeled.Importable, content.WithContent,
             for m in members:
                 # TODO: check integrity when adding members
                 members_bundle.append (m)
-                m._relations.append (self)
+            self.getRootPackage ()._indexRelation (self)
 
             if ident is None:
                 ident = str(uuid.uuid1())
@@ -486,6 +444,92 @@ class Relation(modeled.Importable, content.WithContent,
                                               self.getOwnerPackage (). getAnnotations ())
         return self.__members
 
+    def updateIndex (self):
+        """Update the package relation index after a modification of the members"""
+        self.getRootPackage ().getRelationIndex ().add (self)
+
+    def _getTypeId (self):
+        """Return the type id, without resolving the type element"""
+        type_uri = self._getModel().getAttributeNS(None, "type")
+        if type_uri.startswith('#'):
+            return type_uri[1:]
+        # Imported type: the id is qualified
+        return self.getType().getId()
+
+
+class RelationIndex:
+    """Adjacency index of relations.
+
+    It maps each annotation to the (relation, rank, order) tuples of
+    the relations having the annotation as member, so that relation
+    queries are proportional to the number of relations of the
+    annotation.
+
+    Relations are indexed upon creation, and must be updated (through
+    Relation.updateIndex) if their members are modified. Relations
+    which are not (or no longer) in their package are ignored, so
+    that they are taken into account again if they are inserted
+    later.
+    """
+    def __init__(self):
+        # annotation -> list of (relation, rank, order)
+        self._entries = {}
+        # relation -> tuple of indexed members
+        self._members = {}
+
+    def add(self, relation):
+        """Add or update the index entries for the relation.
+        """
+        members = tuple(relation.getMembers())
+        if self._members.get(relation) == members:
+            return
+        self.remove(relation)
+        self._members[relation] = members
+        order = len(members)
+        for rank, a in enumerate(members):
+            self._entries.setdefault(a, []).append((relation, rank, order))
+
+    def remove(self, relation):
+        """Remove the index entries for the relation.
+        """
+        for a in set(self._members.pop(relation, ())):
+            entries = [ e for e in self._entries.get(a, ()) if e[0] is not relation ]
+            if entries:
+                self._entries[a] = entries
+            else:
+                self._entries.pop(a, None)
+
+    def members(self, relation):
+        """Return the indexed members of the relation.
+        """
+        return self._members.get(relation, ())
+
+    def entries(self, annotation, rank=None, order=None):
+        """Return the matching (relation, rank, order) entries for the annotation.
+        """
+        return [ e
+                 for e in self._entries.get(annotation, ())
+                 if (rank is None or e[1] == rank)
+                 and (order is None or e[2] == order)
+                 and e[0] in e[0].getOwnerPackage().getRelations() ]
+
+    def get(self, annotation, rank=None, order=None):
+        """Return the relations involving the annotation.
+        """
+        return [ e[0] for e in self.entries(annotation, rank, order) ]
+
+    def typed(self, annotation, rank, order, related=None):
+        """Return the relations involving the annotation, sorted by relation type ids.
+
+        If related is not None, return the related annotations
+        (members of rank related) instead of the relations.
+        """
+        d=DefaultDict(default=[])
+        for e in self.entries(annotation, rank, order):
+            r = e[0]
+            d[r._getTypeId()].append(r if related is None else self._members[r][related])
+        return d
+
 
 
 # simple way to do it,
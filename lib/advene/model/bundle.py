@@ -68,6 +68,18 @@ from advene.model.exception import AdveneException
 
 from gettext import gettext as _
 
+def _rindex(node_list, node):
+    """
+    Return the index of the last occurrence of node in node_list.
+
+    Items are mostly appended to bundles, so the reference element is
+    usually found at the end of the list.
+    """
+    for i in range (len (node_list) - 1, -1, -1):
+        if node_list[i] is node:
+            return i
+    raise ValueError(node)
+
 class AbstractBundle:
     """
     Base class of all Bundles.
@@ -272,6 +284,13 @@ class WritableBundle (AbstractBundle):
         length = len (self)
         self.insert (length, item)
 
+    def extend(self, items):
+        """
+        Append all the given items at the end of the bundle.
+        """
+        for item in items:
+            self.append (item)
+
     def insert(self, index, item):
         assert self._assert_add_item (item)
 
@@ -430,11 +449,38 @@ class AbstractXmlBundle(WritableBundle, modeled.Modeled,
             elt_list.insert (true_index, self._get_element (item))
         else:
             ref_elt = self._get_element (self._list[-1])
-            ref_index = elt_list.index (ref_elt)
+            ref_index = _rindex (elt_list, ref_elt)
             elt_list.insert (ref_index + 1, self._get_element (item))
 
         super (AbstractXmlBundle, self).insert (index, item)
 
+    def extend(self, items):
+        """
+        Append all the given items at the end of the bundle.
+
+        The underlying XML structure is updated only once, which is
+        much more efficient than appending items one by one.
+        """
+        items = list (items)
+        if not items:
+            return
+        for item in items:
+            assert self._assert_add_item (item)
+        uris = [ item.getUri (absolute=True) for item in items ]
+        if len (set (uris)) != len (uris):
+            raise ValueError(_("Duplicate items in %s") % uris)
+
+        elt_list = self._getModel ().childNodes
+        if self._list:
+            ref_elt = self._get_element (self._list[-1])
+            true_index = _rindex (elt_list, ref_elt) + 1
+        else:
+            true_index = 0
+        elt_list[true_index:true_index] = [ self._get_element (item) for item in items ]
+
+        self._list.extend (items)
+        self._dict.update (zip (uris, items))
+
 
     def _assert_add_item (self, item):
         assert ( item._getParent ().getRootPackage ()
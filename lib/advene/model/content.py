@@ -36,6 +36,7 @@ from advene.model.constants import adveneNS, xlinkNS, TEXT_NODE, ELEMENT_NODE
 
 import advene.model.util.dom
 import advene.model.util.uri
+import advene.util.values
 
 from advene.model.util.auto_properties import auto_properties
 from advene.model.util.mimetype import MimeType
@@ -236,6 +237,9 @@ class Content(modeled.Modeled,
 
     def __init__(self, parent, element):
         modeled.Modeled.__init__(self, element, parent)
+        # Cached ValuePyramid, and the data/filename it was built from
+        self._pyramid = None
+        self._pyramid_key = None
 
     def getDomElement (self):
         """Return the DOM element representing this content."""
@@ -267,8 +271,10 @@ class Content(modeled.Modeled,
             encoding = 'utf-8'
         if isinstance(d, bytes):
             return d.decode(encoding)
-        else:
-            return d
+        if not d and self.getValuesFile() is not None:
+            # Binary values: return their textual representation
+            return advene.util.values.format_values(self.getValuePyramid().values)
+        return d
 
     def setData(self, data):
         """Set the content's data"""
@@ -334,12 +340,46 @@ class Content(modeled.Modeled,
         """Delete the content's URI"""
         self.setUri(None)
 
+    def getValuesFile(self):
+        """Return the filename of binary values stored in the package resources.
+
+        It is None if the content does not reference binary values
+        (see advene.util.values).
+        """
+        if self.getMimetype() != advene.util.values.VALUES_MIMETYPE:
+            return None
+        href = self.getUri(absolute=False)
+        if not href or not href.startswith('resources/'):
+            return None
+        resources = self._getParent().getOwnerPackage().getResources()
+        if resources is None:
+            return None
+        # Extract only the values and their pyramid from the archive
+        resources.package.extract_member(href[:-4] + '-pyramid.npy')
+        return resources.package.extract_member(href)
+
+    def getValuePyramid(self):
+        """Return the ValuePyramid for application/x-advene-values data.
+
+        It is built once for given data, or loaded from the binary
+        values resource.
+        """
+        filename = self.getValuesFile()
+        key = filename if filename is not None else self.getData()
+        if self._pyramid is None or self._pyramid_key != key:
+            if filename is not None:
+                self._pyramid = advene.util.values.load_values(filename)
+            else:
+                self._pyramid = advene.util.values.ValuePyramid(advene.util.values.parse_values(key))
+            self._pyramid_key = key
+        return self._pyramid
+
     def getStream(self):
         """Return a stream to access the content's data
         FIXME: read/write ?
         """
         uri = self.getUri(absolute=True)
-        if not uri:
+        if not uri or self.getValuesFile() is not None:
             # TODO: maybe find a better way to get a stream from the DOM
             return StringIO(self.getData())
         return advene.model.util.uri.open(uri)
@@ -443,6 +483,8 @@ class Content(modeled.Modeled,
             else:
                 return {'data': self.data}
         elif self.mimetype == 'application/x-advene-values':
+            if self.getValuesFile() is not None:
+                return [ float(v) for v in self.getValuePyramid().values ]
             def convert(v):
                 try:
                     r=float(v)
@@ -29,6 +29,7 @@ from urllib.parse import urljoin
 import re
 
 import xml.sax
+from xml.sax.saxutils import quoteattr
 import xml.dom
 
 from .util.auto_properties import auto_properties
@@ -44,6 +45,7 @@ import advene.model.viewable as viewable
 from advene.model.zippackage import ZipPackage
 from advene.util.expat import PyExpat
 from advene.util.tools import uri2path, is_uri
+import advene.util.values
 
 from advene.model.bundle import StandardXmlBundle, ImportBundle, InverseDictBundle, SumBundle
 from advene.model.constants import adveneNS, xmlNS, xmlnsNS, xlinkNS, dcNS
@@ -98,8 +100,8 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                 if abs_uri.lower().endswith('.azp') or abs_uri.endswith('/'):
                     # Advene Zip Package. Do some magic.
                     self.__zip = ZipPackage(abs_uri)
-                    f=urllib.request.pathname2url(self.__zip.getContentsFile())
-                    element = reader.fromUri("file://" + f).documentElement
+                    with self.__zip.getContentsStream() as f:
+                        element = reader.fromStream(f).documentElement
                 else:
                     element = reader.fromUri(abs_uri).documentElement
             elif hasattr(source, 'read'):
@@ -117,8 +119,8 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                 if source_uri.lower().endswith('.azp') or source_uri.endswith('/'):
                     # Advene Zip Package. Do some magic.
                     self.__zip = ZipPackage(source_uri)
-                    f=urllib.request.pathname2url(self.__zip.getContentsFile())
-                    element = reader.fromUri("file://" + f).documentElement
+                    with self.__zip.getContentsStream() as f:
+                        element = reader.fromStream(f).documentElement
                 else:
                     element = reader.fromUri(source_uri).documentElement
 
@@ -127,6 +129,7 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
         self.__annotations = None
         self.__queries = None
         self.__relations = None
+        self.__relation_index = None
         self.__schemas = None
         self.__views = None
 
@@ -252,6 +255,19 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
             self.__relations = StandardXmlBundle(self, e, annotation.Relation)
         return self.__relations
 
+    def getRelationIndex(self):
+        """Return the adjacency index of this package's relations"""
+        if self.__relation_index is None:
+            self.__relation_index = annotation.RelationIndex()
+            for r in self.getRelations():
+                self.__relation_index.add(r)
+        return self.__relation_index
+
+    def _indexRelation(self, relation):
+        """Update the relation index for the given relation, if it exists"""
+        if self.__relation_index is not None:
+            self.__relation_index.add(relation)
+
     def getSchemas(self):
         """Return a collection of this package's schemas"""
         if self.__schemas is None:
@@ -305,9 +321,80 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                 return el
         return None
 
+    def annotation_statistics(self):
+        """Compute the summary of annotations, in a single pass.
+
+        Return a dict with the following keys:
+          - stats: the duration statistics of all annotations
+          - types: list of (annotation type, count, statistics)
+          - extent: (begin, end) of annotations, or None
+          - tags, authors: tag and author histograms (dicts)
+        """
+        import advene.util.helper as helper
+
+        def statistics(items):
+            if not items:
+                return helper.get_annotations_statistics([], format='raw')
+            return helper.get_durations_statistics([ d for (d, data) in items ],
+                                                   ( data for (d, data) in items ))
+
+        by_type = {}
+        tags = {}
+        authors = {}
+        begin = end = None
+        for a in self.annotations:
+            f = a.fragment
+            if begin is None or f.begin < begin:
+                begin = f.begin
+            if end is None or f.end > end:
+                end = f.end
+            c = a.content
+            # Do not read external (or binary) data
+            data = '' if c.getUri(absolute=False) else c.data
+            by_type.setdefault(a.type.uri, []).append( (f.duration, data) )
+            for t in a.tags:
+                tags[t] = tags.get(t, 0) + 1
+            author = a.author
+            if author:
+                authors[author] = authors.get(author, 0) + 1
+        types = [ (at, len(by_type.get(at.uri, [])), statistics(by_type.get(at.uri, [])))
+                  for at in self.annotationTypes ]
+        return {
+            'stats': statistics([ item for items in by_type.values() for item in items ]),
+            'types': types,
+            'extent': (begin, end) if begin is not None else None,
+            'tags': tags,
+            'authors': authors,
+        }
+
     def generate_statistics(self):
         """Generate the statistics.xml file.
+
+        In addition to element counts, it holds a summary of the
+        package (media, annotation time extent, annotation statistics
+        per type, tag and author histograms) so that packages can be
+        listed without being loaded (see StatisticsHandler).
         """
+        def element(name, attributes, children=()):
+            attrs = "".join(' %s=%s' % (k, quoteattr(str(v))) for (k, v) in attributes)
+            if not children:
+                return "<statistics:%s%s />" % (name, attrs)
+            return "<statistics:%s%s>%s</statistics:%s>" % (name, attrs, "".join(children), name)
+
+        def stats_element(name, stats, attributes=(), children=()):
+            attributes = list(attributes)
+            attributes.extend( (k, stats[k]) for k in ('min', 'max', 'mean', 'median', 'total') )
+            if 'distinct_values_count' in stats:
+                attributes.append( ('distinct', stats['distinct_values_count']) )
+            children = list(children)
+            children.extend( element('value', (('name', k), ('count', v)))
+                             for (k, v) in sorted((stats.get('distinct_values') or {}).items()) )
+            return element(name, attributes, children)
+
+        def meta_elements(el):
+            return [ element('meta', (('name', '%s#%s' % (ns, n)), ('value', v)))
+                     for (ns, n, v) in el.listMetaData() ]
+
         out="""<?xml version="1.0" encoding="UTF-8"?>
     <statistics:statistics xmlns:statistics="urn:advene:names:tc:opendocument:xmlns:manifest:1.0">
     """
@@ -322,6 +409,27 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                       ('query', len(self.queries)),
                       ('view', len(self.views)) ):
             out += """<statistics:item name="%s" value="%d" />""" % (n, l)
+
+        summary = self.annotation_statistics()
+        out += element('media', ( ('uri', self.getMedia()),
+                                  ('duration', self.getMetaData(config.data.namespace, 'duration') or ''),
+                                  ('checksum', self.getMetaData(config.data.namespace, 'media_checksum') or '') ))
+        if summary['extent'] is not None:
+            out += element('extent', zip(('begin', 'end'), summary['extent']))
+        out += "".join(meta_elements(self))
+        out += stats_element('annotations', summary['stats'], (('count', len(self.annotations)), ))
+        for at, count, stats in summary['types']:
+            out += stats_element('annotation-type', stats,
+                                 ( ('id', at.id),
+                                   ('title', at.title or ''),
+                                   ('schema', at.schema.id),
+                                   ('schema-title', at.schema.title or ''),
+                                   ('count', count) ),
+                                 meta_elements(at))
+        for name, histogram in ( ('tag', summary['tags']),
+                                 ('author', summary['authors']) ):
+            out += "".join(element(name, (('name', k), ('count', v)))
+                           for (k, v) in sorted(histogram.items()))
         out += """</statistics:statistics>"""
         return out
 
@@ -351,6 +459,12 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                 z.new()
                 self.__zip = z
 
+            # Store long numeric values as binary resources, if enabled
+            if config.data.preferences['binary-values']:
+                advene.util.values.store_package_values(self)
+            else:
+                advene.util.values.inline_package_values(self)
+
             # Save the content.xml (using binary mode since serialize is handling encoding)
             stream = open (self.__zip.getContentsFile(), "wb")
             self.serialize(stream)
@@ -363,6 +477,7 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
             self.__zip.save(name)
         else:
             # Assuming plain XML format
+            advene.util.values.inline_package_values(self)
             stream = open (name, "wb")
             self.serialize(stream)
             stream.close ()
@@ -492,12 +607,53 @@ class Import(modeled.Modeled, _impl.Aliased, metaclass=auto_properties):
 
 class StatisticsHandler(xml.sax.handler.ContentHandler):
     """Parse a statistics.xml file.
+
+    Data holds the element counts (schema, annotation...), title and
+    description. If the statistics hold the package summary (see
+    Package.generate_statistics), it also holds:
+      - media, media_duration, media_checksum
+      - extent: (begin, end) of annotations
+      - meta: package metadata, as a "ns#name" -> value dict
+      - stats: duration statistics of annotations
+      - annotationtypes: list of dicts (id, title, schema_id, schema,
+        count, stats, meta)
+      - tags, authors: tag and author histograms
     """
     def __init__(self):
         super().__init__()
         # Data will contain parsed elements:
         # title, description, view, schema...
         self.data={}
+        # Annotation type or annotations summary being parsed
+        self.current=None
+
+    @staticmethod
+    def number(value):
+        if value.lstrip('-').isdigit():
+            return int(value)
+        return float(value)
+
+    def integer(self, attributes, name):
+        """Return the integer value of the attribute.
+
+        Missing, empty or invalid values (logged) return None, so that
+        a bad value does not invalidate the whole statistics.
+        """
+        value = attributes.get(name)
+        if not value:
+            return None
+        try:
+            return int(self.number(value))
+        except ValueError:
+            logger.warning("Invalid %s value in statistics: %s", name, value)
+            return None
+
+    def parse_stats(self, attributes):
+        stats = dict( (k, self.number(attributes[k])) for k in ('min', 'max', 'mean', 'median', 'total') )
+        if 'distinct' in attributes:
+            stats['distinct_values_count'] = int(attributes['distinct'])
+            stats['distinct_values'] = {} if stats['distinct_values_count'] < 20 else []
+        return stats
 
     def startElement(self, name, attributes):
         if name == "statistics:title":
@@ -506,6 +662,45 @@ class StatisticsHandler(xml.sax.handler.ContentHandler):
             self.data['description']=urllib.parse.unquote(attributes['value'])
         elif name == 'statistics:item':
             self.data[attributes['name']]=int(attributes['value'])
+        elif name == 'statistics:media':
+            self.data['media'] = attributes['uri']
+            self.data['media_duration'] = self.integer(attributes, 'duration')
+            self.data['media_checksum'] = attributes['checksum'] or None
+        elif name == 'statistics:extent':
+            begin, end = self.integer(attributes, 'begin'), self.integer(attributes, 'end')
+            if begin is not None and end is not None:
+                self.data['extent'] = (begin, end)
+        elif name == 'statistics:annotations':
+            self.data['stats'] = self.parse_stats(attributes)
+            self.current = { 'stats': self.data['stats'] }
+        elif name == 'statistics:annotation-type':
+            self.current = {
+                'id': attributes['id'],
+                'title': attributes['title'] or None,
+                'schema_id': attributes['schema'],
+                'schema': attributes['schema-title'] or None,
+                'count': int(attributes['count']),
+                'stats': self.parse_stats(attributes),
+                'meta': {},
+            }
+            self.data.setdefault('annotationtypes', []).append(self.current)
+        elif name == 'statistics:meta':
+            if self.current is not None:
+                self.current['meta'][attributes['name']] = attributes['value']
+            else:
+                self.data.setdefault('meta', {})[attributes['name']] = attributes['value']
+        elif name == 'statistics:value':
+            self.current['stats']['distinct_values'][attributes['name']] = int(attributes['count'])
+        elif name in ('statistics:tag', 'statistics:author'):
+            self.data.setdefault(name[11:] + 's', {})[attributes['name']] = int(attributes['count'])
+
+    def endElement(self, name):
+        if name in ('statistics:annotations', 'statistics:annotation-type'):
+            stats = self.current['stats']
+            distinct_values = stats.get('distinct_values') or {}
+            if 'distinct_values' in stats:
+                stats['distinct_values_repr'] = "\n".join("\t%s: %s" % (k.replace('\n', '\\n'), distinct_values[k]) for k in sorted(distinct_values.keys()))
+            self.current = None
 
     def parse_file(self, name):
         p=xml.sax.make_parser()
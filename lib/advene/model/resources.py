@@ -52,7 +52,10 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype'), metaclass
         self.author=None
         self.date=None
 
-        self.file_ = self.package.tempfile('resources', resourcepath.replace('/', os.path.sep, -1) )
+        # Archive member name. The file is extracted from the archive
+        # only when its name is needed (see file_).
+        self.member = '/'.join( ('resources', resourcepath) )
+        self._file = self.package.member_file(self.member)
         self._mimetype = None
         self.title = str(self)
 
@@ -62,8 +65,15 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype'), metaclass
     def getId(self):
         return self.resourcepath.split('/')[-1]
 
+    @property
+    def file_(self):
+        """Real filename of the resource.
+        """
+        return self.package.extract_member(self.member)
+
     def getData(self):
-        data=open(self.file_, 'rb').read()
+        with self.package.open_member(self.member) as f:
+            data=f.read()
         mimetype=self.getMimetype()
         if mimetype.startswith('text/') or mimetype in config.data.text_mimetypes:
             # Textual data, return a string
@@ -75,12 +85,13 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype'), metaclass
             mode = 'w'
         else:
             mode = 'wb'
-        with open(self.file_, mode) as f:
+        os.makedirs(os.path.dirname(self._file), exist_ok=True)
+        with open(self._file, mode) as f:
             f.write(data)
 
     def getMimetype(self):
         if self._mimetype is None:
-            (mimetype, encoding) = mimetypes.guess_type(self.file_)
+            (mimetype, encoding) = mimetypes.guess_type(self._file)
             if mimetype is None:
                 mimetype = "text/plain"
             self._mimetype=mimetype
@@ -100,7 +111,7 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype'), metaclass
         return "%s#data_%s" % (self.package.uri, p)
 
     def getStream(self):
-        return open(self.file_, 'rb')
+        return self.package.open_member(self.member)
 
     def getDataBase64(self):
         data = self.getData()
@@ -127,17 +138,28 @@ class Resources(metaclass=auto_properties):
         # Resource path name
         self.resourcepath = resourcepath
 
-        # Real directory
-        self.dir_ = self.package.tempfile( 'resources', resourcepath.replace('/', os.path.sep, -1) )
+        # Archive member name, and real directory. The directory
+        # files are extracted only when its name is needed (see dir_).
+        if resourcepath:
+            self.member = '/'.join( ('resources', resourcepath) )
+        else:
+            self.member = 'resources'
+        self._dir = self.package.member_file(self.member)
         self.filenames=None
         self.title = str(self)
 
+    @property
+    def dir_(self):
+        """Real directory of the resources.
+        """
+        return self.package.extract_tree(self.member)
+
+    def member_name(self, key):
+        return '/'.join( (self.member, key) )
+
     def init_filenames(self):
         if self.filenames is None:
-            try:
-                self.filenames=os.listdir(self.dir_)
-            except OSError:
-                self.filenames=[]
+            self.filenames=self.package.listdir(self.member)
 
     def __str__(self):
         if self.resourcepath == "":
@@ -153,12 +175,11 @@ class Resources(metaclass=auto_properties):
         return self.filenames
 
     def __contains__(self, key):
-        fname=os.path.join( self.dir_, key )
-        return os.path.exists(fname)
+        return self.package.exists(self.member_name(key))
 
     def __getitem__(self, key):
-        fname=os.path.join( self.dir_, key )
-        if not os.path.exists(fname):
+        name=self.member_name(key)
+        if not self.package.exists(name):
             raise KeyError
 
         # resource path for the new resource
@@ -170,7 +191,7 @@ class Resources(metaclass=auto_properties):
         if p in self._children_cache:
             return self._children_cache[p]
 
-        if os.path.isdir(fname):
+        if self.package.isdir(name):
             r=Resources(self.package, p, parent=self)
         else:
             # It is a file. Return its ResourceData
@@ -184,17 +205,17 @@ class Resources(metaclass=auto_properties):
         To create a new directory, use item == Resources.DIRECTORY_TYPE
         """
         self.filenames = None
-        if not os.path.exists(self.dir_):
-            os.mkdir(self.dir_)
-        fname=os.path.join( self.dir_, key )
+        os.makedirs(self._dir, exist_ok=True)
+        fname=os.path.join( self._dir, key )
 
         if item == self.DIRECTORY_TYPE:
-            if os.path.exists(fname):
-                if not os.path.isdir(fname):
+            if self.package.exists(self.member_name(key)):
+                if not self.package.isdir(self.member_name(key)):
                     raise Exception("%s resource exists but is not a folder!" % key)
-            else:
+            elif not os.path.isdir(fname):
                 os.mkdir(fname)
         else:
+            self.package.remove_member(self.member_name(key))
             if isinstance(item, str):
                 mode = 'w'
             else:
@@ -215,11 +236,16 @@ class Resources(metaclass=auto_properties):
         except KeyError:
             pass
         self.filenames = None
-        fname=os.path.join( self.dir_, key )
-        if os.path.isdir(fname):
+        name=self.member_name(key)
+        fname=os.path.join( self._dir, key )
+        if self.package.isdir(name):
+            if self.package.archived_names(name):
+                raise OSError("Resource folder %s is not empty" % key)
             os.rmdir(fname)
         else:
-            os.unlink(fname)
+            self.package.remove_member(name)
+            if os.path.exists(fname):
+                os.unlink(fname)
 
     def getUri (self):
         """Return the URI of the element.
@@ -263,6 +263,27 @@ class AdveneContext(_advene_context):
         self.locals = copy.copy(self._cached_locals)
         self.globals = copy.copy(self._cached_globals)
 
+    def derive(self, here):
+        """Return a new context for here, based on this context.
+
+        The new context shares the method table and options of this
+        context (the method table is copied on the first addMethod
+        call), and gets its own copy of the globals and empty
+        locals. This context is not modified, so it can be used as a
+        prototype from multiple threads.
+        """
+        c = copy.copy(self)
+        c.globals = dict(self.globals)
+        c.globals['here'] = here
+        c.locals = {}
+        c.localStack = []
+        c.repeatStack = []
+        c.repeatMap = {}
+        c.globals['repeat'] = c.repeatMap
+        c.pythonPathFuncs = simpleTALES.PythonPathFunctions(c)
+        c._shared_methods = True
+        return c
+
     def __str__ (self):
         return "<pre>AdveneContext\nGlobals:\n\t%s\nLocals:\n\t%s</pre>" % (
             "\n\t".join([ "%s: %s" % (k, str(v).replace("<", "&lt;"))
@@ -291,6 +312,10 @@ class AdveneContext(_advene_context):
         """Add a new method to this context."""
         # TODO: test that function is indeed a function, and that it has the
         #       correct signature
+        if getattr(self, '_shared_methods', False):
+            # Copy on write of the method table shared with a prototype
+            self.methods = dict(self.methods)
+            self._shared_methods = False
         if True:
             self.methods[name] = function
         else:
@@ -51,6 +51,7 @@ logger = logging.getLogger(__name__)
 
 import zipfile
 import os
+import struct
 import tempfile
 import shutil
 import urllib.request, urllib.parse, urllib.error
@@ -69,6 +70,96 @@ MIMETYPE='application/x-advene-zip-package'
 MANIFEST="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"
 ET._namespace_map[MANIFEST]='manifest'
 
+# Extensions of already compressed data, which are stored without
+# compression.
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp',
+                     '.mp3', '.ogg', '.oga', '.ogv', '.opus', '.flac', '.m4a', '.aac',
+                     '.mp4', '.m4v', '.webm', '.mkv', '.avi', '.mov', '.mpg', '.mpeg',
+                     '.zip', '.azp', '.gz', '.bz2', '.xz')
+
+def member_compression(name):
+    """Return the compression method for the given member name.
+    """
+    if name == 'mimetype' or name.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    (mimetype, encoding) = mimetypes.guess_type(name)
+    if mimetype is not None and mimetype.split('/')[0] in ('audio', 'video'):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def file_signature(fname):
+    """Return a (size, mtime) signature used to detect file modifications.
+    """
+    st = os.stat(fname)
+    return (st.st_size, st.st_mtime_ns)
+
+def copy_raw_member(source, info, dest):
+    """Copy a member from the source zip file object to the dest ZipFile.
+
+    The compressed data is copied as is, without decompression and
+    recompression.
+
+    It relies on zipfile internals (local header layout, ZipFile
+    start_dir/_writecheck/NameToInfo). They are all accessed before
+    anything is written to dest, so that an AttributeError leaves
+    dest unmodified (see copy_member).
+    """
+    source.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for member %s" % info.filename)
+    source.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    new = zipfile.ZipInfo(info.filename, info.date_time)
+    new.compress_type = info.compress_type
+    new.CRC = info.CRC
+    new.compress_size = info.compress_size
+    new.file_size = info.file_size
+    new.external_attr = info.external_attr
+    filelist = dest.filelist
+    name_to_info = dest.NameToInfo
+    # Same steps as ZipFile._open_to_write, but with known sizes
+    dest.fp.seek(dest.start_dir)
+    new.header_offset = dest.fp.tell()
+    dest._writecheck(new)
+    dest._didModify = True
+    dest.fp.write(new.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        data = source.read(min(remaining, 1024 * 1024))
+        if not data:
+            raise zipfile.BadZipFile("Truncated member %s" % info.filename)
+        dest.fp.write(data)
+        remaining -= len(data)
+    dest.start_dir = dest.fp.tell()
+    filelist.append(new)
+    name_to_info[new.filename] = new
+
+def copy_member(archive, info, dest):
+    """Copy a member from the archive ZipFile to the dest ZipFile.
+
+    The compressed data is copied as is if possible. If the zipfile
+    internals used by copy_raw_member are not available, the member
+    is decompressed and compressed again.
+    """
+    try:
+        copy_raw_member(archive.fp, info, dest)
+        return
+    except AttributeError:
+        logger.debug("Cannot copy raw member %s", info.filename, exc_info=True)
+    new = zipfile.ZipInfo(info.filename, info.date_time)
+    new.compress_type = info.compress_type
+    new.external_attr = info.external_attr
+    with archive.open(info) as infile, dest.open(new, 'w') as outfile:
+        shutil.copyfileobj(infile, outfile)
+
+def default_mode():
+    """Return the mode of newly created files (0o666 minus the umask).
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
 class ZipPackage:
     # Global method for cleaning up
     tempdir_list = []
@@ -93,6 +184,13 @@ class ZipPackage:
         # Temp. directory, a unicode string
         self._tempdir = None
         self.file_ = None
+        # Opened archive. Its members are extracted to the temp.
+        # directory only when necessary.
+        self.archive = None
+        self.zipfile = None
+        # Member name -> (ZipInfo in archive, signature of the
+        # extracted file or None if it is not extracted)
+        self.members = {}
 
         if uri:
             if not is_uri(uri):
@@ -117,11 +215,18 @@ class ZipPackage:
     def getContentsFile(self):
         """Return the path to the real XML file.
 
+        Use getContentsStream to read it.
+
         @return: the XML filename
         @rtype: string
         """
         return self.tempfile('content.xml')
 
+    def getContentsStream(self):
+        """Return a binary stream for reading the XML file.
+        """
+        return self.open_member('content.xml')
+
     def tempfile(self, *names):
         """Return a tempfile name.
 
@@ -131,6 +236,11 @@ class ZipPackage:
         """
         return os.path.join(self._tempdir, *names)
 
+    def member_file(self, name):
+        """Return the temp. filename for the member name.
+        """
+        return self.tempfile(*name.split('/'))
+
     def new(self):
         """Prepare a new AZP expanded package.
         """
@@ -141,59 +251,126 @@ class ZipPackage:
 
         os.mkdir(self.tempfile('resources'))
 
-    def extract(self, fname):
-        """Extract the zip file to a temporary directory.
+    def open_archive(self, fname):
+        """Open the zip file in place.
 
-        Return the temporary directory name.
+        Members are read from the archive, and extracted to a
+        temporary directory only when their filename is needed (see
+        extract_member). Modified members are written to the temporary
+        directory, and take precedence over the archive members.
         """
         z=zipfile.ZipFile(fname, 'r')
 
-        def recursive_mkdir(d):
-            parent=os.path.dirname(d)
-            if not os.path.exists(parent):
-                recursive_mkdir(parent)
-            os.mkdir(d)
-
         # Check the validity of mimetype
         try:
             typ = z.read('mimetype').decode('utf-8')
         except KeyError:
+            z.close()
             raise AdveneException(_("File %s is not an Advene zip package.") % self.file_)
         if typ != MIMETYPE:
+            z.close()
             raise AdveneException(_("File %s is not an Advene zip package.") % self.file_)
 
-        # The file is an advene zip package. We can extract its contents
-        # to a temporary directory
         self._tempdir=tempfile.mkdtemp('', 'adv')
         os.mkdir(self.tempfile('resources'))
         self.tempdir_list.append(self._tempdir)
 
-        # FIXME: check the portability (convert / to os.path.sep ?)
-        for name in z.namelist():
-            if name.endswith('/'):
-                # It is a directory name. Strip the trailing /, so
-                # that os.path.dirname(name) really returns the
-                # containing directory
-                name=name[:-1]
-                d=self.tempfile(name)
-                if not os.path.exists(d):
-                    recursive_mkdir(d)
-            else:
-                fname=self.tempfile(name)
-                if not os.path.isdir(os.path.dirname(fname)):
-                    recursive_mkdir(os.path.dirname(fname))
-                outfile = open(fname, 'wb')
-                outfile.write(z.read(name))
-                outfile.close()
-
-        z.close()
-
-        # Create the resources directory if necessary
-        resource_dir = self.tempfile('resources' )
-        if not os.path.exists(resource_dir):
-            os.mkdir(resource_dir)
+        self.zipfile = z
+        self.track_members(fname, z)
         return self._tempdir
 
+    def extract(self, fname):
+        """Extract the zip file to a temporary directory.
+
+        Return the temporary directory name.
+        """
+        self.open_archive(fname)
+        return self.extract_tree('')
+
+    def is_archived(self, name):
+        """Check if the member data is only available from the archive.
+        """
+        m = self.members.get(name)
+        return (m is not None
+                and m[1] is None
+                and self.zipfile is not None
+                and not os.path.exists(self.member_file(name)))
+
+    def extract_member(self, name):
+        """Extract the member to the temporary directory, if necessary.
+
+        Return the member filename.
+        """
+        fname = self.member_file(name)
+        if self.is_archived(name):
+            info = self.members[name][0]
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with self.zipfile.open(info) as infile, open(fname, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile)
+            self.members[name] = (info, file_signature(fname))
+        return fname
+
+    def extract_tree(self, prefix):
+        """Extract the members in the prefix directory ('' for all members).
+
+        Return the directory name.
+        """
+        for name in list(self.members):
+            if not prefix or name.startswith(prefix + '/'):
+                self.extract_member(name)
+        if prefix:
+            d = self.member_file(prefix)
+            os.makedirs(d, exist_ok=True)
+            return d
+        return self._tempdir
+
+    def open_member(self, name):
+        """Return a binary stream for reading the member.
+        """
+        if self.is_archived(name):
+            return self.zipfile.open(self.members[name][0])
+        return open(self.member_file(name), 'rb')
+
+    def archived_names(self, prefix=''):
+        """Return the names of archived members in the prefix directory.
+        """
+        if prefix:
+            prefix = prefix + '/'
+        return [ name for name in self.members
+                 if name.startswith(prefix) and self.is_archived(name) ]
+
+    def exists(self, name):
+        """Check if the member (file or directory) exists.
+        """
+        return (os.path.exists(self.member_file(name))
+                or self.is_archived(name)
+                or self.isdir(name))
+
+    def isdir(self, name):
+        """Check if the member is a directory.
+        """
+        return (os.path.isdir(self.member_file(name))
+                or bool(self.archived_names(name)))
+
+    def listdir(self, name):
+        """Return the names of the files and directories in the name directory.
+        """
+        try:
+            names = set(os.listdir(self.member_file(name)))
+        except OSError:
+            names = set()
+        for n in self.archived_names(name):
+            names.add(n[len(name) + 1:].split('/')[0])
+        return sorted(names)
+
+    def remove_member(self, name):
+        """Remove the member from the archive members.
+
+        The temporary file, if any, must be removed by the caller.
+        """
+        if self.is_archived(name):
+            del self.members[name]
+
     def open(self, fname=None):
         """Open the given AZP file.
 
@@ -218,42 +395,47 @@ class ZipPackage:
             if typ != MIMETYPE:
                 raise AdveneException(_("Directory %s is not an extracted Advene zip package.") % fname)
         else:
-            self._tempdir=self.extract(fname)
+            self.open_archive(fname)
 
         # FIXME: Check against the MANIFEST file
-        for (name, mimetype) in self.manifest_to_list(self.tempfile('META-INF', 'manifest.xml')):
+        with self.open_member('META-INF/manifest.xml') as f:
+            manifest = self.manifest_to_list(f)
+        for (name, mimetype) in manifest:
             if name == '/':
-                pass
-            n=name.replace('/', os.path.sep)
-            if not os.path.exists( self.tempfile(n) ):
+                continue
+            if not self.exists(name):
                 logger.info("Warning: missing file : %s", name)
 
         # FIXME: Make some validity checks (resources/ dir, etc)
         self.file_ = fname
 
-    def save(self, fname=None):
-        """Save the package.
-        """
-        if fname is None:
-            fname=self.file_
-
-        if fname.endswith('/') and not os.path.exists(fname):
-            # We specified a directory that does not exist yet. Create
-            # it.
-            os.mkdir(fname)
+    def track_members(self, archive, z):
+        """Record the members of the archive.
 
-        if os.path.isdir(fname):
-            z=None
-        else:
-            z=zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED)
+        Members which are not extracted, or whose extracted file is
+        not modified, are copied without recompression from the
+        archive on the next save.
+        """
+        self.archive = archive
+        self.members = {}
+        for info in z.infolist():
+            if info.is_dir() or info.flag_bits & 0x1:
+                # Directory or encrypted member
+                continue
+            self.members[info.filename] = (info, None)
 
-        manifest=[]
+    def list_files(self):
+        """Return the list of (name, filename) of the package files.
 
+        filename is None for members that are only in the archive.
+        """
+        files = []
         for (dirpath, dirnames, filenames) in os.walk(self._tempdir):
             # Ignore RCS directory paths
             for d in ('.svn', 'CVS', '_darcs', '.bzr', '.git'):
                 if d in dirnames:
                     dirnames.remove(d)
+            dirnames.sort()
 
             # Remove tempdir prefix
             zpath=dirpath.replace(self._tempdir, '')
@@ -264,27 +446,93 @@ class ZipPackage:
                 # We should have only a relative subdir here
                 zpath=zpath[1:]
 
-            for f in filenames:
-                if f == 'manifest.xml':
-                    # We will write it later on.
-                    continue
+            for f in sorted(filenames):
                 if zpath:
                     name='/'.join( (zpath, f) )
                 else:
                     name=f
-                manifest.append(name)
-                if z is not None:
-                    z.write( os.path.join(dirpath, f), name )
+                files.append( (name, os.path.join(dirpath, f)) )
+        files.extend( (name, None) for name in sorted(self.archived_names()) )
+        # The mimetype must be the first member
+        files.sort(key=lambda t: t[0] != 'mimetype')
+        return [ t for t in files if t[0] != 'META-INF/manifest.xml' ]
+
+    def save(self, fname=None):
+        """Save the package.
+
+        The zip file is written to a temporary file, which then
+        replaces the destination. Unmodified members are copied
+        from the previous archive without recompression.
+        """
+        if fname is None:
+            fname=self.file_
+
+        if fname.endswith('/') and not os.path.exists(fname):
+            # We specified a directory that does not exist yet. Create
+            # it.
+            os.mkdir(fname)
+
+        if os.path.isdir(fname):
+            # Expanded package: all members must be in the directory
+            self.extract_tree('')
+
+        files = self.list_files()
+        manifest = [ name for (name, f) in files ]
 
         # Generation of the manifest file
-        fname=self.tempfile("META-INF", "manifest.xml")
+        manifest_file=self.tempfile("META-INF", "manifest.xml")
+        if not os.path.isdir(os.path.dirname(manifest_file)):
+            os.mkdir(os.path.dirname(manifest_file))
         tree=ET.ElementTree(self.list_to_manifest(manifest))
-        tree.write(fname)
-        if z is not None:
-            # Generation of the manifest file
-            z.write( fname,
-                     "META-INF/manifest.xml" )
-            z.close()
+        tree.write(manifest_file)
+
+        if os.path.isdir(fname):
+            return
+
+        files.append( ("META-INF/manifest.xml", manifest_file) )
+        fd, tmpname = tempfile.mkstemp('.tmp', '.' + os.path.basename(fname), os.path.dirname(os.path.abspath(fname)))
+        signatures = {}
+        copied = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as z:
+                    for (name, f) in files:
+                        info, previous = self.members.get(name, (None, None))
+                        signature = file_signature(f) if f is not None else None
+                        signatures[name] = signature
+                        if info is not None and previous == signature:
+                            # Not extracted, or unmodified
+                            copy_member(self.zipfile, info, z)
+                            copied += 1
+                        else:
+                            z.write(f, name, compress_type=member_compression(name))
+                out.flush()
+                os.fsync(out.fileno())
+            if os.path.exists(fname):
+                shutil.copymode(fname, tmpname)
+            else:
+                # mkstemp creates the file with mode 0600
+                os.chmod(tmpname, default_mode())
+            if self.zipfile is not None:
+                self.zipfile.close()
+                self.zipfile = None
+            os.replace(tmpname, fname)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            if self.zipfile is None and self.archive is not None:
+                # Reopen the previous archive
+                self.zipfile = zipfile.ZipFile(self.archive, 'r')
+            raise
+        logger.debug("Saved %s: %d/%d members copied from the previous archive", fname, copied, len(files))
+
+        # The new archive now holds the unmodified members
+        if self.zipfile is not None:
+            self.zipfile.close()
+        self.archive = fname
+        self.zipfile = zipfile.ZipFile(fname, 'r')
+        self.members = dict( (info.filename, (info, signatures[info.filename]))
+                             for info in self.zipfile.infolist() )
 
     def update_statistics(self, p):
         """Update the META-INF/statistics.xml file
@@ -327,7 +575,7 @@ class ZipPackage:
 
         List of tuples : (name, mimetype)
 
-        @param name: the manifest filename
+        @param name: the manifest filename (or binary stream)
         @type name: string
         @return: a list of typles (name, mimetype)
         """
@@ -342,6 +590,9 @@ class ZipPackage:
     def close(self):
         """Close the package and remove temporary files.
         """
+        if self.zipfile is not None:
+            self.zipfile.close()
+            self.zipfile = None
         shutil.rmtree(self._tempdir, ignore_errors=True)
         self.tempdir_list.remove(self._tempdir)
         return True
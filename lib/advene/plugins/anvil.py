@@ -28,7 +28,7 @@ from gettext import gettext as _
 
 import advene.core.config as config
 from advene.util.importer import GenericImporter
-import xml.etree.ElementTree as ET
+from advene.util.xmlstream import XMLStream
 
 def register(controller=None):
     controller.register_importer(AnvilImporter)
@@ -50,38 +50,35 @@ class AnvilImporter(GenericImporter):
         return 0
 
     def process_file(self, filename):
-        tree=ET.parse(filename)
-        root=tree.getroot()
-
         p, at=self.init_package(filename=filename,
                                 schemaid='anvil', annotationtypeid=None)
-        video=root.find('head/video')
-        if video is not None:
-            mediafile=video.attrib['src']
-            p.setMedia(mediafile)
-        self.convert(self.iterator(root))
+        stream=XMLStream(filename,
+                         start_tags=('annotation', 'track'),
+                         end_tags=('video', 'el', 'track'))
+        self.convert(self.iterator(stream))
         self.progress(1.0)
         return self.package
 
-    def iterator(self, root):
+    def iterator(self, stream):
         schema=self.package.get_element_by_id('anvil')
-        if root.tag != 'annotation':
-            logger.error("Invalid Anvil file format: %s", root.tag)
-            return
-
-        progress=0.01
-        self.progress(progress)
-        l=root.findall('.//track')
-        type_incr=0.98/len(l)
-        for track in l:
-            at=self.create_annotation_type (schema, track.attrib['name'])
-            self.progress(value=progress, label="Converting " + at.id)
-            attribnames=set()
-            elements=track.findall('.//el')
-            el_incr=type_incr / len(elements)
-            for el in elements:
-                progress += el_incr
-                self.progress(progress)
+        root=None
+
+        self.progress(0.01)
+        for event, name, el in stream:
+            if root is None:
+                root=el
+                if root.tag != 'annotation':
+                    logger.error("Invalid Anvil file format: %s", root.tag)
+                    return
+                continue
+            if name == 'video':
+                self.package.setMedia(el.attrib['src'])
+            elif name == 'track' and event == 'start':
+                at=self.create_annotation_type (schema, el.attrib['name'])
+                self.progress(value=stream.progress(), label="Converting " + at.id)
+                attribnames=set()
+            elif name == 'el':
+                self.progress(stream.progress())
                 content="\n".join( [ "%s=%s" % (a.attrib['name'], a.text)
                                      for a in el.findall('attribute') ] )
                 attribnames.update([ a.attrib['name'] for a in el.findall('attribute') ])
@@ -91,7 +88,7 @@ class AnvilImporter(GenericImporter):
                     'begin': int(float(el.attrib['start']) * 1000),
                     'end': int(float(el.attrib['end']) * 1000),
                     }
-            if len(attribnames) == 1:
+            elif name == 'track' and len(attribnames) == 1:
                 n=list(attribnames)[0]
                 # Only 1 attribute name. Define an appropriate
                 # representation for the type.
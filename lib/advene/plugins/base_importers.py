@@ -30,12 +30,11 @@ import os
 import re
 import sys
 import urllib
-import xml.dom
 import xml.etree.ElementTree as ET
 
 import advene.core.config as config
-import advene.util.handyxml as handyxml
 from advene.util.importer import GenericImporter
+from advene.util.xmlstream import XMLStream, local_name, element_text, find_child, find_children
 import advene.util.helper as helper
 
 def register(controller=None):
@@ -49,6 +48,7 @@ def register(controller=None):
     controller.register_importer(IRIImporter)
     controller.register_importer(IRIDataImporter)
     controller.register_importer(FlatJSONImporter)
+    controller.register_importer(FlatNDJSONImporter)
     return True
 
 class TextImporter(GenericImporter):
@@ -437,48 +437,52 @@ class XiImporter(GenericImporter):
         else:
             return 0
 
-    def iterator(self, xi):
-        for t in xi.Turn:
-            d={}
-            d['begin']=self.anchors[t.start]
-            d['end']=self.anchors[t.end]
-            clist=[]
-            try:
-                for vc in t.Verbal[0].VContent:
-                    clist.append(" ".join([ t.value for t in vc.Token ]))
-                content = "\n".join(clist)
-            except AttributeError:
-                content = "No verbal content"
-
-            d['content']=content
-            yield d
+    def verbal_content(self, turn):
+        """Return the verbal content of a Turn element.
+        """
+        verbal = find_child(turn, 'Verbal')
+        vcontents = find_children(verbal, 'VContent') if verbal is not None else []
+        if not vcontents:
+            return "No verbal content"
+        clist=[]
+        for vc in vcontents:
+            tokens = find_children(vc, 'Token')
+            if not tokens or any(t.get('value') is None for t in tokens):
+                return "No verbal content"
+            clist.append(" ".join([ t.get('value') for t in tokens ]))
+        return "\n".join(clist)
+
+    def iterator(self, stream):
+        self.media=None
+        for event, name, element in stream:
+            if name == 'Signal':
+                self.signals[element.get('id')] = element.get('loc')
+            elif name == 'Anchor':
+                self.anchors[element.get('id')] = int(float(element.get('offset').replace(',','.')) * self.factors[element.get('unit')])
+                if self.media is None:
+                    self.media = self.signals[element.get('refSignal')]
+                elif self.media != self.signals[element.get('refSignal')]:
+                    logger.error("Erreur: many source files, not supported")
+                    sys.exit(1)
+            elif name == 'Turn':
+                yield {
+                    'begin': self.anchors[element.get('start')],
+                    'end': self.anchors[element.get('end')],
+                    'content': self.verbal_content(element),
+                }
 
     def process_file(self, filename):
-        xi=handyxml.xml(filename)
-
         p, at=self.init_package(filename=filename,
                                 schemaid='xi-schema',
                                 annotationtypeid='xi-verbal')
         self.defaulttype=at
 
-        # self.signals init
-        for s in xi.Signals[0].Signal:
-            self.signals[s.id] = s.loc
+        stream = XMLStream(filename, end_tags=('Signal', 'Anchor', 'Turn'))
+        self.convert(self.iterator(stream))
 
-        # self.anchors init
-        filename=None
-        for a in xi.Anchors[0].Anchor:
-            self.anchors[a.id] = int(float(a.offset.replace(',','.')) * self.factors[a.unit])
-            if filename is None:
-                filename = self.signals[a.refSignal]
-            elif filename != self.signals[a.refSignal]:
-                logger.error("Erreur: many source files, not supported")
-                sys.exit(1)
+        if not self.package.media and self.media is not None:
+            self.package.setMedia(self.media)
 
-        if not self.package.media:
-            self.package.setMedia(filename)
-
-        self.convert(self.iterator(xi))
         self.progress(1.0)
         return self.package
 
@@ -682,126 +686,93 @@ class CmmlImporter(GenericImporter):
 
         return msec
 
-    def xml_to_text(self, element):
-        l=[]
-        if isinstance(element, handyxml.HandyXmlWrapper):
-            element=element.node
-        if element.nodeType is xml.dom.Node.TEXT_NODE:
-            # Note: element.data returns a unicode object
-            # that happens to be in the default encoding (iso-8859-1
-            # currently on my system). We encode it to utf-8 to
-            # be sure to deal only with this encoding afterwards.
-            l.append(element.data.encode('utf-8'))
-        elif element.nodeType is xml.dom.Node.ELEMENT_NODE:
-            for e in element.childNodes:
-                l.append(self.xml_to_text(e))
-        return "".join(l)
-
-    def iterator(self, cm):
-        # Parse stream information
+    def clip_data(self, clip, begin, end):
+        """Generate the annotation data for a clip element.
+        """
+        for child in clip:
+            name=local_name(child.tag)
+            if name == 'a':
+                content="href=%s\ntext=%s" % (child.get('href'),
+                                              element_text(child).replace("\n", "\\n"))
+                atype=self.atypes['link']
+            elif name == 'img':
+                content=child.get('src')
+                atype=self.atypes['image']
+            elif name == 'desc':
+                content=element_text(child).replace("\n", "\\n")
+                atype=self.atypes['description']
+            elif name == 'meta':
+                # Meta attributes (need to create types as needed)
+                metaname=child.get('name')
+                if metaname is None:
+                    continue
+                if metaname not in self.atypes:
+                    self.atypes[metaname]=self.create_annotation_type(self.schema, metaname)
+                content=child.get('content', '')
+                atype=self.atypes[metaname]
+            else:
+                continue
+            yield {
+                'type': atype,
+                'begin': begin,
+                'end': end,
+                'content': content,
+                }
 
+    def iterator(self, stream, events):
         # Delayed is a list of yielded dictionaries,
         # which may be not complete on the first pass
         # if the end attribute was not filled.
         delayed=[]
-
-        progress=0.5
-        incr=0.5 / len(cm.clip)
-
-        for clip in cm.clip:
-            if not self.progress(progress, _("Parsing clip information")):
-                break
-            progress += incr
-            try:
-                begin=clip.start
-            except AttributeError:
-                logger.error("Error in CMML importer", exc_info=True)
-                begin=0
-            begin=self.npt2time(begin)
-
-            for d in delayed:
-                # We can now complete the previous annotations
-                d['end']=begin
-                yield d
-            delayed=[]
-
-            try:
-                end=self.npt2time(clip.end)
-            except AttributeError:
-                end=None
-
-            # Link attribute
-            try:
-                l=clip.a[0]
-                d={
-                    'type': self.atypes['link'],
-                    'begin': begin,
-                    'end': end,
-                    'content': "href=%s\ntext=%s" % (l.href,
-                                                     self.xml_to_text(l).replace("\n", "\\n")),
-                    }
-                if end is None:
-                    delayed.append(d)
-                else:
-                    yield d
-            except AttributeError:
-                logger.error("CMML - link error", exc_info=True)
-                pass
-
-            # img attribute
-            try:
-                i=clip.img[0]
-                d={
-                    'type': self.atypes['image'],
-                    'begin': begin,
-                    'end': end,
-                    'content': i.src,
-                    }
-                if end is None:
-                    delayed.append(d)
-                else:
-                    yield d
-            except AttributeError:
-                pass
-
-            # desc attribute
-            try:
-                d=clip.desc[0]
-                d={
-                    'type': self.atypes['description'],
-                    'begin': begin,
-                    'end': end,
-                    'content': self.xml_to_text(d).replace("\n", "\\n"),
-                    }
-                if end is None:
-                    delayed.append(d)
-                else:
+        streams=0
+
+        for event, name, element in events:
+            if name == 'head':
+                # Handle heading information
+                title=find_child(element, 'title')
+                if title is not None:
+                    self.schema.title=element_text(title)
+                #FIXME: conversion of metadata (meta name=Producer, DC.Author)
+            elif name == 'stream':
+                # Handle stream information
+                streams += 1
+                if streams > 1:
+                    self.log("Multiple streams. Will handle only the first one. Support yet to come...")
+                    continue
+                t=element.get('basetime')
+                self.basetime=int(t) if t else 0
+                i=find_child(element, 'import')
+                self.package.setMedia(i.get('src', '') if i is not None else "")
+            elif name == 'clip':
+                if not self.progress(0.5 + stream.progress() / 2, _("Parsing clip information")):
+                    break
+                begin=self.npt2time(element.get('start', 0))
+                end=element.get('end')
+                if end is not None:
+                    end=self.npt2time(end)
+
+                for d in delayed:
+                    # We can now complete the previous annotations
+                    d['end']=begin
                     yield d
-            except AttributeError:
-                pass
+                delayed=[]
 
-            # Meta attributes (need to create schemas as needed)
-            try:
-                for meta in clip.meta:
-                    if meta.name not in self.atypes:
-                        self.atypes[meta.name]=self.create_annotation_type(self.schema, meta.name)
-                    d={
-                        'type': self.atypes[meta.name],
-                        'begin': begin,
-                        'end': end,
-                        'content': meta.content,
-                        }
+                for d in self.clip_data(element, begin, end):
                     if end is None:
                         delayed.append(d)
                     else:
                         yield d
-            except AttributeError:
-                pass
 
     def process_file(self, filename):
-        cm=handyxml.xml(filename)
-
-        if cm.node.nodeName != 'cmml':
+        stream=XMLStream(filename,
+                         start_tags=('cmml', ),
+                         end_tags=('head', 'stream', 'clip'))
+        it=iter(stream)
+        try:
+            event, name, root=next(it)
+        except (StopIteration, ET.ParseError):
+            name=None
+        if name != 'cmml':
             self.log("This does not look like a CMML file.")
             return
 
@@ -817,45 +788,10 @@ class CmmlImporter(GenericImporter):
         for n in ('link', 'image', 'description'):
             self.atypes[n]=self.create_annotation_type(self.schema, n)
         self.atypes['link'].mimetype = 'application/x-advene-structured'
+        self.basetime=0
 
-        # Handle heading information
-        self.progress(0.4, _("Parsing header information"))
-        try:
-            h=cm.head[0]
-            try:
-                t=h.title
-                self.schema.title=self.xml_to_text(t)
-            except AttributeError:
-                pass
-            #FIXME: conversion of metadata (meta name=Producer, DC.Author)
-        except AttributeError:
-            # Not <head> componenent
-            pass
-
-        # Handle stream information
         self.progress(0.5, _("Parsing stream information"))
-        if len(cm.stream) > 1:
-            self.log("Multiple streams. Will handle only the first one. Support yet to come...")
-        s=cm.stream[0]
-        try:
-            t=s.basetime
-            if t:
-                t=int(t)
-        except AttributeError:
-            t=0
-        self.basetime=t
-
-        # Stream src:
-        try:
-            il=cm.node.xpath('//import')
-            if il:
-                i=il[0]
-                src=i.getAttributeNS(xml.dom.EMPTY_NAMESPACE, 'src')
-        except AttributeError:
-            src=""
-        self.package.setMedia(src)
-
-        self.convert(self.iterator(cm))
+        self.convert(self.iterator(stream, it))
 
         self.progress(1.0)
 
@@ -865,6 +801,9 @@ class IRIImporter(GenericImporter):
     """IRI importer.
     """
     name = _("IRI importer")
+    # The iterator looks up previously created annotations, so they
+    # must be appended to the package immediately.
+    convert_batch_size = 1
 
     def __init__(self, **kw):
         super(IRIImporter, self).__init__(**kw)
@@ -884,107 +823,137 @@ class IRIImporter(GenericImporter):
         else:
             return 0
 
-    def iterator(self, iri):
-        schema = None
-        ensembles=iri.body[0].ensembles[0].ensemble
-        progress=0.1
-        incr=0.02
-        for ensemble in ensembles:
-            sid=ensemble.id
-            progress += incr
-            if not self.progress(progress, _("Parsing ensemble %s") % sid):
-                break
-            schema=self.create_schema(sid,
-                                      author=ensemble.author or self.author,
-                                      date=ensemble.date,
-                                      title=ensemble.title,
-                                      description=ensemble.abstract)
-
-            for decoupage in ensemble.decoupage:
-                tid = decoupage.id
-                progress += incr
-                if not self.progress(progress, _("Parsing decoupage %s") % tid):
-                    break
-                # Update self.duration
-                self.duration=max(int(decoupage.dur), self.duration)
-
-                # Create the type
-                if tid not in self.atypes:
-                    at=self.create_annotation_type(schema, tid,
-                                                   mimetype='application/x-advene-structured',
-                                                   author=decoupage.author or self.author,
-                                                   title= decoupage.title,
-                                                   date = decoupage.date,
-                                                   description=decoupage.abstract,
-                                                   representation="here/content/parsed/title")
-                    at.setMetaData(config.data.namespace, "color", decoupage.color)
-                    self.atypes[tid]=at
-                else:
-                    at=self.atypes[tid]
+    @staticmethod
+    def get_value(element, name):
+        """Return the value of a attribute or child element.
+        """
+        value=element.get(name)
+        if value is None:
+            child=find_child(element, name)
+            value=element_text(child) if child is not None else ''
+        return value
+
+    def create_ensemble_schema(self, ensemble):
+        return self.create_schema(ensemble.get('id'),
+                                  author=ensemble.get('author') or self.author,
+                                  date=ensemble.get('date'),
+                                  title=self.get_value(ensemble, 'title'),
+                                  description=self.get_value(ensemble, 'abstract'))
+
+    def create_decoupage_type(self, schema, decoupage):
+        tid=decoupage.get('id')
+        if tid not in self.atypes:
+            at=self.create_annotation_type(schema, tid,
+                                           mimetype='application/x-advene-structured',
+                                           author=decoupage.get('author') or self.author,
+                                           title=self.get_value(decoupage, 'title'),
+                                           date=decoupage.get('date'),
+                                           description=self.get_value(decoupage, 'abstract'),
+                                           representation="here/content/parsed/title")
+            at.setMetaData(config.data.namespace, "color", decoupage.get('color'))
+            self.atypes[tid]=at
+        return self.atypes[tid]
+
+    def view_data(self, view, decoupage, schema):
+        """Process a view element.
+
+        Generate new annotations in multiple types mode, else add
+        the view values to the existing annotations.
+        """
+        if self.multiple_types:
+            tid=view.get('id')
+            if tid not in self.atypes:
+                at=self.create_annotation_type(schema, tid,
+                                               mimetype='text/plain',
+                                               author=view.get('author') or self.author,
+                                               title=self.get_value(view, 'title'),
+                                               date=view.get('date'),
+                                               description=self.get_value(view, 'abstract'))
+                at.setMetaData(config.data.namespace, "color", decoupage.get('color'))
+                self.atypes[tid]=at
+            at=self.atypes[tid]
+        for ref in find_children(view, 'ref'):
+            try:
+                an=self.package.annotations['#'.join((self.package.uri, ref.get('id')))]
+            except KeyError:
+                logger.error("IRIImporter: Invalid id %s", ref.get('id'))
+                continue
+            if self.multiple_types:
+                yield {
+                    'type': at,
+                    'begin': an.fragment.begin,
+                    'end': an.fragment.end,
+                    'author': an.author,
+                    'date': an.date,
+                    'content': ref.get('type', ''),
+                }
+            else:
+                an.content.data += '\n%s=%s' % (view.get('id'),
+                                                ref.get('type', '').replace('\n', '\\n'))
+
+    def iterator(self, stream):
+        schema=None
+        decoupage=None
+        at=None
+        for event, name, element in stream:
+            if event == 'start':
+                if name == 'ensemble':
+                    ensemble=element
+                    schema=None
+                elif name == 'decoupage':
+                    # The ensemble title/abstract children have been parsed
+                    if schema is None:
+                        schema=self.create_ensemble_schema(ensemble)
+                        if not self.progress(stream.progress(), _("Parsing ensemble %s") % schema.id):
+                            break
+                    decoupage=element
+                    at=None
+                    # Update self.duration
+                    self.duration=max(int(decoupage.get('dur', 0)), self.duration)
+                elif name == 'elements':
+                    # The decoupage title/abstract children have been parsed
+                    at=self.create_decoupage_type(schema, decoupage)
+                    if not self.progress(stream.progress(), _("Parsing decoupage %s") % at.id):
+                        break
+                continue
 
-                for el in decoupage.elements[0].element:
-                    d={'id': el.id,
+            if name == 'element':
+                yield {'id': element.get('id'),
                        'type': at,
-                       'begin': el.begin,
-                       'duration': el.dur,
-                       'author': el.author or self.author,
-                       'date': el.date,
+                       'begin': element.get('begin'),
+                       'duration': element.get('dur'),
+                       'author': element.get('author') or self.author,
+                       'date': element.get('date'),
                        'content': "title=%s\nabstract=%s\nsrc=%s" % (
-                           str(el.title).encode('utf-8').replace('\n', '\\n'),
-                           str(el.abstract).encode('utf-8').replace('\n', '\\n'),
-                           str(el.src).encode('utf-8').replace('\n', '\\n'),
+                           self.get_value(element, 'title').replace('\n', '\\n'),
+                           self.get_value(element, 'abstract').replace('\n', '\\n'),
+                           self.get_value(element, 'src').replace('\n', '\\n'),
                        )
-                    }
-                    yield d
+                }
+            elif name == 'view':
                 # process "views" elements to add attributes
-                progress += incr
-                if not self.progress(progress, _("Parsing views")):
+                if not self.progress(stream.progress(), self.get_value(element, 'title')):
                     break
-                try:
-                    views=decoupage.views[0].view
-                except AttributeError:
-                    # No defined views
-                    views=[]
-                for view in views:
-                    if self.multiple_types:
-                        tid=view.id
-                        if tid not in self.atypes:
-                            at=self.create_annotation_type(schema, tid,
-                                                           mimetype='text/plain',
-                                                           author=view.author or self.author,
-                                                           title= view.title,
-                                                           date = view.date,
-                                                           description=view.abstract)
-                            at.setMetaData(config.data.namespace, "color", decoupage.color)
-                            self.atypes[tid]=at
-                        else:
-                            at=self.atypes[tid]
-                    progress += incr
-                    if not self.progress(progress, view.title):
-                        break
-                    for ref in view.ref:
-                        an = [a for a in self.package.annotations if a.id == ref.id ]
-                        if not an:
-                            logger.error("IRIImporter: Invalid id %s", ref.id)
-                        else:
-                            an=an[0]
-                            if self.multiple_types:
-                                d={
-                                    'type': at,
-                                    'begin': an.fragment.begin,
-                                    'end': an.fragment.end,
-                                    'author': an.author,
-                                    'date': an.date,
-                                    'content': ref.type.encode('utf-8')
-                                }
-                                yield d
-                            else:
-                                an.content.data += '\n%s=%s' % (view.id,
-                                                                ref.type.encode('utf-8').replace('\n', '\\n'))
+                if at is None:
+                    at=self.create_decoupage_type(schema, decoupage)
+                yield from self.view_data(element, decoupage, schema)
+            elif name == 'head':
+                # Metadata extraction
+                meta=dict((m.get('name'), m.get('content')) for m in find_children(element, 'meta'))
+                if 'title' in meta:
+                    self.package.title = meta['title']
+                if 'contributor' in meta:
+                    self.package.author = meta['contributor'] or self.author
+            elif name == 'medias':
+                # Get the video file.
+                med=[ m for m in find_children(element, 'media') if m.get('id') == 'video' ]
+                if med:
+                    video=find_child(med[0], 'video')
+                    # Got a video file reference
+                    if video is not None and not self.package.media:
+                        self.package.setMedia(video.get('src'))
 
     def process_file(self, filename):
-        iri=handyxml.xml(filename)
-
         self.progress(0.1, _("Initializing package"))
         p, at=self.init_package(filename=filename,
                                 schemaid=None,
@@ -993,25 +962,10 @@ class IRIImporter(GenericImporter):
             self.package=p
         self.defaulttype=at
 
-        # Get the video file.
-        med=[ i for i in iri.body[0].medias[0].media  if i.id == 'video' ]
-        if med:
-            # Got a video file reference
-            if not self.package.media:
-                self.package.setMedia(med[0].video[0].src)
-
-        # Metadata extraction
-        meta=dict((m.name, m.content) for m in iri.head[0].meta)
-        try:
-            self.package.title = meta['title']
-        except KeyError:
-            pass
-        try:
-            self.package.author = meta['contributor'] or self.author
-        except KeyError:
-            pass
-
-        self.convert(self.iterator(iri))
+        stream=XMLStream(filename,
+                         start_tags=('ensemble', 'decoupage', 'elements'),
+                         end_tags=('head', 'element', 'view', 'medias'))
+        self.convert(self.iterator(stream))
         if self.duration != 0:
             if not self.package.getMetaData(config.data.namespace, "duration"):
                 self.package.setMetaData (config.data.namespace, "duration", str(self.duration))
@@ -1105,8 +1059,11 @@ class FlatJSONImporter(GenericImporter):
 
     def process_file(self, filename):
         try:
-            with open(filename, 'r') as f:
-                data = json.load(f)
+            if filename == '-':
+                data = json.load(sys.stdin)
+            else:
+                with open(filename, 'r') as f:
+                    data = json.load(f)
         except ValueError:
             logger.error("Cannot parse source data")
             return self.package
@@ -1119,3 +1076,51 @@ class FlatJSONImporter(GenericImporter):
             self.convert(self.iterator(data['annotations']))
         self.progress(1.0)
         return self.package
+
+class FlatNDJSONImporter(GenericImporter):
+    """FlatNDJSON importer.
+
+    Import newline-delimited FlatJSON data (one annotation per
+    line). Lines are parsed lazily, so that large files (or the
+    standard input, with "-" as filename) can be imported with bounded
+    memory.
+    """
+    name = _("FlatNDJSON importer")
+
+    @staticmethod
+    def can_handle(fname):
+        if fname.lower().endswith('.ndjson') or fname.lower().endswith('.jsonl'):
+            return 100
+        else:
+            return 0
+
+    def iterator(self, source):
+        media_set = False
+        for n, line in enumerate(source, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                a = json.loads(line)
+            except ValueError:
+                logger.error("Cannot parse line %d", n)
+                continue
+            if not media_set:
+                self.package.setMedia(a.get('media'))
+                media_set = True
+            # The keys of the FlatJSON export are the same as those
+            # accepted by the Import API.
+            yield a
+
+    def process_file(self, filename):
+        p, at = self.init_package()
+        p.setMetaData(config.data.namespace_prefix['dc'],
+                      'description',
+                      _("Converted from %s") % filename)
+        if filename == '-':
+            self.convert(self.iterator(sys.stdin))
+        else:
+            with open(filename, 'r', encoding='utf-8') as f:
+                self.convert(self.iterator(f))
+        self.progress(1.0)
+        return self.package
@@ -31,7 +31,7 @@ import re
 
 import advene.core.config as config
 from advene.util.importer import GenericImporter
-import xml.etree.ElementTree as ET
+from advene.util.xmlstream import XMLStream
 from advene.model.exception import AdveneException
 
 MIMETYPE = "application/x-cinelab-zip-package"
@@ -145,19 +145,24 @@ class CinelabImporter(GenericImporter):
             self.extract(filename)
             filename = self.tempfile('content.xml')
 
-        tree=ET.parse(filename)
-        root=tree.getroot()
-
         p, at = self.init_package(filename=filename)
 
         # Initialize Media data
         self.medias = {}
-        for v in (root.find(ns('cinelab:medias')) or []):
-            # FIXME: handle metadata
-            self.medias[v.attrib['id']] = v.attrib['url']
         # Will be initialized when first referenced in source package
         self.default_media = None
-        self.convert(self.iterator(root))
+        # Annotations are processed and discarded while parsing. The
+        # other elements (metadata, types, views) remain in the root
+        # element tree.
+        self.root = None
+        stream = XMLStream(filename,
+                           start_tags=('package', ),
+                           end_tags=('medias', 'annotation'))
+        self.convert(self.iterator(stream))
+        root = self.root
+        if root is None:
+            self.log("This does not look like a Cinelab file.")
+            return
 
         package_author = meta(root, 'dc:creator')
         package_created = meta(root, 'dc:created')
@@ -233,18 +238,25 @@ class CinelabImporter(GenericImporter):
         self.progress(1.0)
         return self.package
 
-    def iterator(self, root):
-        package_author = meta(root, 'dc:creator')
-        package_created = meta(root, 'dc:created')
-
-        annotations = root.find(ns('cinelab:annotations'))
-        if annotations is None:
-            annotations = []
-        size = 1.0 * len(annotations)
+    def iterator(self, stream):
+        package_author = None
         self.progress(0, _("Importing annotations"))
-        for i, a in enumerate(annotations):
-            if not self.progress(i / size):
+        for event, name, a in stream:
+            if name == 'package':
+                if self.root is None:
+                    self.root = a
+                continue
+            elif name == 'medias':
+                for v in a:
+                    # FIXME: handle metadata
+                    self.medias[v.attrib['id']] = v.attrib['url']
+                continue
+            if not self.progress(stream.progress()):
                 return
+            if package_author is None:
+                # The package metadata precedes the annotations
+                package_author = meta(self.root, 'dc:creator')
+                package_created = meta(self.root, 'dc:created')
             if self.default_media is None:
                 self.default_media = self.medias.get(a.attrib['media'], None)
             # FIXME: add check for embedded content
@@ -33,6 +33,7 @@ def register(controller=None):
 
 class CutterImporter(GstImporter):
     name = _("Audio segmentation")
+    segmentable = True
 
     def __init__(self, *p, **kw):
         super(CutterImporter, self).__init__(*p, **kw)
@@ -23,7 +23,7 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
-from math import sqrt
+import numpy
 
 import advene.core.config as config
 from advene.util.gstimporter import GstImporter
@@ -32,9 +32,36 @@ def register(controller=None):
     controller.register_importer(DominantColorImporter)
     return True
 
+def color_distance(colors, reference):
+    """Return the distances between an array of RGB colors and a reference color.
+
+    From https://stackoverflow.com/a/9085524/2870028
+    who got it from https://www.compuphase.com/cmetric.htm:
+    typedef struct {
+        unsigned char r, g, b;
+    } RGB;
+
+    double ColourDistance(RGB e1, RGB e2)
+    {
+        long rmean = ( (long)e1.r + (long)e2.r ) / 2;
+        long r = (long)e1.r - (long)e2.r;
+        long g = (long)e1.g - (long)e2.g;
+        long b = (long)e1.b - (long)e2.b;
+        return sqrt((((512+rmean)*r*r)>>8) + 4*g*g + (((767-rmean)*b*b)>>8));
+    }
+    """
+    rmean = (colors[:, 0] + reference[0]) / 2
+    r, g, b = (colors - reference).T
+    return numpy.sqrt(((512 + rmean) * r * r) / 256 + 4 * g * g + ((767 - rmean) * b * b) / 256)
+
 class DominantColorImporter(GstImporter):
     name = _("Dominant color importer")
 
+    # Size of the thumbnail used to compute the frame color
+    thumbnail_size = 8
+    # Color distance above which a new annotation is created
+    threshold = 20
+
     def __init__(self, *p, **kw):
         super(DominantColorImporter, self).__init__(*p, **kw)
 
@@ -43,51 +70,44 @@ class DominantColorImporter(GstImporter):
         self.first_seen_time = 0
         self.last_seen_time = 0
 
+    def buffer_annotation(self):
+        self.buffer.append({
+            'begin': self.first_seen_time,
+            'end': self.last_seen_time,
+            'content': "#%02x%02x%02x" % tuple(int(round(v)) for v in self.last_seen_color),
+        })
+
     def do_finalize(self):
         # Process end, convert buffered data into annotations
+        if self.last_seen_color is not None:
+            self.buffer_annotation()
         self.convert(f for f in self.buffer)
 
-    def process_frame(self, frame):
-        """Frame process method
-            It will be called for each output frame, with a dict containing
-            data: bytes, date: dts, pts: pts
+    def process_frame_batch(self, frames, dates):
+        """Frame batch process method
+
+        frames is a (n, size) array of RGB thumbnails, dates a (n, ) array.
         """
-        # Pick the first pixel (ARGB format)
-        c = frame['data'][1:4]
+        # Mean color of each frame
+        colors = frames.reshape(len(frames), -1, 3).mean(axis=1)
+        start = 0
         if self.last_seen_color is None:
-            self.last_seen_color = c
-            self.first_seen_time = frame['date']
-            return True
-        lc = self.last_seen_color
-        # From https://stackoverflow.com/a/9085524/2870028
-        # who got it from https://www.compuphase.com/cmetric.htm:
-        # typedef struct {
-        #     unsigned char r, g, b;
-        # } RGB;
-        #
-        # double ColourDistance(RGB e1, RGB e2)
-        # {
-        #     long rmean = ( (long)e1.r + (long)e2.r ) / 2;
-        #     long r = (long)e1.r - (long)e2.r;
-        #     long g = (long)e1.g - (long)e2.g;
-        #     long b = (long)e1.b - (long)e2.b;
-        #     return sqrt((((512+rmean)*r*r)>>8) + 4*g*g + (((767-rmean)*b*b)>>8));
-        # }
-        rmean = int((c[0] + lc[0]) / 2)
-        r = c[0] - lc[0]
-        g = c[1] - lc[1]
-        b = c[2] - lc[2]
-        d = sqrt((((512+rmean)*r*r)>>8) + 4*g*g + (((767-rmean)*b*b)>>8))
-        if d > 20:
+            self.last_seen_color = colors[0]
+            self.first_seen_time = dates[0]
+            start = 1
+        while start < len(colors):
+            changes = numpy.flatnonzero(color_distance(colors[start:], self.last_seen_color) > self.threshold)
+            if not changes.size:
+                break
+            i = start + changes[0]
+            if i > 0:
+                self.last_seen_time = dates[i - 1]
             # Color change. Buffer a new annotation
-            self.buffer.append({
-                'begin': self.first_seen_time,
-                'end': self.last_seen_time,
-                'content': "#" + self.last_seen_color.hex(),
-            })
-            self.last_seen_color = c
-            self.first_seen_time = frame['date']
-        self.last_seen_time = frame['date']
+            self.buffer_annotation()
+            self.last_seen_color = colors[i]
+            self.first_seen_time = dates[i]
+            start = i + 1
+        self.last_seen_time = dates[-1]
         return True
 
     def setup_importer(self, filename):
@@ -96,4 +116,4 @@ class DominantColorImporter(GstImporter):
                                   description=_("Dominant color"))
         at.setMetaData(config.data.namespace, "item_color", "here/content/data")
 
-        return "videoconvert ! videoscale ! video/x-raw,width=80 ! frei0r-filter-pixeliz0r block-height=1 block_width=1 ! videoscale ! video/x-raw,format=ARGB,width=1"
+        return "videoconvert ! videoscale ! video/x-raw,format=RGB,width={size},height={size}".format(size=self.thumbnail_size)
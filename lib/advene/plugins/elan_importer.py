@@ -27,11 +27,10 @@ logger = logging.getLogger(__name__)
 from gettext import gettext as _
 
 import re
-import xml.dom
 
 import advene.core.config as config
-import advene.util.handyxml as handyxml
 from advene.util.importer import GenericImporter
+from advene.util.xmlstream import XMLStream, element_text, find_child
 
 def register(controller=None):
     controller.register_importer(ElanImporter)
@@ -49,6 +48,11 @@ class ElanImporter(GenericImporter):
         self.schema=None
         self.relations=[]
         self.forward_references = []
+        # (begin, end) of parsed annotations, indexed by id
+        self.fragments = {}
+        # Referenced annotation id of unresolved REF_ANNOTATIONs
+        self.references = {}
+        self.duration = 0
 
     @staticmethod
     def can_handle(fname):
@@ -61,72 +65,86 @@ class ElanImporter(GenericImporter):
         else:
             return 0
 
-    def xml_to_text(self, element):
-        l=[]
-        if isinstance(element, handyxml.HandyXmlWrapper):
-            element=element.node
-        if element.nodeType is xml.dom.Node.TEXT_NODE:
-            l.append(element.data)
-        elif element.nodeType is xml.dom.Node.ELEMENT_NODE:
-            for e in element.childNodes:
-                l.append(self.xml_to_text(e))
-        return "".join(l)
-
-    def iterator(self, elan):
+    def iterator(self, stream):
         valid_id_re = re.compile('[^a-zA-Z_0-9]')
-        # List of tuples (annotation-id, related-annotation-uri) of
-        # forward referenced annotations
+        # Annotations are converted as soon as they are parsed. Only
+        # time slots and annotation fragments are kept.
         progress=0.1
-        incr=0.02
-        for tier in elan.TIER:
-            if not hasattr(tier, 'ANNOTATION'):
-                # Empty tier
+        tid = None
+        count = 0
+        for event, name, element in stream:
+            if event == 'start':
+                if name == 'ANNOTATION_DOCUMENT':
+                    self.schema.date = element.get('DATE') or self.timestamp
+                elif name == 'HEADER':
+                    if element.get('TIME_UNITS', 'milliseconds') != 'milliseconds':
+                        raise Exception('Cannot process non-millisecond fragments')
+                elif name == 'TIER':
+                    tid = element.get('LINGUISTIC_TYPE_REF', '').replace(' ','_') + '__' + element.get('TIER_ID', '').replace(' ', '_')
+                    tid=valid_id_re.sub('', tid)
+                    progress = 0.1 + 0.7 * stream.progress()
+                    if not self.progress(progress, _("Converting tier %s") % tid):
+                        break
                 continue
-            tid = tier.LINGUISTIC_TYPE_REF.replace(' ','_') + '__' + tier.TIER_ID.replace(' ', '_')
 
-            tid=valid_id_re.sub('', tid)
-
-            if tid not in self.atypes:
-                self.atypes[tid]=self.create_annotation_type(self.schema, tid)
-
-            if not self.progress(progress, _("Converting tier %s") % tid):
-                break
-            progress += incr
-            for an in tier.ANNOTATION:
+            if name == 'TIME_SLOT':
+                try:
+                    d = self.anchors[element.get('TIME_SLOT_ID')] = int(element.get('TIME_VALUE'))
+                    self.duration = max(self.duration, d)
+                except (TypeError, ValueError):
+                    # FIXME: should not silently ignore error
+                    self.anchors[element.get('TIME_SLOT_ID')] = 0
+            elif name == 'ANNOTATION':
+                if tid not in self.atypes:
+                    self.atypes[tid]=self.create_annotation_type(self.schema, tid)
                 d={}
-
                 d['type']=self.atypes[tid]
-                if hasattr(an, 'ALIGNABLE_ANNOTATION'):
+                al = find_child(element, 'ALIGNABLE_ANNOTATION')
+                ref = find_child(element, 'REF_ANNOTATION')
+                if al is not None:
                     # Annotation on a timeline
-                    al=an.ALIGNABLE_ANNOTATION[0]
-                    d['begin']=self.anchors[al.TIME_SLOT_REF1]
-                    d['end']=self.anchors[al.TIME_SLOT_REF2]
-                    d['id']=al.ANNOTATION_ID
-                    d['content']=self.xml_to_text(al.ANNOTATION_VALUE[0].node)
-                    yield d
-                elif hasattr(an, 'REF_ANNOTATION'):
+                    d['begin']=self.anchors[al.get('TIME_SLOT_REF1')]
+                    d['end']=self.anchors[al.get('TIME_SLOT_REF2')]
+                    d['id']=al.get('ANNOTATION_ID')
+                    d['content']=element_text(find_child(al, 'ANNOTATION_VALUE'))
+                    self.fragments[d['id']] = (d['begin'], d['end'])
+                elif ref is not None:
                     # Reference to another annotation. We will reuse the
                     # related annotation's fragment and put it in relation
-                    ref=an.REF_ANNOTATION[0]
-                    d['id']=ref.ANNOTATION_ID
-                    d['content']=self.xml_to_text(ref.ANNOTATION_VALUE[0].node)
+                    d['id']=ref.get('ANNOTATION_ID')
+                    d['content']=element_text(find_child(ref, 'ANNOTATION_VALUE'))
                     # Related annotation:
-                    rel_id = ref.ANNOTATION_REF
-                    rel_uri = '#'.join( (self.package.uri, rel_id) )
-
-                    if rel_uri in self.package.annotations:
-                        rel_an=self.package.annotations[rel_uri]
+                    rel_id = ref.get('ANNOTATION_REF')
+                    if rel_id in self.fragments:
                         # We reuse the related annotation fragment
-                        d['begin'] = rel_an.fragment.begin
-                        d['end'] = rel_an.fragment.end
+                        d['begin'], d['end'] = self.fragments[d['id']] = self.fragments[rel_id]
                     else:
-                        self.forward_references.append( (d['id'], rel_uri) )
+                        self.forward_references.append(d['id'])
+                        self.references[d['id']] = rel_id
                         d['begin'] = 0
                         d['end'] = 0
                     self.relations.append( (rel_id, d['id']) )
-                    yield d
                 else:
                     raise Exception('Unknown annotation type')
+                count += 1
+                if not count % 1000:
+                    if not self.progress(0.1 + 0.7 * stream.progress(), _("Converting tier %s") % tid):
+                        break
+                yield d
+
+    def resolve_fragment(self, an_id):
+        """Return the fragment of a (possibly referencing) annotation.
+        """
+        seen = set()
+        i = an_id
+        while i not in self.fragments:
+            if i in seen or i not in self.references:
+                logger.error("Cannot resolve reference for annotation %s", an_id)
+                return (0, 0)
+            seen.add(i)
+            i = self.references[i]
+        self.fragments[an_id] = self.fragments[i]
+        return self.fragments[i]
 
     def create_relations(self):
         """Postprocess the package to create relations."""
@@ -164,51 +182,29 @@ class ElanImporter(GenericImporter):
             self.update_statistics('relation')
 
     def fix_forward_references(self):
-        for (an_id, rel_uri) in self.forward_references:
+        for an_id in self.forward_references:
             an_uri = '#'.join( (self.package.uri, an_id) )
             an=self.package.annotations[an_uri]
-            rel_an=self.package.annotations[rel_uri]
             # We reuse the related annotation fragment
-            an.fragment.begin = rel_an.fragment.begin
-            an.fragment.end   = rel_an.fragment.end
+            an.fragment.begin, an.fragment.end = self.resolve_fragment(an_id)
 
     def process_file(self, filename):
-        elan=handyxml.xml(filename)
-
         self.init_package(filename)
         self.schema=self.create_schema(id_='elan', title="ELAN converted schema")
-        try:
-            self.schema.date=elan.DATE
-        except AttributeError:
-            self.schema.date = self.timestamp
-
-        # self.anchors init
-        if elan.HEADER[0].TIME_UNITS != 'milliseconds':
-            raise Exception('Cannot process non-millisecond fragments')
+        self.schema.date = self.timestamp
 
         self.progress(0.1, _("Processing time slots"))
-        duration = 0
-        for a in elan.TIME_ORDER[0].TIME_SLOT:
-            try:
-                d = self.anchors[a.TIME_SLOT_ID] = int(a.TIME_VALUE)
-                duration = max(duration, d)
-            except AttributeError:
-                # FIXME: should not silently ignore error
-                self.anchors[a.TIME_SLOT_ID] = 0
+        stream = XMLStream(filename,
+                           start_tags=('ANNOTATION_DOCUMENT', 'HEADER', 'TIER'),
+                           end_tags=('TIME_SLOT', 'ANNOTATION'))
+        self.convert(self.iterator(stream))
 
         # If duration is not yet set in Advene (starting from a
         # template), use max timestamp
         if self.controller.get_cached_duration() == 0:
-            self.controller.package.setMetaData(config.data.namespace, "duration", str(duration))
-            self.controller.notify('DurationUpdate', duration=duration)
-
-        # Process types
-        #for lt in elan.LINGUISTIC_TYPE:
-        #    i=lt.LINGUISTIC_TYPE_ID
-        #    i=i.replace(' ', '_')
-        #    self.create_annotation_type(schema, i)
+            self.controller.package.setMetaData(config.data.namespace, "duration", str(self.duration))
+            self.controller.notify('DurationUpdate', duration=self.duration)
 
-        self.convert(self.iterator(elan))
         self.progress(0.8, _("Fixing forward references"))
         self.fix_forward_references()
         self.progress(0.9, _("Creating relations"))
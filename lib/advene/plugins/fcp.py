@@ -25,7 +25,7 @@ logger = logging.getLogger(__name__)
 from gettext import gettext as _
 
 from advene.util.importer import GenericImporter
-import xml.etree.ElementTree as ET
+from advene.util.xmlstream import XMLStream
 
 def register(controller=None):
     controller.register_importer(XMLFCPImporter)
@@ -45,9 +45,6 @@ class XMLFCPImporter(GenericImporter):
         return 0
 
     def process_file(self, filename, dest=None):
-        tree=ET.parse(filename)
-        root=tree.getroot()
-
         p, at = self.init_package(filename=dest,
                                   schemaid='fcp', annotationtypeid='fcp_subtitle')
         at.mimetype='text/plain'
@@ -60,50 +57,44 @@ class XMLFCPImporter(GenericImporter):
 
         self.package=p
 
-        self.convert(self.iterator(root))
+        stream=XMLStream(filename,
+                         start_tags=('xmeml', ),
+                         end_tags=('generatoritem', 'clipitem'))
+        self.convert(self.iterator(stream))
         self.progress(1.0)
         return self.package
 
-    def iterator(self, root):
-        if root.tag != 'xmeml':
-            logger.error("Invalid FCP XML file format: %s", root.tag)
-            return
-
-        progress=0.01
-        self.progress(progress)
-
-        l=root.findall('.//generatoritem')
-        if l:
-            self.progress(progress, _("Importing subtitles"))
-            incr = 0.5 / len(l)
-            for e in l:
-                progress += incr
-                self.progress(progress)
-                invrate = 1000 / int(e.findtext('rate/timebase'))
+    def iterator(self, stream):
+        root=None
+        clips=0
+
+        self.progress(0.01)
+        for event, name, e in stream:
+            if root is None:
+                root=e
+                if root.tag != 'xmeml':
+                    logger.error("Invalid FCP XML file format: %s", root.tag)
+                    return
+                continue
+            self.progress(stream.progress())
+            invrate = 1000 / int(e.findtext('rate/timebase'))
+            if name == 'generatoritem':
                 yield {
                     'type': self.at['subtitle'],
                     'content': "\n".join([ p.findtext('value') for p in e.findall('.//parameter') if p.findtext('parameterid').startswith('str') and p.findtext('value') ]),
                     'begin': int(e.find('in').text) * invrate,
                     'end': int(e.find('out').text) * invrate,
                     }
-        else:
-            progress = .5
+            else:
+                clips += 1
+                yield {
+                    'type': self.at['clipitem'],
+                    'content': "\n".join([ p.text.strip() for p in e.find('comments') if p.text and p.text.strip() ]),
+                    'begin': int(e.findtext('start')) * invrate,
+                    'end': int(e.findtext('end')) * invrate,
+                    }
 
-        self.progress(progress, _("Importing clips"))
-        l = root.findall('.//clipitem')
-        if not l:
+        if not clips:
             self.progress(1.0, label=_("No clip"))
             return
-        incr = 0.48 / len(l)
-        for e in l:
-            progress += incr
-            self.progress(progress)
-            invrate = 1000 / int(e.findtext('rate/timebase'))
-            yield {
-                'type': self.at['clipitem'],
-                'content': "\n".join([ p.text.strip() for p in e.find('comments') if p.text and p.text.strip() ]),
-                'begin': int(e.findtext('start')) * invrate,
-                'end': int(e.findtext('end')) * invrate,
-                }
-
         self.progress(1.0)
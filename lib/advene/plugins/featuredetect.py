@@ -33,6 +33,7 @@ except ImportError:
 import advene.core.config as config
 from advene.util.importer import GenericImporter
 import advene.util.helper as helper
+from advene.util.featuredetection import FrameReader, serial_detections, parallel_detections
 
 def register(controller=None):
     if cv2:
@@ -52,6 +53,10 @@ class FeatureDetectImporter(GenericImporter):
 
         # Detect that a shape has moved
         self.motion_threshold = 10
+        # Analyse 1 frame every stride frames
+        self.stride = 1
+        # Number of detection processes
+        self.processes = 1
 
         self.optionparser.add_option("-n", "--min-neighbors",
                                      action="store", type="int", dest="neighbors", default=self.neighbors,
@@ -65,6 +70,12 @@ class FeatureDetectImporter(GenericImporter):
         self.optionparser.add_option("-c", "--classifier",
                                      action="store", type="choice", dest="classifier", choices=classifiers, default=self.classifier,
                                      help=_("Classifier"))
+        self.optionparser.add_option("-t", "--stride",
+                                     action="store", type="int", dest="stride", default=self.stride,
+                                     help=_("Frame stride. Only 1 frame every stride frames is analysed."))
+        self.optionparser.add_option("-p", "--processes",
+                                     action="store", type="int", dest="processes", default=self.processes,
+                                     help=_("Number of detection processes."))
 
     @staticmethod
     def can_handle(fname):
@@ -98,15 +109,39 @@ class FeatureDetectImporter(GenericImporter):
             return
 
         framecount = video.get(cv2.CAP_PROP_FRAME_COUNT)
-        pos = 0
         # Take the first frame to get width/height
         ret, frame = video.read()
+        if not ret:
+            return
         width, height, depth = frame.shape
         scaled_width, scaled_height = int(width / self.scale), int(height / self.scale)
         logger.warning("Video dimensions %dx%d - scaled to %dx%d", width, height, scaled_width, scaled_height)
 
-        cascade = cv2.CascadeClassifier(config.data.advenefile( ('haars', self.classifier + '.xml') ))
+        def convert(frame):
+            return cv2.cvtColor(cv2.resize(frame, (scaled_width, scaled_height)), cv2.COLOR_RGB2GRAY)
+
+        # Frames are decoded (and converted) by the reader thread,
+        # while detection occurs in this thread or in worker
+        # processes. In both cases, detections are processed in
+        # frame order.
+        reader = FrameReader(video, convert, stride=self.stride, first_frame=frame)
+        reader.start()
+        classifier_file = config.data.advenefile( ('haars', self.classifier + '.xml') )
+        if self.processes > 1:
+            detections = parallel_detections(reader.frames(), classifier_file, self.neighbors, self.processes)
+        else:
+            detections = serial_detections(reader.frames(), classifier_file, self.neighbors)
+        try:
+            yield from self.segments(detections, framecount, scaled_width, scaled_height)
+        finally:
+            reader.stop()
+            detections.close()
+
+    def segments(self, detections, framecount, scaled_width, scaled_height):
+        """Generate annotation data from (index, position, objects) detections.
+        """
         count = 0
+        pos = 0
 
         svg_template = """<svg xmlns='http://www.w3.org/2000/svg' version='1' viewBox="0 0 %(scaled_width)d %(scaled_height)d" x='0' y='0' width='%(scaled_width)d' height='%(scaled_height)d'>%%s</svg>""" % locals()
         def objects2svg(objs, threshold=-1):
@@ -117,11 +152,7 @@ class FeatureDetectImporter(GenericImporter):
 
         start_pos = None
 
-        while ret:
-
-            gray = cv2.cvtColor(cv2.resize(frame, (scaled_width, scaled_height)), cv2.COLOR_RGB2GRAY)
-
-            objects = cascade.detectMultiScale(gray, 1.2, self.neighbors) # scale_factor=1.2, min_neighbors=2
+        for index, pos, objects in detections:
 
             def distance(v1, v2):
                 d = max( abs(a - b)
@@ -161,14 +192,11 @@ class FeatureDetectImporter(GenericImporter):
                     }
                 start_pos = None
 
-            if not self.progress(video.get(cv2.CAP_PROP_POS_FRAMES) / framecount,
+            if not self.progress((index + 1) / framecount if framecount else 0,
                                  _("Detected %(count)d feature(s) until %(time)s") % { 'count': count,
                                                                                        'time': helper.format_time(pos) }):
                 break
 
-            pos = video.get(cv2.CAP_PROP_POS_MSEC)
-            ret, frame = video.read()
-
         # Last frame
         if start_pos is not None:
             yield {
@@ -20,29 +20,31 @@
 
 name="Shot detection importer"
 
+import logging
+logger = logging.getLogger(__name__)
+
 from gettext import gettext as _
 
+from collections import deque
 import os
-import sys
+import threading
 
 try:
-    # Needed for pimpy component
     import numpy
-    import opencv.cv as cv
-    import opencv.highgui as hg
 except ImportError:
-    numpy = cv = hg = None
+    numpy = None
+
+from gi.repository import GObject
 
 import advene.core.config as config
-import advene.util.helper as helper
-from advene.util.importer import GenericImporter
+from advene.util.gstimporter import GstImporter
 
 def register(controller=None):
-    if numpy and cv and hg:
+    if numpy:
         controller.register_importer(DelakisShotDetectImporter)
     return True
 
-class DelakisShotDetectImporter(GenericImporter):
+class DelakisShotDetectImporter(GstImporter):
     name = _("Shot detection (Delakis version)")
 
     profiles = {
@@ -51,6 +53,9 @@ class DelakisShotDetectImporter(GenericImporter):
         'aggressive': { 'ALPHA': 1.7, 'BETA': 0.05 },
         }
 
+    # Width of the grayscale frames used for histogram computation
+    frame_width = 320
+
     def __init__(self, *p, **kw):
         super(DelakisShotDetectImporter, self).__init__(*p, **kw)
 
@@ -62,43 +67,88 @@ class DelakisShotDetectImporter(GenericImporter):
         self.optionparser.add_option("-p", "--profile",
                                      action="store", type="choice", dest="profile", choices=list(self.profiles.keys()), default=self.profile,
                                      help=_("Parameter profile: safe will detect less cuts, aggressive will detect more cuts (but more false ones too). default is a compromise."))
-
-    @staticmethod
-    def can_handle(fname):
-        """Return a score between 0 and 100.
-
-        100 is for the best match (specific extension), 0 is for no match at all.
-        """
-        if helper.is_video_file(fname):
-            return 80
-        return 0
-
-    def process_file(self, filename):
-        at = self.ensure_new_type('shot',
-                                  title=_("Shot (%s profile)") % self.profile,
-                                  description = _("Detected shots"))
-
-        #Compute or load histogram
-        histofile = filename + '-histogram.npy'
-        if os.path.exists(histofile):
-            self.progress(0, _("Loading histogram"))
-            histos = numpy.load(histofile)
-            # FIXME: how to cache FPS ?
-            fps = float(config.data.preferences['default-fps'])
-        else :
-            he = HistogramExtractor()
-            histos, fps = he.process(filename, self.progress)
-            if self.cache_histogram:
-                try:
-                    numpy.save(histofile, histos)
-                except Exception as e:
-                    self.controller.log("Cannot save histogram: %s" % e.message)
-
-        sd = ShotDetector()
+        self.detector = None
+        self.histofile = None
+        self.histowriter = None
+        # Shots detected in the frame thread, waiting for conversion
+        self.pending_shots = []
+        self.pending_lock = threading.Lock()
+
+    def get_detector(self, mspf=None):
+        sd = ShotDetector(mspf=mspf)
         for k, v in self.profiles[self.profile].items():
             setattr(sd, k, v)
-        #Detect cut and dissolve
-        self.convert(sd.process(histos, int(1000 / fps)))
+        return sd
+
+    def setup_importer(self, filename):
+        self.ensure_new_type('shot',
+                             title=_("Shot (%s profile)") % self.profile,
+                             description = _("Detected shots"))
+        self.detector = self.get_detector()
+        if self.cache_histogram:
+            self.histowriter = HistogramWriter(self.histofile)
+        return "videoconvert ! videoscale ! video/x-raw,format=GRAY8,width=%d" % self.frame_width
+
+    def convert_idle(self, data):
+        """Convert detected shots from the main thread.
+        """
+        if not data:
+            return
+        with self.pending_lock:
+            self.pending_shots.extend(data)
+        if threading.current_thread() is threading.main_thread():
+            self.convert_pending()
+        else:
+            GObject.idle_add(self.convert_pending)
+
+    def convert_pending(self):
+        """Convert the pending shots, in detection order.
+
+        It must be called from the main thread.
+        """
+        with self.pending_lock:
+            data, self.pending_shots = self.pending_shots, []
+        if data:
+            self.convert(data)
+        return False
+
+    def process_frame_batch(self, frames, dates):
+        histos = compute_histograms(frames)
+        if self.histowriter is not None:
+            self.histowriter.write(histos)
+        # Shots are converted as soon as they are detected
+        self.convert_idle([ dict(d, notify=True)
+                            for h, date in zip(histos, dates)
+                            for d in self.detector.feed(h, date) ])
+        return True
+
+    def do_finalize(self):
+        if self.histowriter is not None:
+            try:
+                self.histowriter.close()
+            except OSError as e:
+                self.log("Cannot save histogram: %s" % str(e))
+            self.histowriter = None
+        # The frame thread is over: convert the shots that are still
+        # pending before the last one.
+        self.convert_pending()
+        self.convert(self.detector.flush())
+
+    def async_process_file(self, filename, end_callback):
+        self.histofile = filename + '-histogram.npy'
+        if not os.path.exists(self.histofile):
+            return super(DelakisShotDetectImporter, self).async_process_file(filename, end_callback)
+
+        # Use cached histograms
+        self.ensure_new_type('shot',
+                             title=_("Shot (%s profile)") % self.profile,
+                             description = _("Detected shots"))
+        self.progress(0, _("Loading histogram"))
+        histos = numpy.load(self.histofile, mmap_mode='r')
+        # FIXME: how to cache FPS ?
+        fps = float(config.data.preferences['default-fps'])
+        self.convert(self.get_detector(mspf=int(1000 / fps)).process(histos))
+        end_callback()
         return self.package
 
 # Code adapted from pimpy: http://pim.gforge.inria.fr/pimpy/
@@ -111,6 +161,49 @@ T=70
 
 MEAN_WINDOW = 3
 
+def compute_histograms(frames):
+    """Compute the grayscale histograms for a (n, size) uint8 frame array.
+
+    Return a (n, NB_BINS) int32 array.
+    """
+    n = len(frames)
+    # Offset each frame values so that a single bincount call
+    # computes all histograms.
+    offsets = (numpy.arange(n, dtype=numpy.int64) * 256)[:, None]
+    histos = numpy.bincount((frames + offsets).ravel(), minlength=256 * n)
+    return histos.reshape(n, 256)[:, :NB_BINS].astype(numpy.int32)
+
+class HistogramWriter:
+    """Incrementally write histograms to a .npy file.
+
+    The histograms are appended to a raw temporary file, which is
+    converted to a memory-mapped .npy file on close.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.rawname = filename + '.raw'
+        self.count = 0
+        self.fd = open(self.rawname, 'wb')
+
+    def write(self, histos):
+        self.fd.write(numpy.ascontiguousarray(histos, dtype=numpy.int32).tobytes())
+        self.count += len(histos)
+
+    def close(self):
+        self.fd.close()
+        try:
+            if self.count:
+                raw = numpy.memmap(self.rawname, dtype=numpy.int32, mode='r',
+                                   shape=(self.count, NB_BINS))
+                out = numpy.lib.format.open_memmap(self.filename, mode='w+',
+                                                   dtype=numpy.int32, shape=raw.shape)
+                out[:] = raw
+                out.flush()
+                del out
+                del raw
+        finally:
+            os.unlink(self.rawname)
+
 class ShotDetector:
     """
     ShotDetector inspired by :
@@ -122,11 +215,20 @@ class ShotDetector:
     year = {2006},
     url = {ftp://ftp.irisa.fr/techreports/theses/2006/delakis.pdf }
     }
+
+    Histograms are fed one at a time through the feed method, which
+    returns the shots and dissolves that can be decided from the
+    histograms seen so far. Only a sliding window of histograms is
+    kept, so that memory use does not depend on the media duration.
     """
-    def __init__(self, progress=None):
+    def __init__(self, progress=None, mspf=None):
         if progress is None:
             progress = self.dummy_progress
         self.progress = progress
+        # If mspf (ms per frame) is specified, it is used to convert
+        # frame numbers into times. Else, the dates passed to feed
+        # are used.
+        self.mspf = mspf
         self.ALPHA = 1.8
         self.BETA = 0.10
         self.MOTION_THRESHOLD = 0.15
@@ -137,120 +239,150 @@ class ShotDetector:
         self.DISS_END_THRESHOLD = 0.26
         self.DISS_MIN_FRAMES = 3
 
+        # Weights used to compute the pixelwise difference
+        self.pixelwise_weights = numpy.array([ (i - T - 1) if i >= T else 0
+                                               for i in range(NB_BINS) ])
+        self.reset()
 
     def dummy_progress(self, prg, label):
         pass
 
-    def process(self, histos, mspf=40):
-        self.progress(.1, _("Computing hdiff"))
-        nbpixel = numpy.sum(histos[0])
-        #compute various histogram variations
-        hdiff = (numpy.abs(histos[:-1] - histos[1:])) / 2
-        hdiffsumchannel = numpy.sum(hdiff, axis=1)
-        histo_dist = hdiffsumchannel / nbpixel / NB_CHANNELS
-
-        self.progress(.2, _("Detecting cuts"))
-        #detect hard cut
-        cuts = numpy.flatnonzero( histo_dist >= self.HIGH_CUT_THRESHOLD )
-
-        #detect low cut
-        for f in numpy.flatnonzero(
-                (histo_dist < self.HIGH_CUT_THRESHOLD) &
-                (histo_dist >= self.SHOT_THRESHOLD)
-        ):
-            if self.__cut_detection(f, histo_dist):
-                cuts = numpy.append(cuts, f)
-
-        cuts.sort()
-        n = 1
-        yield {
-            'begin': 0,
-            'end': cuts[0] * mspf,
-            'content': str(n),
-            }
-        for b, e in zip(cuts[:-1], cuts[1:]):
-            n += 1
-            yield {
-                'begin': b * mspf,
-                'end': e * mspf,
-                'content': str(n)
-                }
-
-        self.progress(.3, _("Detecting dissolves"))
-        #detect dissolve
-        hcumul = self.__histo_cumul(histos)
-        hcumul = self.__filter_by_cut(cuts, hcumul)
-        hpixelwise = self.__histo_pixelwise(hdiff)
-        hpixelwise = hpixelwise / nbpixel / 100
-
-        for diss in self.__detect_dissolve(hcumul, hpixelwise):
-            yield {
-                'begin': diss[0] * mspf,
-                'end': diss[1] * mspf,
-                'content': 'grad',
-                }
-
-    def __detect_dissolve(self, hcumul, hpixelwise):
-        motion_frames = hpixelwise > self.MOTION_THRESHOLD
-        start = end = -1
-        for f in numpy.flatnonzero(hcumul > self.DISS_THRESHOLD):
-            #new frame not in current dissolve, record dissolve
-            if start > 0 and f > end:
-                motion = numpy.sum(motion_frames[list(range(start,end))])
-                if not motion and end - start > self.DISS_MIN_FRAMES:
-                    yield (start,end)
-                start = end = -1
-
-            if start < 0 :
-                start = end = f
-                #find lower bound
-                while start > 0 and hcumul[start] > self.DISS_START_THRESHOLD:
-                    start -= 1
-                #find upper bound
-                while end+1 < len(hcumul) and hcumul[end+1] > self.DISS_END_THRESHOLD :
-                    end += 1
-
-        #add the last dissolve
-        if start > 0 and end > 0 :
-            motion = numpy.sum(motion_frames[list(range(start,end))])
-            if not motion and end - start > self.DISS_MIN_FRAMES:
-                yield (start,end)
-
-    def __histo_pixelwise(self,hdiff):
-        r = []
-        for h in hdiff:
-            s = 0
-            for i in range(T, NB_BINS):
-                s += (h[i] * (i-T-1))
-            r.append(s)
-        return numpy.array(r)
-
-    def __histo_cumul(self, histos):
-        nbpix = numpy.sum(histos[0])
-        r = []
-        for i in range(1, len(histos)):
-            h = (histos[i] + histos[i-1]) / 2
+    def reset(self):
+        # Number of histograms fed so far
+        self.count = 0
+        self.nbpixel = None
+        # Window of the last K histograms
+        self.histos = deque(maxlen=K)
+        # Window of the last histogram distances (index of the first
+        # element is self.count - 1 - len(self.dists))
+        self.dists = deque(maxlen=2 * MEAN_WINDOW + 2)
+        # Frame dates, by frame number, for the window
+        self.dates = {}
+        # Raw (not yet filtered by cuts) cumulated histogram
+        # differences and motion prefix counts, by frame number
+        self.hcumul = {}
+        self.motion_prefix = { 0: 0 }
+        self.motion_count = 0
+        # Recent cuts (used to filter the cumulated differences)
+        self.recent_cuts = deque()
+        self.last_cut = 0
+        self.shot_number = 0
+        # Dissolve detection state
+        self.last_low = None
+        self.last_low_prefix = 0
+        self.dissolve = None
+        self.hcumul_count = 0
+
+    def frame_time(self, f):
+        if self.mspf is not None:
+            return f * self.mspf
+        return self.dates.get(f, 0)
+
+    def feed(self, histo, date=None):
+        """Feed a new histogram.
+
+        Return a list of detected shots and dissolves (as dicts).
+        """
+        res = []
+        i = self.count
+        self.count += 1
+        self.dates[i] = date if date is not None else i * (self.mspf or 40)
+        if self.nbpixel is None:
+            self.nbpixel = numpy.sum(histo)
+        if self.histos:
+            prev = self.histos[-1]
+            hdiff = numpy.abs(histo - prev) / 2
+            self.dists.append(numpy.sum(hdiff) / self.nbpixel / NB_CHANNELS)
+            # Pixelwise difference for frame i - 1
+            if numpy.dot(hdiff, self.pixelwise_weights) / self.nbpixel / 100 > self.MOTION_THRESHOLD:
+                self.motion_count += 1
+            self.motion_prefix[i] = self.motion_count
+            # Cumulated difference for frame i - 1
+            h = (histo + prev) / 2
             c = 0
             for k in range(1, K):
-                if i - k < 0 :
-                    break
-                c += numpy.sum(numpy.abs(h - histos[i - k])) / nbpix
-            r.append(c / K)
-        return numpy.array(r)
-
-    def __filter_by_cut(self, cuts, histo_cumul):
-        for c in cuts:
-            for i in range(K):
-                try :
-                    histo_cumul[c + i] = histo_cumul[c + i]/(K - i)
-                except IndexError:
+                if i - k < 0:
                     break
-        return histo_cumul
-
-    def __cut_detection(self, f, histo_dist):
-        d = histo_dist[f]
-        left_diff  = histo_dist[f - 1 - MEAN_WINDOW : f - 1] + self.BETA
-        right_diff = histo_dist[f + 1 : f + 1 + MEAN_WINDOW] + self.BETA
+                c += numpy.sum(numpy.abs(h - self.histos[-k])) / self.nbpixel
+            self.hcumul[i - 1] = c / K
+        self.histos.append(histo)
+
+        # Decide frames for which the whole right context is available
+        f = i - 1 - MEAN_WINDOW
+        if f >= 0:
+            res.extend(self.decide(f))
+        return res
+
+    def flush(self):
+        """Decide the remaining frames, and return the last shots/dissolves.
+        """
+        res = []
+        for f in range(max(0, self.count - 1 - MEAN_WINDOW), self.count - 1):
+            res.extend(self.decide(f))
+        if self.dissolve is not None:
+            res.extend(self.close_dissolve())
+        if self.count:
+            self.shot_number += 1
+            res.append({
+                'begin': self.frame_time(self.last_cut),
+                'end': self.frame_time(self.count - 1),
+                'content': str(self.shot_number),
+            })
+        self.reset()
+        return res
+
+    def process(self, histos):
+        """Process a whole histogram array.
+        """
+        total = len(histos)
+        for n, h in enumerate(histos):
+            if n % 1000 == 0:
+                self.progress(n / total, _("Detecting shots"))
+            yield from self.feed(numpy.asarray(h, dtype=numpy.int32))
+        yield from self.flush()
+
+    def decide(self, f):
+        """Decide if frame f is a cut, and update dissolve detection.
+        """
+        res = []
+        if self.__is_cut(f):
+            self.recent_cuts.append(f)
+            if f > 0:
+                self.shot_number += 1
+                res.append({
+                    'begin': self.frame_time(self.last_cut),
+                    'end': self.frame_time(f),
+                    'content': str(self.shot_number),
+                })
+                self.last_cut = f
+        # Cuts older than K frames cannot influence the cumulated differences anymore
+        while self.recent_cuts and self.recent_cuts[0] <= f - K:
+            self.recent_cuts.popleft()
+        # The cumulated difference for frame f can now be filtered by cuts
+        v = self.hcumul.pop(f)
+        for c in self.recent_cuts:
+            v = v / (K - (f - c))
+        res.extend(self.__detect_dissolve(f, v))
+        # Cleanup data that is not needed anymore
+        for n in [ n for n in self.dates if n < f - K and n not in (self.last_cut, self.last_low) ]:
+            del self.dates[n]
+        for n in [ n for n in self.motion_prefix if n < f ]:
+            del self.motion_prefix[n]
+        return res
+
+    def __is_cut(self, f):
+        # Index of f in self.dists
+        offset = self.count - 1 - len(self.dists)
+        dists = list(self.dists)
+        d = dists[f - offset]
+        if d >= self.HIGH_CUT_THRESHOLD:
+            return True
+        if d < self.SHOT_THRESHOLD:
+            return False
+        left_diff  = numpy.array(dists[max(0, f - 1 - MEAN_WINDOW - offset) : max(0, f - 1 - offset)]) + self.BETA
+        right_diff = numpy.array(dists[f + 1 - offset : f + 1 + MEAN_WINDOW - offset]) + self.BETA
+        if not left_diff.size or not right_diff.size:
+            return False
 
         mean_left  = numpy.mean(left_diff)
         mean_rigth = numpy.mean(right_diff)
@@ -259,29 +391,36 @@ class ShotDetector:
         adapt_threshold =  self.ALPHA * mean_local  - self.BETA
         return d >= adapt_threshold
 
-class HistogramExtractor:
-    def process(self, videofile, progress):
-        progress(0, _("Extracting histogram"))
-        video = hg.cvCreateFileCapture(str(videofile).encode(sys.getfilesystemencoding()))
-        if not video:
-            raise Exception("Could not open video file")
-        histo = cv.cvCreateHist([256],cv.CV_HIST_ARRAY,[[0,256]], 1)
-        frame = hg.cvQueryFrame(video)
-        frame_gray  = cv.cvCreateImage(cv.cvGetSize(frame), frame.depth, 1)
-        hists    = []
-        nbframes = 0
-
-        fps = hg.cvGetCaptureProperty(video, hg.CV_CAP_PROP_FPS)
-        while frame :
-            if not progress(hg.cvGetCaptureProperty(video, hg.CV_CAP_PROP_POS_AVI_RATIO)):
-                break
-            hg.cvConvertImage(frame,frame_gray)
-            cv.cvCalcHist(frame_gray,histo,0,None)
-            h = [cv.cvGetReal1D(histo.bins,i) for i in range(255) ]
-            h = numpy.array(h,dtype='int32')
-            hists.append(h)
-            frame = hg.cvQueryFrame(video)
-            nbframes += 1
-
-        hists = numpy.array(hists)
-        return hists.reshape(nbframes, -1), fps
+    def __detect_dissolve(self, f, v):
+        """Update the dissolve state with the cumulated difference v for frame f.
+        """
+        if self.dissolve is not None:
+            start, end = self.dissolve
+            if end + 1 == f and v > self.DISS_END_THRESHOLD:
+                # Extend the current dissolve
+                self.dissolve = (start, f)
+            else:
+                yield from self.close_dissolve()
+        if self.dissolve is None and v > self.DISS_THRESHOLD:
+            # Start a new dissolve, its lower bound is the last frame
+            # below DISS_START_THRESHOLD
+            if self.last_low is None:
+                self.dissolve = (0, f)
+            else:
+                self.dissolve = (self.last_low, f)
+        if v <= self.DISS_START_THRESHOLD:
+            self.last_low = f
+            self.last_low_prefix = self.motion_prefix.get(f, self.motion_count)
+        self.hcumul_count = f + 1
+
+    def close_dissolve(self):
+        start, end = self.dissolve
+        self.dissolve = None
+        if start > 0 and end - start > self.DISS_MIN_FRAMES:
+            motion = self.motion_prefix.get(end, self.motion_count) - self.last_low_prefix
+            if not motion:
+                yield {
+                    'begin': self.frame_time(start),
+                    'end': self.frame_time(end),
+                    'content': 'grad',
+                }
@@ -26,8 +26,10 @@ from gettext import gettext as _
 
 import base64
 from collections import OrderedDict
+import concurrent.futures
 from io import BytesIO
 import json
+import time
 from PIL import Image
 import requests
 
@@ -75,6 +77,9 @@ class HPIImporter(GenericImporter):
         self.split_types = False
         self.create_relations = False
         self.url = self.get_preferences().get('url', 'http://localhost:9000/')
+        self.batch_size = 32
+        self.workers = 4
+        self.retries = 2
 
         self.server_options = {}
         # Populate available models options from server
@@ -137,6 +142,21 @@ class HPIImporter(GenericImporter):
             dest="create_relations", default=self.create_relations,
             help=_("Create relations between the original annotations and the new ones"),
             )
+        self.optionparser.add_option(
+            "-b", "--batch-size", action="store", type="int",
+            dest="batch_size", default=self.batch_size,
+            help=_("Number of annotations sent in each request"),
+            )
+        self.optionparser.add_option(
+            "-w", "--workers", action="store", type="int",
+            dest="workers", default=self.workers,
+            help=_("Number of concurrent requests"),
+            )
+        self.optionparser.add_option(
+            "--retries", action="store", type="int",
+            dest="retries", default=self.retries,
+            help=_("Number of retries for failed requests"),
+            )
 
     def process_file(self, _filename):
         self.convert(self.iterator())
@@ -207,10 +227,9 @@ class HPIImporter(GenericImporter):
         if image_scale:
             logger.warning("Scaling images to (%d, %d) as requested by %s", image_scale, image_scale, self.model)
 
-        def get_scaled_image(t):
+        def get_scaled_image(original):
             """Return the image at the appropriate scale for the selected model.
             """
-            original = bytes(self.controller.package.imagecache.get(t))
             if image_scale:
                 im = Image.open(BytesIO(original))
                 im = im.resize((image_scale, image_scale))
@@ -222,50 +241,148 @@ class HPIImporter(GenericImporter):
                 scaled = original
             return scaled
 
-        # Use a requests.session to use a KeepAlive connection to the server
+        # Respect the batch size limits advertised by the server
+        batch_size = max(1, self.batch_size)
+        if self.server_options.get('maximum_batch_size'):
+            batch_size = min(batch_size, self.server_options['maximum_batch_size'])
+        if self.server_options.get('minimum_batch_size'):
+            batch_size = max(batch_size, self.server_options['minimum_batch_size'])
+        workers = max(1, self.workers)
+
+        # Use a requests.session to use KeepAlive connections to the server
         session = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
-        response = session.post(self.url, headers=headers, json={
-            "model": self.model,
-            'media_uri': self.package.uri,
-            'media_filename': self.controller.get_default_media(),
-            'minimum_confidence': minconf,
-            'annotations': [
-                { 'annotationid': a.id,
-                  'begin': a.fragment.begin,
-                  'end': a.fragment.end,
-                  'frames': [
-                      {
-                          'screenshot': base64.encodebytes(get_scaled_image(t)).decode('ascii'),
-                          'timecode': t
-                      } for t in (a.fragment.begin,
-                                  int((a.fragment.begin + a.fragment.end) / 2),
-                                  a.fragment.end)
-                  ]
-                }
-                for a in self.source_type.annotations
-            ]
-        })
+        image_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
 
-        output = response.json()
-        if output.get('status') != 200:
-            # Not OK result. Display error message.
-            msg = _("Server error: %s") % output.get('message', _("Server transmission error."))
-            logger.error(msg)
-            self.output_message = msg
-            return
-        # FIXME: maybe check consistency with media_filename/media_uri?
-        concepts = output.get('data', {}).get('concepts', [])
+        def process_batch(batch):
+            """Send a batch of annotations to the server.
+
+            batch is a list of (annotation_id, begin, end, [ (timecode, png_data), ...]) tuples.
+            Return the list of concepts.
+            """
+            # Scale all batch images in parallel
+            images = [ image_pool.map(get_scaled_image, (data for t, data in frames))
+                       for aid, begin, end, frames in batch ]
+            payload = {
+                "model": self.model,
+                'media_uri': media_uri,
+                'media_filename': media_filename,
+                'minimum_confidence': minconf,
+                'annotations': [
+                    { 'annotationid': aid,
+                      'begin': begin,
+                      'end': end,
+                      'frames': [
+                          {
+                              'screenshot': base64.encodebytes(im).decode('ascii'),
+                              'timecode': t
+                          } for (t, data), im in zip(frames, scaled)
+                      ]
+                    }
+                    for (aid, begin, end, frames), scaled in zip(batch, images)
+                ]
+            }
+            for attempt in range(self.retries + 1):
+                try:
+                    output = session.post(self.url, headers=headers, json=payload).json()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    output = { 'message': str(e) }
+                if output.get('status') == 200:
+                    # FIXME: maybe check consistency with media_filename/media_uri?
+                    return output.get('data', {}).get('concepts', [])
+                logger.warning("Batch request failed (attempt %d): %s", attempt + 1, output.get('message'))
+                if attempt < self.retries:
+                    time.sleep(attempt + 1)
+            raise Exception(output.get('message', _("Server transmission error.")))
+
+        # Fetch original images and annotation information from the
+        # main thread, then send batches concurrently. Batches are
+        # built on demand, so that at most 2 * workers of them are
+        # in memory.
+        media_uri = self.package.uri
+        media_filename = self.controller.get_default_media()
+        source_annotations = {}
+        def batches():
+            batch = []
+            for a in self.source_type.annotations:
+                source_annotations[a.id] = a
+                begin, end = a.fragment.begin, a.fragment.end
+                batch.append((a.id, begin, end, [ (t, bytes(self.controller.package.imagecache.get(t)))
+                                               for t in (begin, int((begin + end) / 2), end) ]))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        total = -(-len(self.source_type.annotations) // batch_size)
+        pending_batches = batches()
+
+        request_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        futures = set()
+        def submit_next():
+            b = next(pending_batches, None)
+            if b is not None:
+                futures.add(request_pool.submit(process_batch, b))
+
+        self.progress(.2, _("Sending %(count)d requests to server") % { 'count': total })
         progress = .2
-        step = .8 / (len(concepts) or 1)
-        self.progress(.2, _("Parsing %d results") % len(concepts))
-        logger.warning(_("Parsing %(count)d results (level %(confidence)f)") % { "count": len(concepts),
-                                                                                 "confidence": self.confidence })
+        step = .8 / (total or 1)
+        done = 0
+        errors = []
+        try:
+            for i in range(2 * workers):
+                submit_next()
+            while futures:
+                finished, running = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                cancelled = False
+                for future in finished:
+                    futures.remove(future)
+                    submit_next()
+                    try:
+                        concepts = future.result()
+                    except Exception as e:
+                        # Not OK result. Store the error message.
+                        msg = _("Server error: %s") % str(e)
+                        logger.error(msg)
+                        errors.append(msg)
+                        continue
+                    logger.info(_("Parsing %(count)d results (level %(confidence)f)") % { "count": len(concepts),
+                                                                                          "confidence": self.confidence })
+                    yield from self.convert_concepts(concepts, source_annotations, minconf,
+                                                     new_atype=None if self.split_types else new_atype,
+                                                     new_atypes=new_atypes if self.split_types else None,
+                                                     rtype=rtype if self.create_relations else None)
+                    progress += step
+                    done += 1
+                    if self.progress(progress, _("Processed %(count)d / %(total)d batches") % {
+                            'count': done,
+                            'total': total }) is False:
+                        cancelled = True
+                        break
+                if cancelled:
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
+            request_pool.shutdown(wait=False)
+            image_pool.shutdown(wait=False)
+        if errors:
+            self.output_message = "\n".join(errors)
+
+    def convert_concepts(self, concepts, source_annotations, minconf, new_atype=None, new_atypes=None, rtype=None):
+        """Convert the concepts returned by the server into annotation data.
+
+        If new_atypes is not None, types are split by entity type.
+        If rtype is not None, relations are created.
+        """
         for item in concepts:
             # Should not happen, since we pass the parameter to the server
             if item["confidence"] < minconf:
                 continue
-            a = self.package.get_element_by_id(item['annotationid'])
+            a = source_annotations[item['annotationid']]
             if self.detected_position:
                 begin = item['timecode']
             else:
@@ -273,7 +390,7 @@ class HPIImporter(GenericImporter):
             end = a.fragment.end
             label = item.get('label')
             label_id = helper.title2id(label)
-            if label and self.split_types:
+            if label and new_atypes is not None:
                 new_atype = new_atypes.get(label_id)
                 if new_atype is None:
                     # Not defined yet. Create a new one.
@@ -289,7 +406,7 @@ class HPIImporter(GenericImporter):
                 'end': end,
                 'content': json.dumps(item),
             }
-            if an is not None and self.create_relations:
+            if an is not None and rtype is not None:
                 r = self.package.createRelation(
                     ident='_'.join( ('r', a.id, an.id) ),
                     type=rtype,
@@ -299,5 +416,3 @@ class HPIImporter(GenericImporter):
                 r.title = "Relation between %s and %s" % (a.id, an.id)
                 self.package.relations.append(r)
                 self.update_statistics('relation')
-            self.progress(progress)
-            progress += step
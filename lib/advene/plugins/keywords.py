@@ -29,10 +29,18 @@ try:
 except ImportError:
     nltk = None
 
+import collections
+import concurrent.futures
+import json
 import operator
-import string
 
+import advene.core.config as config
+from advene.util.batch import ordered_chunk_map
 from advene.util.importer import GenericImporter
+import advene.util.rake as rake
+
+# Number of annotation texts sent to a worker process at once
+CHUNK_SIZE = 256
 
 def register(controller=None):
     if nltk is None:
@@ -66,6 +74,10 @@ class KeywordImporter(GenericImporter):
             self.get_preferences().update({'source_type_id': self.source_type_id})
 
         self.confidence = 0.0
+        # Number of extraction processes
+        self.processes = 1
+        # Store keyword document frequencies in the type value_metadata
+        self.document_frequency = False
 
         self.optionparser.add_option(
             "-t", "--source-type-id", action="store", type="choice", dest="source_type_id",
@@ -78,99 +90,65 @@ class KeywordImporter(GenericImporter):
             dest="confidence", default=0.0,
             help=_("Minimum confidence level (between 0.0 and 1.0)"),
             )
+        self.optionparser.add_option(
+            "-p", "--processes", action="store", type="int",
+            dest="processes", default=self.processes,
+            help=_("Number of extraction processes"),
+            )
+        self.optionparser.add_option(
+            "-d", "--document-frequency", action="store_true",
+            dest="document_frequency", default=self.document_frequency,
+            help=_("Store the number of annotations containing each keyword"),
+            )
 
     def process_file(self, _filename):
         self.convert(self.iterator())
 
+    def keywords(self, annotations):
+        """Generate (annotation, keywords) tuples.
+
+        Keywords are extracted in this process, or in a pool of
+        worker processes. In both cases, the stopword model is loaded
+        once per process, and results are generated in the
+        annotations order.
+        """
+        items = ( (a, a.content.data) for a in annotations )
+        if self.processes > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+                for (a, text), keywords in ordered_chunk_map(executor, rake.extract_chunk, items,
+                                                             key=operator.itemgetter(1),
+                                                             chunk_size=CHUNK_SIZE,
+                                                             max_pending=2 * self.processes):
+                    yield a, keywords
+        else:
+            extractor = rake.get_extractor()
+            for a, text in items:
+                yield a, list(extractor.extract(text))
+
     def iterator(self):
         """I iterate over the created annotations.
         """
-        rake = RakeKeywordExtractor()
         logger.warning("Detection keywords")
         self.source_type = self.controller.package.get_element_by_id(self.source_type_id)
 
         new_atype = self.ensure_new_type("%s_keywords" % self.source_type.id,
                                          mimetype = "text/x-advene-keyword-list")
-        self.progress(.1, "Sending request to server")
-        for a in self.source_type.annotations:
-            keywords = rake.extract(a.content.data)
+        self.progress(.1, _("Extracting keywords"))
+        annotations = self.source_type.annotations
+        frequencies = collections.Counter()
+        for i, (a, keywords) in enumerate(self.keywords(annotations)):
+            if not self.progress(.1 + .9 * i / len(annotations)):
+                break
             if keywords:
+                if self.document_frequency:
+                    frequencies.update(set(keywords))
                 an = yield {
                     'type': new_atype,
                     'begin': a.fragment.begin,
                     'end': a.fragment.end,
                     'content': ",".join(keywords)
                 }
-
-# Downloaded from http://sujitpal.blogspot.fr/2013/03/implementing-rake-algorithm-with-nltk.html
-# Adapted from: github.com/aneesha/RAKE/rake.py
-
-def isPunct(word):
-    return len(word) == 1 and word in string.punctuation
-
-def isNumeric(word):
-    try:
-        float(word) if '.' in word else int(word)
-        return True
-    except ValueError:
-        return False
-
-class RakeKeywordExtractor:
-    def __init__(self):
-        self.stopwords = set(nltk.corpus.stopwords.words())
-        self.top_fraction = 1 # consider top third candidate keywords by score
-
-    def _generate_candidate_keywords(self, sentences):
-        phrase_list = []
-        for sentence in sentences:
-            words = map(lambda x: "|" if x in self.stopwords else x,
-                        nltk.word_tokenize(sentence.lower()))
-            phrase = []
-            for word in words:
-                if word == "|" or isPunct(word):
-                    if len(phrase) > 0:
-                        phrase_list.append(phrase)
-                        phrase = []
-                    else:
-                        phrase.append(word)
-        return phrase_list
-
-    def _calculate_word_scores(self, phrase_list):
-        word_freq = nltk.FreqDist()
-        word_degree = nltk.FreqDist()
-        for phrase in phrase_list:
-            degree = len(list(filter(lambda x: not isNumeric(x), phrase))) - 1
-        for word in phrase:
-            word_freq.update([word])
-            word_degree.update([word, degree]) # other words
-        for word in word_freq.keys():
-            word_degree[word] = word_degree[word] + word_freq[word] # itself
-            # word score = deg(w) / freq(w)
-        word_scores = {}
-        for word in word_freq.keys():
-            word_scores[word] = word_degree[word] / word_freq[word]
-        return word_scores
-
-    def _calculate_phrase_scores(self, phrase_list, word_scores):
-        phrase_scores = {}
-        for phrase in phrase_list:
-            phrase_score = 0
-            for word in phrase:
-                phrase_score += word_scores[word]
-            phrase_scores[" ".join(phrase)] = phrase_score
-        return phrase_scores
-
-    def extract(self, text, incl_scores=False):
-        sentences = nltk.sent_tokenize(text)
-        phrase_list = self._generate_candidate_keywords(sentences)
-        word_scores = self._calculate_word_scores(phrase_list)
-        phrase_scores = self._calculate_phrase_scores(
-            phrase_list, word_scores)
-        sorted_phrase_scores = sorted(phrase_scores.items(),
-                                      key=operator.itemgetter(1), reverse=True)
-        n_phrases = len(sorted_phrase_scores)
-        if incl_scores:
-            return sorted_phrase_scores[0:int(n_phrases/self.top_fraction)]
-        else:
-            return map(lambda x: x[0],
-                       sorted_phrase_scores[0:int(n_phrases/self.top_fraction)])
+        if self.document_frequency:
+            new_atype.setMetaData(config.data.namespace, "value_metadata", json.dumps(dict(
+                (kw, { 'document_frequency': count })
+                for kw, count in frequencies.items())))
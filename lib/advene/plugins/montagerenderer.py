@@ -29,6 +29,10 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
+import os
+import shutil
+import tempfile
+
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import GLib
@@ -45,66 +49,196 @@ except ValueError:
 
 import advene.util.helper as helper
 
+# Encoding profiles (container, video and audio caps), by output file
+# extension.
+PROFILES = {
+    '.webm': ("video/webm", "video/x-vp8", "audio/x-vorbis"),
+    '.mkv': ("video/x-matroska", "video/x-vp8", "audio/x-vorbis"),
+    '.mp4': ("video/quicktime,variant=iso", "video/x-h264", "audio/mpeg,mpegversion=4"),
+}
+DEFAULT_PROFILE = '.webm'
+
+# Number of segments per job, so that the jobs are balanced even if
+# some segments are slower to encode.
+SEGMENTS_PER_JOB = 2
+# Fraction of the progress bar for the segment rendering. The
+# remaining part is for the concatenation.
+SEGMENT_PHASE = .9
+
 def register(controller=None):
     if GES is not None:
         controller.register_generic_feature(shortname, MontageRenderer)
     return True
 
+def get_profile(filename):
+    """Return the encoding profile for the output filename.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return ext if ext in PROFILES else DEFAULT_PROFILE
+
+def container_profile(profile):
+    """Build the GstPbutils container profile for profile.
+    """
+    container, video, audio = PROFILES[profile]
+    container_profile = \
+        GstPbutils.EncodingContainerProfile.new("montage-profile",
+                                                "Pitivi encoding profile",
+                                                Gst.Caps(container),
+                                                None)
+    video_profile = GstPbutils.EncodingVideoProfile.new(Gst.Caps(video),
+                                                        None,
+                                                        Gst.Caps("video/x-raw"),
+                                                        0)
+
+    container_profile.add_profile(video_profile)
+
+    audio_profile = GstPbutils.EncodingAudioProfile.new(Gst.Caps(audio),
+                                                        None,
+                                                        Gst.Caps("audio/x-raw"),
+                                                        0)
+
+    container_profile.add_profile(audio_profile)
+    return container_profile
+
+def segment_groups(elements, count):
+    """Split elements into (at most) count contiguous groups of similar durations.
+    """
+    total = sum(a.fragment.duration for a in elements)
+    groups = []
+    current = []
+    duration = 0
+    for a in elements:
+        current.append(a)
+        duration += a.fragment.duration
+        if len(groups) < count - 1 and duration * count >= total * (len(groups) + 1):
+            groups.append(current)
+            current = []
+    if current:
+        groups.append(current)
+    return groups
+
+class MontageSegment:
+    """A group of clips rendered to a temporary file.
+    """
+    def __init__(self, index, elements, filename):
+        self.index = index
+        self.elements = elements
+        self.filename = filename
+        self.duration = sum(a.fragment.duration * Gst.MSECOND for a in elements)
+        self.pipeline = None
+        self.done = False
+
+    def position(self):
+        if self.done:
+            return self.duration
+        if self.pipeline is None:
+            return 0
+        return max(0, self.pipeline.query_position(Gst.Format.TIME)[1])
+
 class MontageRenderer:
     """Video montage exporter.
+
+    The montage can be rendered by a single pipeline, or by
+    splitting it into segments, rendered by concurrent pipelines
+    (jobs) and then concatenated. When the source streams are
+    compatible with the output profile, smart rendering is used, so
+    that the parts of the clips which start on a keyframe are copied
+    without re-encoding.
     """
     name = _("Video montage exporter")
 
-    def __init__(self, controller, elements=None):
+    def __init__(self, controller, elements=None, jobs=1):
         self.controller = controller
         self.elements = elements
+        self.jobs = jobs or os.cpu_count() or 1
         self.progress_cb = None
         self.pipeline = None
         self.total_duration = 1
+        self.profile = DEFAULT_PROFILE
+        self.smart = False
+        self.assets = {}
+        self.segments = []
+        self.tempdir = None
+        self.timeout = None
 
     def finalize(self):
+        if self.timeout is not None:
+            GLib.source_remove(self.timeout)
+            self.timeout = None
+        for s in self.segments:
+            if s.pipeline is not None:
+                s.pipeline.set_state(Gst.State.NULL)
+                s.pipeline = None
         if self.pipeline is not None:
             self.pipeline.set_state(Gst.State.NULL)
             self.pipeline = None
+        if self.tempdir is not None:
+            shutil.rmtree(self.tempdir, ignore_errors=True)
+            self.tempdir = None
+
+    def end(self):
+        self.finalize()
+        if self.progress_cb:
+            self.progress_cb(None)
 
     def bus_message_cb(self, unused_bus, message):
         if message.type == Gst.MessageType.EOS:
             logger.warning("End of encoding")
-            self.progress_cb(None)
+            self.end()
+        elif message.type == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            logger.error("Error when encoding: %s (%s)", err.message, debug)
+            self.end()
 
     def duration_querier(self):
         if self.pipeline is None:
-            self.progress_cb(None)
-            return True
+            self.timeout = None
+            return False
         pos = self.pipeline.query_position(Gst.Format.TIME)[1] / self.total_duration
+        if self.segments:
+            pos = SEGMENT_PHASE + (1 - SEGMENT_PHASE) * pos
         if self.progress_cb:
             self.progress_cb(pos)
         return True
 
-    def render(self, filename, progress_callback=None):
-        # Works if source is a type
-        self.progress_cb = progress_callback
-
-        # FIXME: considering single-video for the moment
-        media_uri = self.controller.get_default_media()
-        media_uri = helper.path2uri(media_uri)
-
-        logger.warning("Extracting clips from %s", media_uri)
-        asset = GES.UriClipAsset.request_sync(media_uri)
-
+    def get_asset(self, uri):
+        if uri not in self.assets:
+            self.assets[uri] = GES.UriClipAsset.request_sync(uri)
+        return self.assets[uri]
+
+    def can_copy(self, uri):
+        """Check if the streams of uri can be copied into the output profile.
+        """
+        if not hasattr(GES.PipelineFlags, 'SMART_RENDER'):
+            return False
+        container, video, audio = PROFILES[self.profile]
+        try:
+            info = GstPbutils.Discoverer().discover_uri(uri)
+        except Exception as e:
+            logger.warning(_("Cannot analyse %(uri)s: %(error)s"), { 'uri': uri,
+                                                                     'error': str(e) })
+            return False
+        streams = ([ (s, video) for s in info.get_video_streams() ]
+                   + [ (s, audio) for s in info.get_audio_streams() ])
+        return bool(streams) and all(s.get_caps().can_intersect(Gst.Caps(caps))
+                                     for s, caps in streams)
+
+    def build_pipeline(self, clips, filename, smart=False):
+        """Build the rendering pipeline for clips.
+
+        clips is a list of (uri, inpoint, duration) tuples (in ns). If
+        duration is None, the whole asset is used.
+        """
         timeline = GES.Timeline.new_audio_video()
         layer = timeline.append_layer()
 
         start_on_timeline = 0
-
-        self.total_duration = sum(a.fragment.duration * Gst.MSECOND for a in self.elements)
-        clips = []
-        for a in self.elements:
-            start_position_asset = a.fragment.begin * Gst.MSECOND
-            duration = a.fragment.duration * Gst.MSECOND
+        for uri, inpoint, duration in clips:
+            if duration is None:
+                duration = self.get_asset(uri).get_duration()
             # GES.TrackType.UNKNOWN => add every kind of stream to the timeline
-            clips.append(layer.add_asset(asset, start_on_timeline, start_position_asset,
-                                         duration, GES.TrackType.UNKNOWN))
+            layer.add_asset(self.get_asset(uri), start_on_timeline, inpoint,
+                            duration, GES.TrackType.UNKNOWN)
             start_on_timeline += duration
 
         timeline.commit()
@@ -112,37 +246,114 @@ class MontageRenderer:
         # Build the encoding pipeline
         pipeline = GES.Pipeline()
         pipeline.set_timeline(timeline)
+        pipeline.set_render_settings(helper.path2uri(filename), container_profile(self.profile))
+        pipeline.set_mode(GES.PipelineFlags.SMART_RENDER if smart else GES.PipelineFlags.RENDER)
+        return pipeline
 
-        container_profile = \
-            GstPbutils.EncodingContainerProfile.new("montage-profile",
-                                                    "Pitivi encoding profile",
-                                                    Gst.Caps("video/webm"),
-                                                    None)
-        video_profile = GstPbutils.EncodingVideoProfile.new(Gst.Caps("video/x-vp8"),
-                                                            None,
-                                                            Gst.Caps("video/x-raw"),
-                                                            0)
+    def element_clips(self, media_uri, elements):
+        return [ (media_uri, a.fragment.begin * Gst.MSECOND, a.fragment.duration * Gst.MSECOND)
+                 for a in elements ]
 
-        container_profile.add_profile(video_profile)
+    def start_pipeline(self, pipeline, callback, *p):
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", callback, *p)
+        pipeline.set_state(Gst.State.PLAYING)
 
-        audio_profile = GstPbutils.EncodingAudioProfile.new(Gst.Caps("audio/x-vorbis"),
-                                                            None,
-                                                            Gst.Caps("audio/x-raw"),
-                                                            0)
+    def render(self, filename, progress_callback=None, jobs=None):
+        # Works if source is a type
+        self.progress_cb = progress_callback
+        if jobs is None:
+            jobs = self.jobs
 
-        container_profile.add_profile(audio_profile)
+        # FIXME: considering single-video for the moment
+        media_uri = self.controller.get_default_media()
+        media_uri = helper.path2uri(media_uri)
 
-        pipeline.set_render_settings(helper.path2uri(filename), container_profile)
-        pipeline.set_mode(GES.PipelineFlags.RENDER)
+        self.profile = get_profile(filename)
+        self.smart = self.can_copy(media_uri)
+        logger.warning("Extracting clips from %s%s", media_uri,
+                       " (smart rendering)" if self.smart else "")
+        self.total_duration = sum(a.fragment.duration * Gst.MSECOND for a in self.elements)
+
+        if jobs > 1 and len(self.elements) > 1:
+            self.render_segments(media_uri, filename, jobs)
+            return
 
-        self.pipeline = pipeline
+        self.pipeline = self.build_pipeline(self.element_clips(media_uri, self.elements),
+                                            filename, self.smart)
         logger.warning("Starting encoding")
-        self.pipeline.set_state(Gst.State.PLAYING)
+        self.start_pipeline(self.pipeline, self.bus_message_cb)
+        self.timeout = GLib.timeout_add(300, self.duration_querier)
+
+    def render_segments(self, media_uri, filename, jobs):
+        """Render the montage by segments, then concatenate them.
+        """
+        self.tempdir = tempfile.mkdtemp('', 'montage')
+        groups = segment_groups(self.elements, min(len(self.elements), jobs * SEGMENTS_PER_JOB))
+        self.segments = [ MontageSegment(i, g, os.path.join(self.tempdir, 'segment-%03d%s' % (i, self.profile)))
+                          for i, g in enumerate(groups) ]
+        self.pending = list(self.segments)
+        self.media_uri = media_uri
+        self.filename = filename
+        self.jobs = jobs
+        logger.warning("Rendering %d segments with %d jobs", len(self.segments), jobs)
+        self.start_segments()
+        self.timeout = GLib.timeout_add(300, self.segment_querier)
+
+    def start_segments(self):
+        running = [ s for s in self.segments if s.pipeline is not None ]
+        while self.pending and len(running) < self.jobs:
+            s = self.pending.pop(0)
+            s.pipeline = self.build_pipeline(self.element_clips(self.media_uri, s.elements),
+                                             s.filename, self.smart)
+            self.start_pipeline(s.pipeline, self.segment_message_cb, s)
+            running.append(s)
+
+    def segment_message_cb(self, bus, message, segment):
+        if message.type == Gst.MessageType.EOS:
+            logger.info("End of segment %d", segment.index)
+            bus.remove_signal_watch()
+            segment.pipeline.set_state(Gst.State.NULL)
+            segment.pipeline = None
+            segment.done = True
+            if all(s.done for s in self.segments):
+                self.concatenate()
+            else:
+                self.start_segments()
+        elif message.type == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            logger.error("Error when encoding segment %d: %s (%s)", segment.index, err.message, debug)
+            self.end()
+
+    def segment_querier(self):
+        if self.pipeline is not None or not self.segments:
+            # Concatenation phase (or finalized)
+            self.timeout = None
+            if self.pipeline is not None:
+                self.timeout = GLib.timeout_add(300, self.duration_querier)
+            return False
+        done = sum(1 for s in self.segments if s.done)
+        pos = sum(s.position() for s in self.segments) / self.total_duration
+        if self.progress_cb:
+            self.progress_cb(SEGMENT_PHASE * min(pos, 1.0),
+                             _("Rendered %(done)d/%(count)d segments") % { 'done': done,
+                                                                           'count': len(self.segments) })
+        return True
 
-        bus = self.pipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message", self.bus_message_cb)
-        GLib.timeout_add(300, self.duration_querier)
+    def concatenate(self):
+        """Concatenate the rendered segments into the destination file.
+
+        Segments are encoded with the output profile, so they are
+        copied if smart rendering is available.
+        """
+        logger.warning("Concatenating %d segments", len(self.segments))
+        # Use the actual segment durations, which may slightly differ
+        # from the expected ones (frame boundaries)
+        clips = [ (helper.path2uri(s.filename), 0, None) for s in self.segments ]
+        self.pipeline = self.build_pipeline(clips, self.filename,
+                                            hasattr(GES.PipelineFlags, 'SMART_RENDER'))
+        self.start_pipeline(self.pipeline, self.bus_message_cb)
 
 if __name__ == '__main__':
     import sys
@@ -164,11 +375,11 @@ if __name__ == '__main__':
     r = MontageRenderer(None, sorted(at.annotations))
 
     mainloop = GLib.MainLoop()
-    def pg(value):
+    def pg(value, msg=''):
         if value is None:
             mainloop.quit()
             return
-        logging.warning("Progress %d", value)
+        logging.warning("Progress %d %s", value * 100, msg)
 
     r.render('/tmp/montage.webm', pg)
     mainloop.run()
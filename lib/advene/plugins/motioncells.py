@@ -27,7 +27,7 @@ from math import isinf, isnan
 
 from gi.repository import Gst
 
-from advene.util.gstimporter import GstImporter
+from advene.util.gstimporter import GstImporter, owned_samples, group_samples
 
 def register(controller=None):
     if Gst.ElementFactory.find('motioncells'):
@@ -38,6 +38,7 @@ def register(controller=None):
 
 class MotionCellImporter(GstImporter):
     name = _("Motion cell detection")
+    segmentable = True
 
     def __init__(self, *p, **kw):
         super(MotionCellImporter, self).__init__(*p, **kw)
@@ -85,6 +86,18 @@ class MotionCellImporter(GstImporter):
         self.generate_normalized_annotations()
         return True
 
+    def merge_segments(self, segments):
+        # Values are normalized with the min/max of the whole media
+        samples = [ sample
+                    for importer, (begin, end) in segments
+                    for sample in owned_samples(importer.buffer_list, begin, end) ]
+        if samples:
+            values = [ v for t, v in samples ]
+            self.min = min(values)
+            self.max = max(values)
+        self.buffer_list = group_samples(samples, self.count)
+        self.generate_normalized_annotations()
+
     def do_process_message(self, message, bus):
         if message.get_name() == 'motion':
             pos = self.get_current_position()
@@ -31,6 +31,7 @@ import re
 import time
 
 from advene.util.importer import GenericImporter
+from advene.util.xmlstream import XMLStream
 import xml.etree.ElementTree as ET
 
 def register(controller=None):
@@ -68,9 +69,6 @@ class MPEG7Importer(GenericImporter):
         return 0
 
     def process_file(self, filename):
-        tree=ET.parse(filename)
-        root=tree.getroot()
-
         p, at=self.init_package(filename=filename,
                                 schemaid='mpeg7',
                                 annotationtypeid='freetext')
@@ -79,18 +77,29 @@ class MPEG7Importer(GenericImporter):
             # FIXME: should specify title
             p.setMedia("dvd@1,1")
         self.defaulttype=at
-        self.convert(self.iterator(root))
+        stream=XMLStream(filename,
+                         start_tags=('Mpeg7', ),
+                         end_tags=('AudioVisualSegment', 'VideoSegment', 'AudioSegment'))
+        self.convert(self.iterator(stream))
         self.progress(1.0)
         return self.package
 
-    def iterator(self, root):
-        if root.tag != tag('Mpeg7'):
-            logger.error("Invalid MPEG7 file format: %s", root.tag)
-            return
-
-        for s in (root.findall('.//%s' % tag('AudioVisualSegment'))
-                  + root.findall('.//%s' % tag('VideoSegment'))
-                  + root.findall('.//%s' % tag('AudioSegment'))):
+    def iterator(self, stream):
+        root=None
+        # Segments are processed in document order. Nested segments
+        # are discarded once processed, so their content is not
+        # repeated in the enclosing segment.
+        for event, name, s in stream:
+            if root is None:
+                root=s
+                if root.tag != str(tag('Mpeg7')):
+                    logger.error("Invalid MPEG7 file format: %s", root.tag)
+                    return
+                continue
+            if event == 'start':
+                continue
+            if not self.progress(stream.progress()):
+                break
             content='No content'
             tp=''
             td=''
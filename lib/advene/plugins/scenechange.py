@@ -35,6 +35,7 @@ def register(controller=None):
 
 class SceneChangeImporter(GstImporter):
     name = _("Scene change detection")
+    segmentable = True
 
     def __init__(self, *p, **kw):
         super(SceneChangeImporter, self).__init__(*p, **kw)
@@ -50,6 +51,20 @@ class SceneChangeImporter(GstImporter):
                      for i, (begin, end) in enumerate(zip(self.buffer[:-1], self.buffer[1:])))
         self.buffer = []
 
+    def merge_segments(self, segments):
+        # Rebuild the shots from the scene changes owned by each segment
+        cuts = [ item['begin']
+                 for importer, (begin, end) in segments
+                 for item in importer.segment_items
+                 if begin <= item['begin'] < end ]
+        last_items = segments[-1][0].segment_items
+        if last_items:
+            cuts.append(last_items[-1]['end'])
+        self.convert({ 'begin': begin,
+                       'end': end,
+                       'content': i + 1 }
+                     for i, (begin, end) in enumerate(zip(cuts[:-1], cuts[1:])))
+
     def pipeline_postprocess(self, pipeline):
         def event_handler(pad, parent, event):
             if event is not None:
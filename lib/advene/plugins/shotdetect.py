@@ -28,7 +28,7 @@ from gettext import gettext as _
 
 import advene.core.config as config
 from advene.util.importer import GenericImporter
-import xml.etree.ElementTree as ET
+from advene.util.xmlstream import XMLStream
 
 def register(controller=None):
     controller.register_importer(ShotdetectImporter)
@@ -50,9 +50,6 @@ class ShotdetectImporter(GenericImporter):
         return 0
 
     def process_file(self, filename, dest=None):
-        tree=ET.parse(filename)
-        root=tree.getroot()
-
         p, at=self.init_package(filename=dest,
                                 schemaid='shotdetect', annotationtypeid='shots')
         at.mimetype='application/x-advene-structured'
@@ -61,36 +58,39 @@ class ShotdetectImporter(GenericImporter):
         self.package=p
         self.annotationtype=at
 
-        video=root.find('content/head/media')
-        if video is not None:
-            mediafile=video.attrib['src']
-            p.setMedia(mediafile)
-        self.convert(self.iterator(root))
+        stream=XMLStream(filename,
+                         start_tags=('shotdetect', ),
+                         end_tags=('media', 'shot'))
+        self.convert(self.iterator(stream))
         self.progress(1.0)
         return self.package
 
-    def iterator(self, root):
-        if root.tag != 'shotdetect':
-            logger.error("Invalid Shotdetect file format: %s", root.tag)
-            return
-
-        progress=0.01
-        self.progress(progress)
-
-        l=root.findall('content/body/shots/shot')
-        if not l:
-            self.progress(1.0, label=_("No shots"))
-            return
-        incr=0.98/len(l)
-        for an in l:
-            progress += incr
-            self.progress(progress)
+    def iterator(self, stream):
+        root=None
+        shots=0
+
+        self.progress(0.01)
+        for event, name, an in stream:
+            if root is None:
+                root=an
+                if root.tag != 'shotdetect':
+                    logger.error("Invalid Shotdetect file format: %s", root.tag)
+                    return
+                continue
+            if name == 'media':
+                self.package.setMedia(an.attrib['src'])
+                continue
+            shots += 1
+            self.progress(stream.progress())
             yield {
                 'type': self.annotationtype,
                 'content': "num=" + an.attrib['id'],
                 'begin': int(an.attrib['msbegin']),
                 'duration': int(an.attrib['msduration']),
                 }
+        if not shots:
+            self.progress(1.0, label=_("No shots"))
+            return
         self.progress(1.0)
 
 if __name__ == "__main__":
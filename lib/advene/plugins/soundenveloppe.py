@@ -26,7 +26,7 @@ from gettext import gettext as _
 import sys
 from gi.repository import Gst
 
-from advene.util.gstimporter import GstImporter
+from advene.util.gstimporter import GstImporter, owned_samples, group_samples
 
 from math import isinf, isnan
 
@@ -36,6 +36,7 @@ def register(controller=None):
 
 class SoundEnveloppeImporter(GstImporter):
     name = _("Sound enveloppe")
+    segmentable = True
 
     def __init__(self, *p, **kw):
         super(SoundEnveloppeImporter, self).__init__(*p, **kw)
@@ -104,6 +105,18 @@ class SoundEnveloppeImporter(GstImporter):
         self.generate_normalized_annotations()
         return True
 
+    def merge_segments(self, segments):
+        # Values are normalized with the min/max of the whole media
+        samples = [ sample
+                    for importer, (begin, end) in segments
+                    for sample in owned_samples(importer.buffer_list, begin, end) ]
+        if samples:
+            values = [ v for t, v in samples ]
+            self.min = min(values)
+            self.max = max(values)
+        self.buffer_list = group_samples(samples, self.count)
+        self.generate_normalized_annotations()
+
     def do_process_message(self, message, bus=None):
         if message.get_name() == 'level':
             if not self.buffer:
@@ -0,0 +1,177 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Tests for the HPI concept extraction importer, using a local stub server.
+
+This module is not a plugin (it has no register function), so the
+plugin loader ignores it.
+"""
+import unittest
+
+import http.server
+from io import BytesIO
+import json
+import sys
+import threading
+
+# advene.core.config parses the command line arguments
+saved_args = sys.argv
+sys.argv = sys.argv[:1]
+import advene.core.config as config
+sys.argv = saved_args
+
+from advene.core.idgenerator import Generator
+from advene.model.package import Package
+from advene.model.fragment import MillisecondFragment
+
+class StubImageCache:
+    def __init__(self):
+        from PIL import Image
+        buf = BytesIO()
+        Image.new('RGB', (64, 48)).save(buf, 'PNG')
+        self.data = buf.getvalue()
+
+    def get(self, position):
+        return self.data
+
+class StubController:
+    def __init__(self, package):
+        self.package = package
+
+    def get_default_media(self):
+        return 'movie.mp4'
+
+class VCDHandler(http.server.BaseHTTPRequestHandler):
+    """Stub VCD server.
+
+    Requests containing an annotation in server.failing get an error
+    response.
+    """
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json({ 'data': { 'capabilities': {
+            'minimum_batch_size': 1,
+            'maximum_batch_size': 2,
+            'available_models': [ { 'id': 'standard', 'label': 'Standard' } ],
+        } } })
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        with self.server.lock:
+            self.server.requests.append(payload)
+        ids = [ a['annotationid'] for a in payload['annotations'] ]
+        if self.server.failing.intersection(ids):
+            self.send_json({ 'status': 500, 'message': 'Model failure' })
+            return
+        self.send_json({ 'status': 200, 'data': { 'concepts': [
+            { 'annotationid': a['annotationid'],
+              'timecode': a['frames'][1]['timecode'],
+              'confidence': .9,
+              'label': 'concept %s' % a['annotationid'] }
+            for a in payload['annotations'] ] } })
+
+    def log_message(self, format, *args):
+        pass
+
+class HPIImporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), VCDHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failing = set()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        # The importer gets the server capabilities at instanciation
+        config.data.preferences['filter-options']['HPIImporter'] = { 'url': self.url }
+
+        self.package = Package(uri='new_pkg', source=config.data.advenefile(config.data.templatefilename))
+        self.package.imagecache = StubImageCache()
+        self.package._idgenerator = Generator(self.package)
+        schema = self.package.createSchema(ident='s_test')
+        self.package.schemas.append(schema)
+        self.source_type = schema.createAnnotationType(ident='shot')
+        schema.annotationTypes.append(self.source_type)
+        for i in range(5):
+            a = self.package.createAnnotation(ident='a%d' % i,
+                                              type=self.source_type,
+                                              fragment=MillisecondFragment(begin=i * 1000, end=(i + 1) * 1000))
+            self.package.annotations.append(a)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        del config.data.preferences['filter-options']['HPIImporter']
+
+    def run_importer(self, **options):
+        from advene.plugins.hpi import HPIImporter
+
+        i = HPIImporter(package=self.package,
+                        defaulttype=self.source_type,
+                        controller=StubController(self.package),
+                        source_type=self.source_type)
+        i.retries = 0
+        for k, v in options.items():
+            setattr(i, k, v)
+        i.process_file(self.url)
+        concept_type = self.package.get_element_by_id('concept_shot')
+        concepts = [ json.loads(a.content.data) for a in concept_type.annotations ]
+        return i, sorted(c['annotationid'] for c in concepts)
+
+    def test_concepts(self):
+        i, ids = self.run_importer(batch_size=2, workers=2)
+        self.assertEqual(ids, [ 'a0', 'a1', 'a2', 'a3', 'a4' ])
+        self.assertEqual(i.output_message, "")
+        self.assertEqual(sorted(len(r['annotations']) for r in self.server.requests), [ 1, 2, 2 ])
+        frames = self.server.requests[0]['annotations'][0]['frames']
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(self.server.requests[0]['media_filename'], 'movie.mp4')
+
+    def test_batch_size_limit(self):
+        # The server maximum batch size is 2
+        i, ids = self.run_importer(batch_size=10, workers=1)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(max(len(r['annotations']) for r in self.server.requests), 2)
+
+    def test_error_response(self):
+        # The batch holding a2 fails. The other batches are converted.
+        self.server.failing.add('a2')
+        i, ids = self.run_importer(batch_size=1, workers=2)
+        self.assertEqual(ids, [ 'a0', 'a1', 'a3', 'a4' ])
+        self.assertIn('Model failure', i.output_message)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_all_batches_failing(self):
+        self.server.failing.update(('a0', 'a1', 'a2', 'a3', 'a4'))
+        i, ids = self.run_importer(batch_size=1, workers=2)
+        self.assertEqual(ids, [])
+        self.assertEqual(i.output_message.count('Model failure'), 5)
+
+if __name__ == "__main__":
+    testsuite = unittest.defaultTestLoader.loadTestsFromTestCase(HPIImporterTestCase)
+    testrunner = unittest.TextTestRunner()
+    testrunner.run(testsuite)
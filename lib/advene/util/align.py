@@ -0,0 +1,220 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Annotation alignment.
+
+Dynamic Time Warping alignment of a sequence of annotations
+(destination) on a reference sequence (source). Each destination
+annotation is associated to a source annotation, so that the sum of
+the fragment distances is minimal while preserving the order.
+
+The cost matrix is computed row by row (one row per destination
+annotation). Only back-pointers (one byte per cell) are kept, and an
+optional Sakoe-Chiba band limits the computation to the cells near
+the diagonal.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Back-pointer values
+START = 0
+INSERT = 1
+SUBSTITUTE = 2
+DELETE = 3
+
+# Weight of the distance for a substitution (diagonal) move
+SUBSTITUTION_WEIGHT = 1.5
+
+INFINITY = float('inf')
+
+def fragment_distance(source, dest):
+    """Distance between two (begin, end) fragments.
+    """
+    return (abs(source[0] - dest[0])
+            + abs(source[1] - dest[1])
+            + abs((source[1] - source[0]) - (dest[1] - dest[0])))
+
+def band_limits(n, m, band=None):
+    """Return the list of source index ranges (lo, hi) for each destination index.
+
+    If band is None, all source indexes are considered. Else only
+    the indexes within band of the (scaled) diagonal are
+    considered. The ranges are made contiguous so that the last
+    cell can always be reached.
+    """
+    if band is None:
+        return [ (0, m) ] * n
+    limits = []
+    hi = 1
+    for i in range(n):
+        center = i * (m - 1) // (n - 1) if n > 1 else m - 1
+        lo = min(max(0, center - band), hi - 1)
+        hi = min(m, max(center + band + 1, lo + 1))
+        limits.append((lo, hi))
+    return limits
+
+def _python_rows(source, dest, limits):
+    """Generate (lo, costs, moves) rows - pure python version.
+    """
+    prev_lo, prev = 0, []
+    for i, (lo, hi) in enumerate(limits):
+        d = [ fragment_distance(source[j], dest[i]) for j in range(lo, hi) ]
+        costs = []
+        moves = []
+        runmin = math.inf
+        for k, j in enumerate(range(lo, hi)):
+            if i == 0:
+                if d[k] < runmin:
+                    runmin = d[k]
+                    costs.append(d[k])
+                    moves.append(START)
+                else:
+                    costs.append(costs[-1] + d[k])
+                    moves.append(DELETE)
+                continue
+            p = j - prev_lo
+            ins = prev[p] + d[k] if 0 <= p < len(prev) else INFINITY
+            sub = prev[p - 1] + d[k] * SUBSTITUTION_WEIGHT if 0 <= p - 1 < len(prev) else INFINITY
+            if ins < sub:
+                cost, move = ins, INSERT
+            else:
+                cost, move = sub, SUBSTITUTE
+            if k > 0 and not cost < costs[-1] + d[k]:
+                cost, move = costs[-1] + d[k], DELETE
+            costs.append(cost)
+            moves.append(move)
+        yield lo, costs, moves
+        prev_lo, prev = lo, costs
+
+def _shifted(values, values_lo, lo, hi):
+    """Return values (indexed from values_lo) for indexes in [lo, hi).
+
+    Missing values are infinite.
+    """
+    out = numpy.full(hi - lo, numpy.inf)
+    a = max(lo, values_lo)
+    b = min(hi, values_lo + len(values))
+    if a < b:
+        out[a - lo:b - lo] = values[a - values_lo:b - values_lo]
+    return out
+
+def _numpy_rows(source, dest, limits):
+    """Generate (lo, costs, moves) rows - numpy version.
+
+    A delete move depends on the cell on its left, so it is
+    expressed as a prefix minimum: with D the cumulated distances
+    along the row, and c the best of insert/substitute costs,
+    cost[j] = D[j] + min(c[k] - D[k] for k <= j).
+    Distances are integers (or half-integers once weighted) so this
+    is exactly the same as the sequential computation.
+    """
+    source = numpy.asarray(source, dtype=numpy.float64).reshape(-1, 2)
+    begins, ends = source[:, 0], source[:, 1]
+    durations = ends - begins
+    prev_lo, prev = 0, None
+    for i, (lo, hi) in enumerate(limits):
+        b, e = dest[i]
+        d = (numpy.abs(begins[lo:hi] - b)
+             + numpy.abs(ends[lo:hi] - e)
+             + numpy.abs(durations[lo:hi] - (e - b)))
+        cumulated = numpy.cumsum(d)
+        if i == 0:
+            start = numpy.empty(hi - lo, dtype=bool)
+            start[0] = True
+            start[1:] = d[1:] < numpy.minimum.accumulate(d)[:-1]
+            moves = numpy.where(start, START, DELETE).astype(numpy.int8)
+            # Index of the last start cell for each cell
+            last = numpy.maximum.accumulate(numpy.where(start, numpy.arange(hi - lo), 0))
+            costs = cumulated - cumulated[last] + d[last]
+        else:
+            ins = _shifted(prev, prev_lo, lo, hi) + d
+            sub = _shifted(prev, prev_lo, lo - 1, hi - 1) + d * SUBSTITUTION_WEIGHT
+            best = numpy.where(ins < sub, ins, sub)
+            offset = best - cumulated
+            minimum = numpy.minimum.accumulate(offset)
+            keep = numpy.empty(hi - lo, dtype=bool)
+            keep[0] = True
+            keep[1:] = offset[1:] < minimum[:-1]
+            moves = numpy.where(keep,
+                                numpy.where(ins < sub, INSERT, SUBSTITUTE),
+                                DELETE).astype(numpy.int8)
+            costs = cumulated + minimum
+        yield lo, costs, moves
+        prev_lo, prev = lo, costs
+
+def dtw_align(source, dest, band=None):
+    """Align the dest fragments on the source fragments.
+
+    source and dest are sequences of (begin, end) tuples, sorted by
+    begin time. band is the optional Sakoe-Chiba band width (in
+    number of fragments).
+
+    Return a list of source indexes, one for each dest fragment.
+    """
+    n, m = len(dest), len(source)
+    if n == 0:
+        return []
+    if m == 0:
+        raise ValueError("Cannot align on an empty reference")
+    limits = band_limits(n, m, band)
+    rows = _numpy_rows if numpy is not None else _python_rows
+
+    back = []
+    costs = None
+    for lo, costs, moves in rows(source, dest, limits):
+        back.append((lo, moves))
+    if costs[-1] == INFINITY:
+        raise ValueError("No possible alignment")
+
+    # Backtrack from the last cell
+    result = [ 0 ] * n
+    i, j = n - 1, m - 1
+    while True:
+        lo, moves = back[i]
+        move = moves[j - lo]
+        if move == DELETE:
+            j -= 1
+        elif move == START:
+            result[i] = j
+            break
+        else:
+            result[i] = j
+            i -= 1
+            if move == SUBSTITUTE:
+                j -= 1
+    return result
+
+def align_annotations(source, dest, band=None):
+    """Align the dest annotations on the source annotations.
+
+    Return a list of (dest_annotation, source_annotation) tuples.
+    """
+    source = sorted(source, key=lambda a: a.fragment.begin)
+    dest = sorted(dest, key=lambda a: a.fragment.begin)
+    indexes = dtw_align([ (a.fragment.begin, a.fragment.end) for a in source ],
+                        [ (a.fragment.begin, a.fragment.end) for a in dest ],
+                        band=band)
+    return [ (a, source[j]) for a, j in zip(dest, indexes) ]
@@ -0,0 +1,251 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Batch processing of files.
+
+Used by the advene_import/advene_export command line tools to
+process a list of files in a pool of worker processes. Each worker
+is initialized once (controller, plugins...) and then processes
+multiple files.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+
+from gettext import gettext as _
+
+import advene.core.config as config
+
+def expand_inputs(args, extensions=None):
+    """Return the input files for the given arguments.
+
+    Arguments may be filenames, glob patterns or directories (which
+    are recursively walked). If extensions is specified, directory
+    contents are filtered by extension (lowercase, with the leading
+    dot).
+
+    Return an ordered dict mapping input filenames to output base
+    names (see output_filename). The base name is the input path
+    relative to its directory or glob root argument, without
+    extension, so that the input tree is mirrored in the output
+    directory. The extension is kept if it is necessary to make base
+    names unique. A ValueError is raised if some base names remain
+    ambiguous.
+    """
+    result = collections.OrderedDict()
+    def add(fname, root):
+        if fname not in result:
+            result[fname] = os.path.relpath(fname, root) if root else os.path.basename(fname)
+
+    for arg in args:
+        if os.path.isdir(arg):
+            for root, dirs, files in os.walk(arg):
+                dirs.sort()
+                for name in sorted(files):
+                    if extensions is None or os.path.splitext(name)[1].lower() in extensions:
+                        add(os.path.join(root, name), arg)
+        elif any(c in arg for c in '*?['):
+            # The root is the longest directory prefix without magic characters
+            prefix = []
+            for part in os.path.dirname(arg).split(os.path.sep):
+                if any(c in part for c in '*?['):
+                    break
+                prefix.append(part)
+            root = os.path.sep.join(prefix) or os.curdir
+            for fname in sorted(glob.glob(arg, recursive=True)):
+                add(fname, root)
+        else:
+            add(arg, None)
+
+    stems = collections.Counter(os.path.splitext(name)[0] for name in result.values())
+    for fname, name in result.items():
+        if stems[os.path.splitext(name)[0]] == 1:
+            result[fname] = os.path.splitext(name)[0]
+    duplicates = [ name for name, count in collections.Counter(result.values()).items() if count > 1 ]
+    if duplicates:
+        raise ValueError(_("Ambiguous output names for input files: %s") % ", ".join(sorted(duplicates)))
+    return result
+
+def output_filename(basename, outputdir, extension):
+    """Return the output filename for the given output base name.
+
+    Necessary subdirectories of outputdir are created.
+    """
+    fname = os.path.join(outputdir, "{}.{}".format(basename, extension))
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    return fname
+
+def timed_call(method, inputfile, *p):
+    """Call method(inputfile, *p) and return a status dict.
+
+    The method may return the output filename. Exceptions are
+    reported in the status.
+    """
+    status = { 'input': inputfile }
+    t = time.time()
+    try:
+        status['output'] = method(inputfile, *p)
+        status['status'] = 'ok'
+    except Exception as e:
+        logger.debug("Error when processing %s", inputfile, exc_info=True)
+        status['status'] = 'error'
+        status['error'] = str(e) or e.__class__.__name__
+    status['duration'] = time.time() - t
+    return status
+
+def init_worker(paths, initializer, initargs):
+    """Initialize a worker process.
+
+    Application paths are propagated, since they may have been fixed
+    by the launching script (and worker processes may be spawned
+    instead of forked).
+    """
+    config.data.path.update(paths)
+    if initializer is not None:
+        initializer(*initargs)
+
+def run_batch(inputs, process, initializer=None, initargs=(), jobs=None, summary='-', label=""):
+    """Process the input files in a pool of worker processes.
+
+    inputs is a dict mapping input filenames to output base names
+    (see expand_inputs). process is a module-level function taking
+    an input filename and its output base name, and returning a
+    status dict (see timed_call). initializer(*initargs)
+    is called once in each worker.
+
+    A JSON summary (per-file status and timings) is written to the
+    summary filename ("-" for stdout). It is also returned.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    t = time.time()
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                initializer=init_worker,
+                                                initargs=(dict(config.data.path),
+                                                          initializer,
+                                                          initargs)) as executor:
+        futures = { executor.submit(process, fname, basename): fname
+                    for (fname, basename) in inputs.items() }
+        for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            fname = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                # Crashed worker, unpicklable result...
+                status = { 'input': fname,
+                           'status': 'error',
+                           'error': str(e) or e.__class__.__name__ }
+            results[fname] = status
+            logger.info("[%d/%d] %s %s: %s", n, len(futures), label, fname, status['status'])
+
+    return write_summary([ results[fname] for fname in inputs ],
+                         summary=summary, label=label, jobs=jobs, duration=time.time() - t)
+
+def write_summary(files, summary='-', label="", jobs=1, duration=0):
+    """Write the JSON summary for the given per-file status list.
+
+    The summary filename may be "-" for stdout. The summary data is
+    returned.
+    """
+    data = {
+        'label': label,
+        'jobs': jobs,
+        'duration': duration,
+        'total': len(files),
+        'succeeded': sum(1 for s in files if s['status'] == 'ok'),
+        'failed': sum(1 for s in files if s['status'] != 'ok'),
+        'files': files,
+    }
+    if summary == '-':
+        json.dump(data, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif summary:
+        with open(summary, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+    return data
+
+def ordered_chunk_map(executor, function, items, args=(), key=None, chunk_size=16, max_pending=4):
+    """Apply function to chunks of items in an executor.
+
+    function(data, *args) is called with a list of key(item) values
+    (the items themselves if key is None), and returns the list of
+    corresponding results. It must be a module-level function if the
+    executor is a ProcessPoolExecutor.
+
+    Generate (item, result) tuples, in the items order. At most
+    max_pending chunks are submitted at the same time, so that items
+    may be produced on the fly.
+    """
+    pending = collections.deque()
+
+    def submit(chunk):
+        data = chunk if key is None else [ key(item) for item in chunk ]
+        pending.append((executor.submit(function, data, *args), chunk))
+
+    def results():
+        future, chunk = pending.popleft()
+        return zip(chunk, future.result())
+
+    try:
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) < chunk_size:
+                continue
+            submit(chunk)
+            chunk = []
+            if len(pending) >= max_pending:
+                yield from results()
+        if chunk:
+            submit(chunk)
+        while pending:
+            yield from results()
+    finally:
+        # Interrupted iteration
+        for future, chunk in pending:
+            future.cancel()
+
+def batch_options(options):
+    """Extract the batch-specific options from the -o options dict.
+
+    Return a (outputdir, jobs, summary) tuple, outputdir being None if
+    batch mode is not requested.
+    """
+    jobs = options.get('jobs')
+    return (options.get('batch') or None,
+            int(jobs) if jobs else None,
+            options.get('summary') or '-')
+
+BATCH_OPTIONS = ('batch', 'jobs', 'summary')
+
+BATCH_USAGE = """Batch mode: with the "-o batch=OUTPUT_DIR" option, all the
+arguments following filter_name are considered as input files, glob
+patterns or directories, and are processed in parallel by worker
+processes ("-o jobs=N", default: number of CPUs). A JSON summary with
+per-file status and timings is written to stdout, or to the file
+specified with "-o summary=FILE".
+"""
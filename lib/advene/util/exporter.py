@@ -28,13 +28,16 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
+import codecs
 import io
 import json
 import optparse
 import os
+import re
 import sys
 
 import advene.core.config as config
+import advene.util.batch as batch
 
 from advene.model.package import Package
 from advene.model.content import KeywordList
@@ -250,6 +253,8 @@ class TemplateExporter(GenericExporter):
     name = _("Template exporter")
     # This is supposed to be a view
     templateview = None
+    # Compiled template for templateview
+    template = None
 
     @classmethod
     def get_name(cls):
@@ -269,56 +274,88 @@ class TemplateExporter(GenericExporter):
 
     def export(self, filename=None):
         ctx = self.controller.build_context(here=self.source)
+        if self.template is None:
+            type(self).template = compile_template(self.templateview)
+
         if filename is None:
             # No filename is provided. Return string.
             stream = io.BytesIO()
+            output = codecs.getwriter('utf-8')(stream)
         elif isinstance(filename, io.TextIOBase):
-            # Use an intermediary BytesIO
-            stream = io.BytesIO()
+            output = filename
         elif isinstance(filename, io.BytesIO):
-            stream = filename
+            output = codecs.getwriter('utf-8')(filename)
         else:
             try:
-                stream = open(filename, 'wb')
+                output = open(filename, 'w', encoding='utf-8')
             except Exception:
                 logger.error(_("Cannot export to %(filename)s"), exc_info=True)
                 return True
 
-        if self.templateview.content.mimetype is None or self.templateview.content.mimetype.startswith('text/'):
-            compiler = simpleTAL.HTMLTemplateCompiler ()
-            compiler.parseTemplate(self.templateview.content.stream, 'utf-8')
-            if self.templateview.content.mimetype == 'text/plain':
+        mimetype = self.templateview.content.mimetype
+        if mimetype is None or mimetype.startswith('text/'):
+            if mimetype == 'text/plain':
                 # Convert HTML entities to their values
-                output = io.BytesIO()
+                writer = EntityUnescaper(output)
             else:
-                output = stream
+                writer = output
             try:
-                compiler.getTemplate().expand(context=ctx, outputFile=output, outputEncoding='utf-8')
+                self.template.expand(context=ctx, outputFile=writer, outputEncoding='utf-8')
             except simpleTALES.ContextContentException:
                 logger.error(_("Error when exporting text template"), exc_info=True)
-            if self.templateview.content.mimetype == 'text/plain':
-                stream.write(output.getvalue().replace(b'&lt;', b'<').replace(b'&gt;', b'>').replace(b'&amp;', b'&'))
+            if writer is not output:
+                writer.flush()
         else:
-            compiler = simpleTAL.XMLTemplateCompiler ()
-            compiler.parseTemplate(self.templateview.content.stream)
             try:
-                compiler.getTemplate().expand(context=ctx, outputFile=stream, outputEncoding='utf-8', suppressXMLDeclaration=True)
+                self.template.expand(context=ctx, outputFile=output, outputEncoding='utf-8', suppressXMLDeclaration=True)
             except simpleTALES.ContextContentException:
                 logger.error(_("Error when exporting XML template"), exc_info=True)
         if filename is None:
             value = stream.getvalue()
             stream.close()
             return value
-        elif isinstance(filename, io.TextIOBase):
-            # Enforce UTF-8
-            filename.write(stream.getvalue().encode('utf-8'))
-        elif isinstance(filename, io.BytesIO):
+        elif isinstance(filename, (io.TextIOBase, io.BytesIO)):
             # Nothing to do: it is the responsibility of the caller to close the stream
             pass
         else:
-            stream.close()
+            output.close()
             return _("Data exported to %s") % filename
 
+class EntityUnescaper(codecs.StreamWriter):
+    """Text stream wrapper converting basic HTML entities to their values.
+
+    Data is converted incrementally: an entity split across
+    successive writes is kept until it is complete.
+
+    It is a StreamWriter so that simpleTAL considers it as a text
+    output.
+    """
+    entity_re = re.compile('&(lt|gt|amp);')
+    entities = { 'lt': '<', 'gt': '>', 'amp': '&' }
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = ''
+
+    def unescape(self, data):
+        return self.entity_re.sub(lambda m: self.entities[m.group(1)], data)
+
+    def write(self, data):
+        data = self.pending + data
+        i = data.rfind('&')
+        if i != -1 and len(data) - i < 5 and ';' not in data[i:]:
+            # Possibly incomplete entity
+            self.pending = data[i:]
+            data = data[:i]
+        else:
+            self.pending = ''
+        self.stream.write(self.unescape(data))
+
+    def flush(self):
+        if self.pending:
+            self.stream.write(self.unescape(self.pending))
+            self.pending = ''
+
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, KeywordList):
@@ -344,46 +381,131 @@ class FlatJsonExporter(GenericExporter):
     def serialize(self, data, textstream):
         json.dump(data, textstream, skipkeys=True, ensure_ascii=False, sort_keys=True, indent=4, cls=CustomJSONEncoder)
 
-    def export(self, filename=None):
+    def flat_json(self, a, media_uri):
+        """Return the flat representation of an annotation.
+        """
+        return {
+            "id": a.id,
+            "title": self.controller.get_title(a),
+            "creator": a.author,
+            "type": a.type.id,
+            "type_title": self.controller.get_title(a.type),
+            "type_color": self.controller.get_element_color(a.type),
+            "media": media_uri,
+            "begin": a.fragment.begin,
+            "end": a.fragment.end,
+            "color": self.controller.get_element_color(a),
+            "content_type": a.content.mimetype,
+            "content": a.content.data,
+            "parsed": a.content.parsed()
+        }
+
+    def iter_annotations(self):
+        """Generate the flat representations of the source annotations.
+        """
         # Works if source is a package or a type
         package = self.source.ownerPackage
         media_uri = package.getMetaData(config.data.namespace, "media_uri") or self.controller.get_default_media()
+        for a in self.source.annotations:
+            yield self.flat_json(a, media_uri)
 
-        def flat_json(a):
-            return {
-                "id": a.id,
-                "title": self.controller.get_title(a),
-                "creator": a.author,
-                "type": a.type.id,
-                "type_title": self.controller.get_title(a.type),
-                "type_color": self.controller.get_element_color(a.type),
-                "media": media_uri,
-                "begin": a.fragment.begin,
-                "end": a.fragment.end,
-                "color": self.controller.get_element_color(a),
-                "content_type": a.content.mimetype,
-                "content": a.content.data,
-                "parsed": a.content.parsed()
-            }
-
-        data = { "annotations": [ flat_json(a)
-                                  for a in self.source.annotations ] }
-
+    def export(self, filename=None):
+        data = { "annotations": list(self.iter_annotations()) }
         return self.output(data, filename)
 
+@register_exporter
+class FlatNdjsonExporter(FlatJsonExporter):
+    """Flat newline-delimited json exporter.
+
+    Each annotation is serialized as a JSON object on its own
+    line. Data is generated and written incrementally, so that it can
+    be streamed.
+    """
+    name = _("Flat NDJSON exporter")
+    extension = 'ndjson'
+    mimetype = "application/x-ndjson"
+
+    def serialize(self, data, textstream):
+        encoder = CustomJSONEncoder(skipkeys=True, ensure_ascii=False, sort_keys=True)
+        for d in data:
+            textstream.write(encoder.encode(d))
+            textstream.write('\n')
+
+    def export(self, filename=None):
+        if filename is None:
+            return list(self.iter_annotations())
+        return self.output(self.iter_annotations(), filename)
+
+def compile_template(view):
+    """Compile the TAL template of the given view.
+    """
+    if view.content.mimetype is None or view.content.mimetype.startswith('text/'):
+        compiler = simpleTAL.HTMLTemplateCompiler ()
+        compiler.parseTemplate(view.content.stream, 'utf-8')
+    else:
+        compiler = simpleTAL.XMLTemplateCompiler ()
+        compiler.parseTemplate(view.content.stream)
+    return compiler.getTemplate()
+
 def init_templateexporters():
     exporter_package = Package(uri=config.data.advenefile('exporters.xml', as_uri=True))
     for v in exporter_package.views:
         if v.id == 'index':
             continue
+        try:
+            template = compile_template(v)
+        except Exception:
+            logger.error(_("Cannot compile %s exporter template"), v.id, exc_info=True)
+            continue
         klass = type("{}Exporter".format(v.id), (TemplateExporter,), {
             'name': v.title,
             'templateview': v,
+            'template': template,
             'extension': v.getMetaData(config.data.namespace, 'extension') or v.id,
             'mimetype': v.content.mimetype
         })
         register_exporter(klass)
 
+# State of batch worker processes, initialized by batch_init
+_batch_worker = {}
+
+def batch_init(exporter_id, option_list, outputdir):
+    """Initialize a batch worker process.
+    """
+    import advene.core.controller as controller
+    c = controller.AdveneController()
+    c.init_plugins()
+    controller.init_templateexporters()
+    _batch_worker.update(controller=c,
+                         exporter=c.get_export_filters(ident=exporter_id),
+                         option_list=option_list,
+                         outputdir=outputdir)
+
+def _batch_export(inputfile, basename):
+    c = _batch_worker['controller']
+    e = _batch_worker['exporter'](controller=c)
+    e.process_options(_batch_worker['option_list'])
+    previous = c.package
+    c.load_package(inputfile, alias='batch')
+    if c.package is previous:
+        raise Exception(_("Cannot load package %s") % inputfile)
+    # Do not keep a reference to the previously exported package
+    if previous is not None and previous not in c.packages.values():
+        c.aliases.pop(previous, None)
+    e.set_source(c.package)
+    outputfile = e.get_filename(os.path.join(_batch_worker['outputdir'], basename))
+    os.makedirs(os.path.dirname(outputfile), exist_ok=True)
+    e.export(outputfile)
+    return outputfile
+
+def batch_export(inputfile, basename):
+    """Export a file in a batch worker process.
+
+    basename is the output filename, relative to the output
+    directory and without extension. Return a status dict.
+    """
+    return batch.timed_call(_batch_export, inputfile, basename)
+
 def main():
     logging.basicConfig(level=logging.DEBUG)
     USAGE = f"{sys.argv[0]} [-o filter_options] filter_name input_file [output_file]"
@@ -397,9 +519,11 @@ def main():
         or config.data.args[0] == 'list'):
         logger.error("""Syntax: %s
 
+%s
 Available filters:
   * %s
         """ % (USAGE,
+               batch.BATCH_USAGE,
                "\n  * ".join(i.get_id() for i in c.get_export_filters())))
         sys.exit(0)
 
@@ -414,7 +538,9 @@ Available filters:
     # Filter options are passed using the -o option
     # Rebuild filter option string from config.data.options.options dict
     option_list = [ (f"--{k}={v}" if v else f"--{k}")
-                    for (k, v) in config.data.options.options.items() ]
+                    for (k, v) in config.data.options.options.items()
+                    if k not in batch.BATCH_OPTIONS ]
+    outputdir, jobs, summary = batch.batch_options(config.data.options.options)
 
     e = None
     cl = [ f for f in c.get_export_filters() if f.get_id().startswith(filtername) ]
@@ -431,10 +557,24 @@ Available filters:
     e.optionparser.set_usage(USAGE)
     e.process_options(option_list)
 
+    if outputdir is not None:
+        # Batch mode
+        try:
+            inputs = batch.expand_inputs(config.data.args[1:], extensions=('.azp', '.xml'))
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        os.makedirs(outputdir, exist_ok=True)
+        data = batch.run_batch(inputs, batch_export,
+                               initializer=batch_init,
+                               initargs=(e.get_id(), option_list, outputdir),
+                               jobs=jobs, summary=summary, label=e.get_id())
+        sys.exit(1 if data['failed'] else 0)
+
     c.load_package(inputfile)
     e.set_source(c.package)
 
-    if outputfile:
+    if outputfile and outputfile != '-':
         outputfile = e.get_filename(outputfile)
         logger.info("Converting %s to %s using %s", inputfile, outputfile, e.name)
         e.export(outputfile)
@@ -0,0 +1,168 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Frame feature detection.
+
+Helpers for the feature detection importer: frames are decoded (and
+sampled) by a reader thread, and the cascade detection can be run in
+a pool of worker processes. Worker functions are defined here, since
+plugin modules cannot be imported by worker processes.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import concurrent.futures
+import operator
+import queue
+import threading
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from advene.util.batch import ordered_chunk_map
+
+# Detection parameters (scale factor, passed to detectMultiScale)
+SCALE_FACTOR = 1.2
+# Number of frames sent to a worker process at once
+CHUNK_SIZE = 16
+
+# Cascade classifier of the worker process
+_cascade = None
+
+def detect(cascade, gray, neighbors):
+    """Detect objects in a grayscale frame.
+
+    Return a list of (x, y, w, h) tuples.
+    """
+    objects = cascade.detectMultiScale(gray, SCALE_FACTOR, neighbors)
+    return [ tuple(int(v) for v in o) for o in objects ]
+
+def init_worker(classifier_file):
+    """Load the cascade classifier in a worker process.
+    """
+    global _cascade
+    _cascade = cv2.CascadeClassifier(classifier_file)
+
+def detect_chunk(frames, neighbors):
+    """Detect objects in a list of grayscale frames (in a worker process).
+    """
+    return [ detect(_cascade, gray, neighbors) for gray in frames ]
+
+class FrameReader(threading.Thread):
+    """Decode video frames in a separate thread.
+
+    One frame every stride frames is decoded and converted by
+    convert(frame). The others are only grabbed, which is much
+    cheaper. Converted frames are available as (index, position,
+    data) tuples through the frames() generator, position being in
+    ms.
+    """
+    def __init__(self, video, convert, stride=1, first_frame=None, buffer_size=64):
+        super().__init__(daemon=True)
+        self.video = video
+        self.convert = convert
+        self.stride = max(1, stride)
+        self.first_frame = first_frame
+        self.queue = queue.Queue(buffer_size)
+        self.stopped = threading.Event()
+        fps = video.get(cv2.CAP_PROP_FPS)
+        # If the framerate is unknown, fallback to the (slower)
+        # position property.
+        self.fps = fps if fps and fps > 0 else None
+
+    def position(self, index):
+        if self.fps is not None:
+            return index * 1000.0 / self.fps
+        return self.video.get(cv2.CAP_PROP_POS_MSEC)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        index = 0
+        try:
+            if self.first_frame is not None:
+                if not self.put((0, 0, self.convert(self.first_frame))):
+                    return
+                index = 1
+            while not self.stopped.is_set():
+                if index % self.stride:
+                    if not self.video.grab():
+                        break
+                else:
+                    pos = self.position(index)
+                    ret, frame = self.video.read()
+                    if not ret:
+                        break
+                    if not self.put((index, pos, self.convert(frame))):
+                        break
+                index += 1
+        except Exception:
+            logger.error("Error while reading frames", exc_info=True)
+        finally:
+            self.put(None)
+
+    def frames(self):
+        """Generate (index, position, data) tuples.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            yield item
+
+    def stop(self):
+        self.stopped.set()
+        # Unblock the reader thread
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+def serial_detections(frames, classifier_file, neighbors):
+    """Generate (index, position, objects) tuples for (index, position, gray) frames.
+    """
+    cascade = cv2.CascadeClassifier(classifier_file)
+    for index, pos, gray in frames:
+        yield index, pos, detect(cascade, gray, neighbors)
+
+def parallel_detections(frames, classifier_file, neighbors, processes, chunk_size=CHUNK_SIZE):
+    """Generate (index, position, objects) tuples, detecting in worker processes.
+
+    Frames are sent to the workers by chunks. Results are returned
+    in the frame order.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                initializer=init_worker,
+                                                initargs=(classifier_file, )) as executor:
+        for (index, pos, gray), objects in ordered_chunk_map(executor, detect_chunk, frames,
+                                                            args=(neighbors, ),
+                                                            key=operator.itemgetter(2),
+                                                            chunk_size=chunk_size,
+                                                            max_pending=2 * processes):
+            yield index, pos, objects
@@ -23,13 +23,26 @@ logger = logging.getLogger(__name__)
 
 from gettext import gettext as _
 
+import collections
+import os
+import queue
+import threading
+import time
+
+from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gst
 
+from advene.model.package import Package
 import advene.util.helper as helper
 from advene.util.importer import GenericImporter
 from advene.util.tools import path2uri
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class GstImporter(GenericImporter):
     """GstImporter - Gstreamer importer
 
@@ -54,15 +67,79 @@ class GstImporter(GenericImporter):
     data, and call the `.convert` method only in the `do_finalize`
     method.
 
+    If numpy is available, you can alternatively implement the
+    `process_frame_batch` method, which will be called with
+    `frame_batch_size` frames at once, as a (n, size) uint8 numpy
+    array of frame data and a (n, ) array of frame dates (in ms). The
+    buffers are copied directly into a preallocated array, so that
+    statistics can be computed on many frames at once with array
+    operations.
+
+    Frames are not dropped: when the frame processing is slower than
+    the decoding, the appsink queue fills up and blocks the pipeline
+    (back-pressure). If `threaded_frames` is True, the frame
+    callbacks are run in a dedicated worker thread, so that decoding
+    and analysis can overlap.
+
     You can see examples of usage in the `plugins.soundenveloppe`
     plugin (for audio, using Gstreamer message metadata) and
-    `plugins.dominantcolor` (for video, using frame data).
+    `plugins.dominantcolor` (for video, using batched frame data).
+
+    Multiple files can be analysed concurrently with an
+    AnalysisScheduler.
+
+    Importers with the `segmentable` attribute can split a long media
+    file into overlapping time segments (`segments` option), analysed
+    by concurrent pipelines. The data converted by each segment
+    pipeline is collected, and merged by the `merge_segments` method.
     """
     name = _("GStreamer generic importer")
 
+    # Number of frames passed at once to process_frame_batch
+    frame_batch_size = 256
+    # Maximum number of frames waiting to be processed
+    sink_max_buffers = 10
+    # Drop frames when the queue is full, instead of blocking the pipeline
+    drop_frames = False
+    # Run the frame callbacks in a worker thread
+    threaded_frames = True
+    # Can the media be analysed in independent time segments
+    segmentable = False
+
     def __init__(self, *p, **kw):
         super(GstImporter, self).__init__(*p, **kw)
         self.is_finalized = False
+        # Frame batch buffers (allocated on first frame)
+        self.frame_batch = None
+        self.frame_batch_dates = None
+        self.frame_batch_count = 0
+        # Frame processing thread and its input queue
+        self.frame_queue = None
+        self.frame_thread = None
+        self.frame_worker_stop = False
+        # Throughput statistics
+        self.frame_count = 0
+        self.start_time = None
+        self.end_time = None
+        # Last pipeline error message
+        self.error = None
+
+        # Time segment (begin, end) in ms analysed by this importer,
+        # when it is a segment importer
+        self.segment = None
+        self.segment_started = False
+        # Data converted by the segment importer
+        self.segment_items = []
+        # Number of segments and overlap (in ms) for segmented analysis
+        self.segments = 1
+        self.segment_overlap = 5000
+        if self.segmentable:
+            self.optionparser.add_option("--segments",
+                                         action="store", type="int", dest="segments", default=self.segments,
+                                         help=_("Number of time segments analysed in parallel."))
+            self.optionparser.add_option("--segment-overlap",
+                                         action="store", type="int", dest="segment_overlap", default=self.segment_overlap,
+                                         help=_("Overlap (in ms) between consecutive time segments."))
 
     @staticmethod
     def can_handle(fname):
@@ -82,7 +159,25 @@ class GstImporter(GenericImporter):
         self.is_finalized = True
         GObject.idle_add(lambda: self.pipeline.set_state(Gst.State.NULL) and False)
         logger.debug("Doing finalize")
+        if self.frame_queue is not None:
+            if threading.current_thread() is self.frame_thread:
+                # Called from a frame callback: stop once it returns
+                self.frame_worker_stop = True
+            else:
+                # Frames queued before this point will still be processed
+                self.frame_queue.put(None)
         def wrapper():
+            if self.frame_thread is not None:
+                self.frame_thread.join()
+                self.frame_thread = None
+            self.end_time = time.time()
+            if self.frame_count and self.start_time is not None:
+                duration = self.end_time - self.start_time
+                logger.info(_("Processed %(count)d frames in %(duration).02fs (%(fps).02f fps)"),
+                            { 'count': self.frame_count,
+                              'duration': duration,
+                              'fps': self.frame_count / (duration or 1) })
+            self.flush_frame_batch()
             if hasattr(self, 'do_finalize'):
                 self.do_finalize()
             self.end_callback()
@@ -132,10 +227,26 @@ class GstImporter(GenericImporter):
         if message.type == Gst.MessageType.EOS:
             logger.debug("MSG EOS - finalize")
             self.finalize()
+        elif message.type == Gst.MessageType.ERROR:
+            # The pipeline will not produce any more data.
+            title, debug = message.parse_error()
+            self.error = str(title)
+            logger.error("%s: %s", title, debug)
+            self.finalize()
+        elif (message.type == Gst.MessageType.ASYNC_DONE
+              and self.segment is not None
+              and not self.segment_started):
+            # The pipeline is prerolled: we can seek to the segment
+            self.segment_started = True
+            GObject.idle_add(self.start_segment)
         elif s:
             logger.debug("MSG %s: %s", bus.get_name(), s.to_string())
             if s.get_name() == 'progress' and self.progress is not None:
-                progress = s['percent-double'] / 100
+                if self.segment is not None:
+                    begin, end = self.segment
+                    progress = max(0, (self.get_current_position() - begin) / ((end - begin) or 1))
+                else:
+                    progress = s['percent-double'] / 100
                 if not self.progress(progress, self.progress_message(progress, message)):
                     self.finalize()
                 if s['current'] == s['total']:
@@ -145,6 +256,13 @@ class GstImporter(GenericImporter):
                 self.do_process_message(s, bus)
         return True
 
+    def convert(self, source):
+        if self.segment is not None:
+            # Segment importer: keep the data for merge_segments
+            self.segment_items.extend(source)
+            return
+        return super(GstImporter, self).convert(source)
+
     def setup_importer(self, filename):
         """Setup a new import session:
         - initialize annotation type/package
@@ -167,29 +285,107 @@ class GstImporter(GenericImporter):
     #    """
     #    return True
 
-    def frame_handler(self, element):
-        """Convert frame before passing it to self.process_frame as a dict
+    #def process_frame_batch(self, frames, dates):
+    #    """Frame batch process method
+    #    It will be called with a (n, size) uint8 numpy array of frame data
+    #    and a (n, ) float numpy array of frame dates (in ms)
+    #    """
+    #    return True
+
+    def flush_frame_batch(self):
+        """Pass the buffered frames to process_frame_batch.
+        """
+        if self.frame_batch_count:
+            n = self.frame_batch_count
+            self.frame_batch_count = 0
+            self.process_frame_batch(self.frame_batch[:n], self.frame_batch_dates[:n])
+
+    def sample_handler(self, element):
+        """Handle a new appsink sample.
+
+        The sample is either processed directly (in the streaming
+        thread) or queued for the frame worker thread. In the latter
+        case, the streaming thread blocks while the queue is full.
         """
         sample = element.emit("pull-sample")
+        if sample is None:
+            return Gst.FlowReturn.EOS
+        date = element.query_position(Gst.Format.TIME)[1] / Gst.MSECOND
+        if self.frame_queue is None:
+            self.frame_callback(sample, date)
+            return Gst.FlowReturn.OK
+        while not self.is_finalized:
+            try:
+                self.frame_queue.put((sample, date), timeout=.5)
+                return Gst.FlowReturn.OK
+            except queue.Full:
+                continue
+        return Gst.FlowReturn.EOS
+
+    def frame_worker(self):
+        """Process queued samples until finalization.
+        """
+        while not self.frame_worker_stop:
+            item = self.frame_queue.get()
+            if item is None:
+                break
+            try:
+                self.frame_callback(*item)
+            except Exception:
+                logger.error("Error in frame processing", exc_info=True)
+
+    def frame_handler(self, sample, date):
+        """Convert frame before passing it to self.process_frame as a dict
+        """
         buf = sample.get_buffer()
         (res, mapinfo) = buf.map(Gst.MapFlags.READ)
         if not res:
             logger.warning("Error in converting buffer")
         else:
-            pos = element.query_position(Gst.Format.TIME)[1]
+            self.frame_count += 1
             data = bytes(mapinfo.data)
+            buf.unmap(mapinfo)
             self.process_frame({
                 "data": data,
-                "date": pos / Gst.MSECOND,
+                "date": date,
                 "pts": buf.pts / Gst.MSECOND,
                 "media": self.uri
             })
-        return Gst.FlowReturn.OK
+
+    def frame_batch_handler(self, sample, date):
+        """Copy frame data into the frame batch array
+
+        self.process_frame_batch is called when the batch is full.
+        """
+        buf = sample.get_buffer()
+        (res, mapinfo) = buf.map(Gst.MapFlags.READ)
+        if not res:
+            logger.warning("Error in converting buffer")
+            return
+        # Zero-copy view on the mapped buffer
+        view = numpy.frombuffer(mapinfo.data, dtype=numpy.uint8)
+        if self.frame_batch is None or self.frame_batch.shape[1] != view.size:
+            self.flush_frame_batch()
+            self.frame_batch = numpy.empty((self.frame_batch_size, view.size), dtype=numpy.uint8)
+            self.frame_batch_dates = numpy.empty(self.frame_batch_size, dtype=numpy.float64)
+        n = self.frame_batch_count
+        self.frame_batch[n] = view
+        del view
+        buf.unmap(mapinfo)
+        self.frame_batch_dates[n] = date
+        self.frame_batch_count += 1
+        self.frame_count += 1
+        if self.frame_batch_count == self.frame_batch_size:
+            self.flush_frame_batch()
 
     def async_process_file(self, filename, end_callback):
+        if self.segmentable and self.segment is None and self.segments > 1:
+            return self.async_process_segments(filename, end_callback)
         self.end_callback = end_callback
 
-        sink = 'appsink name=sink emit-signals=true sync=false max-buffers=10 drop=true'
+        sink = 'appsink name=sink emit-signals=true sync=false max-buffers=%d drop=%s' % (
+            self.sink_max_buffers,
+            'true' if self.drop_frames else 'false')
 
         pipeline_elements = self.setup_importer(filename)
 
@@ -204,9 +400,20 @@ class GstImporter(GenericImporter):
         self.decoder = self.pipeline.get_by_name('decoder')
         self.report = self.pipeline.get_by_name('report')
         self.sink = self.pipeline.get_by_name('sink')
-        if hasattr(self, 'process_frame'):
-            print("Connecting signal handler")
-            self.sink.connect("new-sample", self.frame_handler)
+        if hasattr(self, 'process_frame_batch') and numpy is not None:
+            self.frame_callback = self.frame_batch_handler
+        elif hasattr(self, 'process_frame'):
+            self.frame_callback = self.frame_handler
+        else:
+            self.frame_callback = None
+        if self.frame_callback is not None:
+            if self.threaded_frames:
+                self.frame_queue = queue.Queue(maxsize=self.sink_max_buffers)
+                self.frame_thread = threading.Thread(target=self.frame_worker,
+                                                     name="%s frames" % self.name,
+                                                     daemon=True)
+                self.frame_thread.start()
+            self.sink.connect("new-sample", self.sample_handler)
 
         bus = self.pipeline.get_bus()
 
@@ -226,5 +433,271 @@ class GstImporter(GenericImporter):
         if hasattr(self, 'pipeline_postprocess'):
             self.pipeline_postprocess(self.pipeline)
 
+        self.start_time = time.time()
+        if self.segment is not None:
+            # Preroll, then seek (see on_bus_message)
+            self.pipeline.set_state(Gst.State.PAUSED)
+        else:
+            self.pipeline.set_state(Gst.State.PLAYING)
+        return self.package
+
+    def start_segment(self):
+        """Seek to the segment and start playing.
+        """
+        begin, end = self.segment
+        self.pipeline.seek(1.0, Gst.Format.TIME,
+                           Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                           Gst.SeekType.SET, int(begin * Gst.MSECOND),
+                           Gst.SeekType.SET, int(end * Gst.MSECOND))
         self.pipeline.set_state(Gst.State.PLAYING)
+        return False
+
+    def get_media_duration(self, uri):
+        """Return the media duration in ms (0 if unknown).
+        """
+        try:
+            from gi.repository import GstPbutils
+            info = GstPbutils.Discoverer().discover_uri(uri)
+            return info.get_duration() / Gst.MSECOND
+        except Exception as e:
+            logger.warning(_("Cannot get the duration of %(uri)s: %(error)s"),
+                           { 'uri': uri,
+                             'error': str(e) })
+            return 0
+
+    def create_segment_importer(self, begin, end):
+        """Create an importer for the (begin, end) time segment.
+
+        It has the same options as self, and converts data into a
+        temporary package.
+        """
+        importer = self.__class__(package=Package(uri='new_pkg', source=None),
+                                  controller=self.controller)
+        importer.set_options(dict((o.dest, getattr(self, o.dest))
+                                  for o in self.optionparser.option_list
+                                  if o.dest and hasattr(self, o.dest)))
+        importer.segments = 1
+        importer.offset = 0
+        importer.segment = (begin, end)
+        return importer
+
+    def segment_bounds(self, duration):
+        """Return the list of (analysed, owned) segments for the duration.
+
+        Each segment owns the [begin, end) part of the media
+        timeline, and analyses it with an overlap on both sides, so
+        that detectors have some context and that items spanning a
+        boundary are complete.
+        """
+        n = self.segments
+        bounds = [ duration * i / n for i in range(n + 1) ]
+        # Items at the very beginning/end belong to the first/last segment
+        owned = [ -float('inf') ] + bounds[1:-1] + [ float('inf') ]
+        return [ ((max(0, bounds[i] - self.segment_overlap),
+                   min(duration, bounds[i + 1] + self.segment_overlap)),
+                  (owned[i], owned[i + 1]))
+                 for i in range(n) ]
+
+    def async_process_segments(self, filename, end_callback):
+        """Analyse the file as concurrent time segments.
+        """
+        self.uri = path2uri(filename)
+        duration = self.get_media_duration(self.uri)
+        if not duration:
+            logger.warning(_("Unknown media duration. Analysing the whole file at once."))
+            self.segments = 1
+            return self.async_process_file(filename, end_callback)
+
+        self.end_callback = end_callback
+        # Create the annotation types in self.package
+        self.setup_importer(filename)
+
+        segments = []
+        progresses = [ 0 ] * self.segments
+        def segment_progress(index, value=None, label=None):
+            if value is not None:
+                progresses[index] = value
+            if self.is_finalized:
+                # Cancelled by the user
+                return False
+            if not self.progress(sum(progresses) / len(progresses),
+                                 _("Analysing %d segments") % len(progresses)):
+                self.is_finalized = True
+                return False
+            return True
+
+        def segments_ended(scheduler):
+            self.end_time = time.time()
+            self.frame_count = sum(importer.frame_count for importer, owned in segments)
+            errors = [ importer.error for importer, owned in segments if importer.error ]
+            if errors:
+                self.error = errors[0]
+            logger.info(_("Analysed %(count)d segments in %(duration).02fs"),
+                        { 'count': len(segments),
+                          'duration': self.end_time - self.start_time })
+            self.is_finalized = True
+            self.merge_segments(segments)
+            self.end_callback()
+
+        scheduler = AnalysisScheduler(jobs=self.segments, end_callback=segments_ended)
+        for index, ((begin, end), owned) in enumerate(self.segment_bounds(duration)):
+            importer = self.create_segment_importer(begin, end)
+            importer.callback = lambda value=None, label=None, index=index: segment_progress(index, value, label)
+            segments.append((importer, owned))
+            scheduler.add(importer, filename)
+        self.start_time = time.time()
+        self.progress(.1, _("Starting processing"))
+        scheduler.start()
         return self.package
+
+    def merge_segments(self, segments):
+        """Merge the data converted by segment importers.
+
+        segments is a list of (importer, (begin, end)) tuples, in
+        timeline order, where (begin, end) is the part of the
+        timeline owned by the importer. The default implementation
+        keeps the items beginning in the owned part, so that items
+        detected in the overlaps are not duplicated.
+        """
+        self.convert(item
+                     for importer, (begin, end) in segments
+                     for item in importer.segment_items
+                     if begin <= item['begin'] < end)
+
+def owned_samples(buffer_list, begin, end):
+    """Return the (time, value) samples of buffer_list in [begin, end).
+
+    buffer_list is a list of (begin, end, values) tuples, where the
+    values are regularly spaced in time (as built by value-sampling
+    importers like soundenveloppe).
+    """
+    result = []
+    for b, e, values in buffer_list:
+        step = (e - b) / len(values) if values else 0
+        result.extend((b + i * step, v)
+                      for i, v in enumerate(values)
+                      if begin <= b + i * step < end)
+    return result
+
+def group_samples(samples, count):
+    """Group (time, value) samples in (begin, end, values) tuples.
+
+    Each tuple holds at most count values.
+    """
+    if not samples:
+        return []
+    step = (samples[-1][0] - samples[0][0]) / (len(samples) - 1) if len(samples) > 1 else 0
+    result = []
+    for i in range(0, len(samples), count):
+        chunk = samples[i:i + count]
+        if i + count < len(samples):
+            end = samples[i + count][0]
+        else:
+            end = chunk[-1][0] + step
+        result.append((chunk[0][0], end, [ v for t, v in chunk ]))
+    return result
+
+class AnalysisScheduler:
+    """Run multiple GstImporter analyses concurrently.
+
+    Analyses (importer, filename) are queued with the add() method.
+    At most `jobs` pipelines are running at the same time: when an
+    analysis ends, the next pending one is started. Pipelines are
+    started and finalized in the context of the GLib main loop.
+
+    job_callback(importer, filename) is called when an analysis is finished,
+    and end_callback(scheduler) when all of them are.
+
+    Importers can also be created when their analysis starts, by
+    queuing a factory with add_lazy().
+    """
+    def __init__(self, jobs=None, job_callback=None, end_callback=None):
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        self.jobs = max(1, jobs)
+        self.job_callback = job_callback
+        self.end_callback = end_callback
+        self.pending = collections.deque()
+        self.running = []
+        # List of (importer, filename) for finished analyses
+        self.done = []
+        self.is_finished = False
+
+    def add(self, importer, filename):
+        """Queue an analysis.
+        """
+        self.pending.append((lambda: importer, filename))
+
+    def add_lazy(self, factory, filename):
+        """Queue an analysis whose importer is created by factory() when it starts.
+
+        If factory returns None, the analysis is skipped.
+        """
+        self.pending.append((factory, filename))
+
+    def start(self):
+        """Start the pending analyses.
+        """
+        self.is_finished = False
+        self.start_next()
+        return False
+
+    def start_next(self):
+        while self.pending and len(self.running) < self.jobs:
+            factory, filename = self.pending.popleft()
+            try:
+                importer = factory()
+            except Exception as e:
+                logger.error(_("Cannot analyse %(filename)s: %(error)s"),
+                             { 'filename': filename,
+                               'error': str(e) }, exc_info=True)
+                importer = None
+            if importer is None:
+                continue
+            self.running.append(importer)
+            try:
+                importer.async_process_file(filename,
+                                            lambda *p, i=importer, f=filename: self.job_ended(i, f))
+            except Exception as e:
+                logger.error(_("Cannot analyse %(filename)s: %(error)s"),
+                             { 'filename': filename,
+                               'error': str(e) }, exc_info=True)
+                importer.error = str(e) or e.__class__.__name__
+                self.job_ended(importer, filename)
+        if not self.running and not self.pending and not self.is_finished:
+            self.is_finished = True
+            if self.end_callback is not None:
+                self.end_callback(self)
+
+    def job_ended(self, importer, filename):
+        if importer not in self.running:
+            return True
+        self.running.remove(importer)
+        self.done.append((importer, filename))
+        if self.job_callback is not None:
+            try:
+                self.job_callback(importer, filename)
+            except Exception:
+                logger.error("Error in analysis callback", exc_info=True)
+        self.start_next()
+        return True
+
+    def run(self):
+        """Run all the analyses and return when they are finished.
+
+        A GLib main loop is run during the processing. Return the
+        list of (importer, filename) tuples.
+        """
+        mainloop = GLib.MainLoop()
+        end_callback = self.end_callback
+        def end(scheduler):
+            if end_callback is not None:
+                end_callback(scheduler)
+            mainloop.quit()
+        self.end_callback = end
+        GLib.idle_add(self.start)
+        try:
+            mainloop.run()
+        finally:
+            self.end_callback = end_callback
+        return self.done
@@ -3,6 +3,8 @@
     Ned Batchelder, http://nedbatchelder.com
 """
 
+from collections import OrderedDict
+import os
 import os.path
 import sys
 
@@ -98,8 +100,11 @@ def _findFile(filename):
             ret = os.path.abspath(p)
     return ret
 
-# A dictionary from full file paths to parsed XML.
-_xmlcache = {}
+# A dictionary from full file paths to ((mtime, size), parsed XML),
+# in least recently used order. Its size is bounded, since the parsed
+# DOM trees use much more memory than the files.
+_xmlcache = OrderedDict()
+CACHE_SIZE = 16
 
 def xml(xmlin, forced=False):
     """ Parse some XML.
@@ -118,8 +123,12 @@ def xml(xmlin, forced=False):
             raise "Couldn't find XML to parse: %s" % xmlin
 
     if filename:
-        if filename in _xmlcache and not forced:
-            return _xmlcache[filename]
+        st = os.stat(filename)
+        signature = (st.st_mtime, st.st_size)
+        cached = _xmlcache.get(filename)
+        if cached is not None and cached[0] == signature and not forced:
+            _xmlcache.move_to_end(filename)
+            return cached[1]
         xmlin = open(filename)
 
     xmldata = xmlin.read()
@@ -132,7 +141,10 @@ def xml(xmlin, forced=False):
     parsedxml = HandyXmlWrapper(doc.documentElement)
 
     if filename:
-        _xmlcache[filename] = parsedxml
+        _xmlcache[filename] = (signature, parsedxml)
+        _xmlcache.move_to_end(filename)
+        while len(_xmlcache) > CACHE_SIZE:
+            _xmlcache.popitem(last=False)
 
     return parsedxml
 
@@ -476,8 +476,51 @@ Description:
         'view': format_element_name('view', data['view']),
         'description': data['description']
         }
+    if data.get('media'):
+        m += _("\nMedia: %s") % data['media']
+        if data.get('media_duration'):
+            m += " (%s)" % format_time(data['media_duration'])
+        m += "\n"
+    if data.get('extent'):
+        m += _("Annotations from %(begin)s to %(end)s\n") % {
+            'begin': format_time(data['extent'][0]),
+            'end': format_time(data['extent'][1]) }
+    if data.get('annotationtypes'):
+        m += _("\nAnnotation types:\n")
+        m += "".join("\t%s: %s (%s)\n" % (at['title'] or at['id'],
+                                           format_element_name('annotation', at['count']),
+                                           format_time(at['stats']['total']))
+                     for at in data['annotationtypes'])
+    if data.get('authors'):
+        m += _("\nAuthors: %s\n") % ", ".join("%s (%d)" % (k, v) for (k, v) in sorted(data['authors'].items(), key=lambda t: -t[1]))
     return m
 
+def get_durations_statistics(durations, data):
+    """Return raw statistics about annotation durations and contents.
+
+    durations is a non-empty list of durations, data an iterable of
+    the corresponding content data.
+    """
+    total_duration = sum(durations)
+    res = {
+        'min': min(durations),
+        'max': max(durations),
+        'mean': total_duration / len(durations),
+        'median': median(durations),
+        'total': total_duration
+    }
+    # Determine distinct values. We split fields against commas
+    # FIXME: this should be a specific content-type (application/x-advene-keywords)
+    distinct_values = collections.Counter(itertools.chain.from_iterable(re.split(r'\s*,\s*', d) for d in data))
+    res['distinct_values_count'] = distinct_values_count = len(distinct_values)
+    if distinct_values_count < 20:
+        res['distinct_values'] = distinct_values
+        res['distinct_values_repr'] = "\n".join("\t%s: %s" % (k.replace('\n', '\\n'), distinct_values[k]) for k in sorted(distinct_values.keys()))
+    else:
+        res['distinct_values'] = []
+        res['distinct_values_repr'] = ""
+    return res
+
 def get_annotations_statistics(annotations, format='text'):
     """Return some statistics about the given annotations.
 
@@ -494,24 +537,8 @@ def get_annotations_statistics(annotations, format='text'):
                 'median': 0,
                 'total': 0
             }
-    total_duration = sum(a.fragment.duration for a in annotations)
-    res = {
-        'min': min(a.fragment.duration for a in annotations),
-        'max': max(a.fragment.duration for a in annotations),
-        'mean': total_duration / len(annotations),
-        'median': median(a.fragment.duration for a in annotations),
-        'total': total_duration
-    }
-    # Determine distinct values. We split fields against commas
-    # FIXME: this should be a specific content-type (application/x-advene-keywords)
-    distinct_values = collections.Counter(itertools.chain.from_iterable(re.split(r'\s*,\s*', a.content.data) for a in annotations))
-    res['distinct_values_count'] = distinct_values_count = len(distinct_values)
-    if distinct_values_count < 20:
-        res['distinct_values'] = distinct_values
-        res['distinct_values_repr'] = "\n".join("\t%s: %s" % (k.replace('\n', '\\n'), distinct_values[k]) for k in sorted(distinct_values.keys()))
-    else:
-        res['distinct_values'] = []
-        res['distinct_values_repr'] = ""
+    res = get_durations_statistics([ a.fragment.duration for a in annotations ],
+                                   ( a.content.data for a in annotations ))
 
     if format == 'text':
         for k in ('min', 'max', 'mean', 'median', 'total'):
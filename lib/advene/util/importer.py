@@ -75,6 +75,7 @@ import signal
 import subprocess
 import sys
 import threading
+import time
 
 from gettext import gettext as _
 
@@ -87,6 +88,7 @@ from advene.model.annotation import Annotation
 from advene.model.schema import AnnotationType, Schema
 from advene.model.fragment import MillisecondFragment
 
+import advene.util.batch as batch
 import advene.util.helper as helper
 
 IMPORTERS = []
@@ -143,6 +145,8 @@ class GenericImporter:
     """
     name = _("Generic importer")
     annotation_filter = False
+    # Number of annotations appended at once to the package by convert
+    convert_batch_size = 1000
 
     def __init__(self, author=None, package=None, defaulttype=None, controller=None, callback=None, source_type=None):
         """Instanciate the importer.
@@ -178,6 +182,8 @@ class GenericImporter:
         self.callback=callback
         # Default offset in ms
         self.offset=0
+        # Ids reserved from the package idgenerator, indexed by element type
+        self.reserved_ids={}
         # Dictionary holding the number of created elements
         self.statistics={
             'annotation': 0,
@@ -366,15 +372,57 @@ class GenericImporter:
         self.update_statistics('schema')
         return schema
 
+    def get_idgenerator(self):
+        """Return the id generator of the destination package.
+
+        Packages loaded by the controller have their own. Fallback to
+        the controller package one for other packages (e.g. temporary
+        packages), or return None without controller.
+        """
+        idgenerator = getattr(self.package, '_idgenerator', None)
+        if idgenerator is None and self.controller is not None:
+            idgenerator = self.controller.package._idgenerator
+        return idgenerator
+
+    def get_reserved_id(self, elementtype):
+        """Return a new id for the given element type.
+
+        Ids are reserved from the idgenerator by blocks of
+        convert_batch_size. This is used by convert, which releases
+        the unused ids at its end.
+        """
+        ids = self.reserved_ids.setdefault(elementtype, [])
+        if not ids:
+            ids.extend(reversed(self.get_idgenerator().reserve(elementtype, self.convert_batch_size)))
+        return ids.pop()
+
+    def release_reserved_ids(self):
+        """Release the reserved and unused ids.
+        """
+        idgenerator = self.get_idgenerator()
+        if idgenerator is not None:
+            for elementtype, ids in self.reserved_ids.items():
+                idgenerator.release(elementtype, ids)
+        self.reserved_ids.clear()
+
     def create_annotation (self, type_=None, begin=None, end=None,
                            data=None, ident=None, author=None,
-                           timestamp=None, title=None):
+                           timestamp=None, title=None, append=True):
         """Create an annotation in the package
+
+        If append is False, the annotation is not appended to the
+        package annotations: it is then the caller's responsibility to
+        do it (e.g. through package.annotations.extend).
         """
         begin += self.offset
         end += self.offset
-        if ident is None and self.controller is not None:
-            ident=self.controller.package._idgenerator.get_id(Annotation)
+        idgenerator = self.get_idgenerator() if ident is None else None
+        if idgenerator is not None:
+            if Annotation in self.reserved_ids:
+                # Bulk creation (from convert)
+                ident=self.get_reserved_id(Annotation)
+            else:
+                ident=idgenerator.get_id(Annotation)
 
         if ident is None:
             a=self.package.createAnnotation(type=type_,
@@ -387,7 +435,8 @@ class GenericImporter:
         a.date=timestamp
         a.title=title
         a.content.data = data
-        self.package.annotations.append(a)
+        if append:
+            self.package.annotations.append(a)
         self.update_statistics('annotation')
         return a
 
@@ -457,6 +506,11 @@ class GenericImporter:
           - notify: if True, then each annotation creation will generate a AnnotationCreate signal
           - complete: boolean. Used to mark the completeness of the annotation.
           - send: yield should return the created annotation
+
+        Created annotations are appended to the package by batches of
+        convert_batch_size elements (annotations with the notify flag
+        are appended immediately), so the package annotations
+        bundle is up-to-date only when convert returns.
         """
         if self.defaulttype is None:
             self.package, self.defaulttype = self.init_package(annotationtypeid='imported', schemaid='imported-schema')
@@ -466,6 +520,17 @@ class GenericImporter:
             # access its contents.
             source = iter(source)
 
+        # Cache of annotation types, indexed by id
+        types = {}
+        # Created annotations, not yet appended to the package
+        batch = []
+
+        def flush():
+            if batch:
+                self.package.annotations.extend(batch)
+                del batch[:]
+                self.package._modified = True
+
         try:
             if hasattr(source, 'send'):
                 d = source.send(None)
@@ -473,71 +538,88 @@ class GenericImporter:
                 d = next(source)
         except StopIteration:
             return
-        while True:
-            try:
-                begin=helper.parse_time(d['begin'])
-            except KeyError:
-                raise Exception("Begin is mandatory")
-            if 'end' in d:
-                end=helper.parse_time(d['end'])
-            elif 'duration' in d:
-                end=begin + helper.parse_time(d['duration'])
-            else:
-                raise Exception("end or duration is missing")
-            content = d.get('content', "Default content")
-            if not isinstance(content, str):
-                content = json.dumps(content)
-            ident = d.get('id', None)
-            # Support both author and creator keys
-            author = d.get('author', d.get('creator', self.author))
-            title = d.get('title', content[:20])
-            timestamp = d.get('timestamp', self.timestamp)
-
-            type_ = d.get('type')
-            if not type_:
-                # Either None or an empty string. Set to defaulttype anyway.
-                type_ = self.defaulttype
-            elif isinstance(type_, str):
-                # A type id was specified. Dereference it, and
-                # create it if necessary.
-                type_id = type_
-                type_ = self.package.get_element_by_id(type_id)
-
-                # mimetype was the key in initial versions of the
-                # import API. But I used content_type in FlatJSON
-                # export. Let's support both.
-                mimetype = d.get('mimetype', d.get('content_type', None))
-                if type_ is None:
-                    # Not existing, create it.
-                    type_ = self.ensure_new_type(prefix=type_id,
-                                                 title=d.get('type_title', type_id),
-                                                 mimetype=mimetype,
-                                                 color=d.get('type_color', None),
-                                                 )
-            if not isinstance(type_, AnnotationType):
-                raise Exception("Error during import: the specified type id %s is not an annotation type" % type_)
-
-            a = self.create_annotation(type_=type_,
-                                       begin=begin,
-                                       end=end,
-                                       data=content,
-                                       ident=ident,
-                                       author=author,
-                                       title=title,
-                                       timestamp=timestamp)
-            self.package._modified = True
-            if 'complete' in d:
-                a.complete=d['complete']
-            if 'notify' in d and d['notify'] and self.controller is not None:
-                logger.debug("Notifying %s", a)
-                self.controller.notify('AnnotationCreate', annotation=a)
-            try:
-                if hasattr(source, 'send'):
-                    d = source.send(None)
+        # Reserve annotation ids by blocks
+        self.reserved_ids.setdefault(Annotation, [])
+        try:
+            while True:
+                try:
+                    begin = d['begin']
+                except KeyError:
+                    raise Exception("Begin is mandatory")
+                if not isinstance(begin, int):
+                    begin = helper.parse_time(begin)
+                if 'end' in d:
+                    end = d['end']
+                    if not isinstance(end, int):
+                        end = helper.parse_time(end)
+                elif 'duration' in d:
+                    end = begin + helper.parse_time(d['duration'])
                 else:
-                    d = next(source)
-            except StopIteration:
-                break
+                    raise Exception("end or duration is missing")
+                content = d.get('content', "Default content")
+                if not isinstance(content, str):
+                    content = json.dumps(content)
+                ident = d.get('id', None)
+                # Support both author and creator keys
+                author = d.get('author', d.get('creator', self.author))
+                title = d.get('title', content[:20])
+                timestamp = d.get('timestamp', self.timestamp)
+
+                type_ = d.get('type')
+                if not type_:
+                    # Either None or an empty string. Set to defaulttype anyway.
+                    type_ = self.defaulttype
+                elif isinstance(type_, str):
+                    # A type id was specified. Dereference it, and
+                    # create it if necessary.
+                    type_id = type_
+                    type_ = types.get(type_id)
+                    if type_ is None:
+                        type_ = self.package.get_element_by_id(type_id)
+
+                        # mimetype was the key in initial versions of the
+                        # import API. But I used content_type in FlatJSON
+                        # export. Let's support both.
+                        mimetype = d.get('mimetype', d.get('content_type', None))
+                        if type_ is None:
+                            # Not existing, create it.
+                            type_ = self.ensure_new_type(prefix=type_id,
+                                                         title=d.get('type_title', type_id),
+                                                         mimetype=mimetype,
+                                                         color=d.get('type_color', None),
+                                                         )
+                        types[type_id] = type_
+                if not isinstance(type_, AnnotationType):
+                    raise Exception("Error during import: the specified type id %s is not an annotation type" % type_)
+
+                a = self.create_annotation(type_=type_,
+                                           begin=begin,
+                                           end=end,
+                                           data=content,
+                                           ident=ident,
+                                           author=author,
+                                           title=title,
+                                           timestamp=timestamp,
+                                           append=False)
+                batch.append(a)
+                if 'complete' in d:
+                    a.complete=d['complete']
+                if 'notify' in d and d['notify'] and self.controller is not None:
+                    flush()
+                    logger.debug("Notifying %s", a)
+                    self.controller.notify('AnnotationCreate', annotation=a)
+                elif len(batch) >= self.convert_batch_size:
+                    flush()
+                try:
+                    if hasattr(source, 'send'):
+                        d = source.send(None)
+                    else:
+                        d = next(source)
+                except StopIteration:
+                    break
+        finally:
+            flush()
+            self.release_reserved_ids()
 
 class ExternalAppImporter(GenericImporter):
     """External application importer.
@@ -665,6 +747,146 @@ class ExternalAppImporter(GenericImporter):
         """
         yield {}
 
+# State of batch worker processes, initialized by batch_init
+_batch_worker = {}
+
+def batch_init(filtername, option_list, template_package, outputdir, output_format):
+    """Initialize a batch worker process.
+    """
+    import advene.core.controller as controller
+    c = controller.AdveneController()
+    c.init_plugins()
+    _batch_worker.update(controller=c,
+                         importers=controller.advene.util.importer.IMPORTERS,
+                         filtername=filtername,
+                         option_list=option_list,
+                         template_package=template_package,
+                         outputdir=outputdir,
+                         output_format=output_format)
+
+def _batch_import(inputfile, basename):
+    c = _batch_worker['controller']
+    previous = c.package
+    c.load_package(_batch_worker['template_package'], alias='batch')
+    # Do not keep a reference to the previously imported package
+    if previous is not None and previous not in c.packages.values():
+        c.aliases.pop(previous, None)
+    if helper.is_video_file(inputfile):
+        c.set_default_media(inputfile)
+
+    filtername = _batch_worker['filtername']
+    if filtername == 'auto':
+        i = get_importer(inputfile, package=c.package, controller=c)
+    else:
+        i = [ f for f in _batch_worker['importers'] if f.name == filtername ][0](package=c.package, controller=c)
+    if i is None:
+        raise Exception(_("No valid importer"))
+    if _batch_worker['option_list']:
+        i.process_options(_batch_worker['option_list'])
+    reqs = i.check_requirements()
+    if reqs:
+        raise Exception(_("The filter is not ready: %s") % " ".join(reqs))
+
+    if hasattr(i, 'async_process_file'):
+        from gi.repository import GLib
+        mainloop = GLib.MainLoop()
+        def end_callback():
+            mainloop.quit()
+            return True
+        i.async_process_file(inputfile, end_callback)
+        mainloop.run()
+    else:
+        i.process_file(inputfile)
+
+    return _batch_save(c, i.package, basename,
+                       _batch_worker['outputdir'], _batch_worker['output_format'])
+
+def _batch_save(controller, package, basename, outputdir, output_format):
+    """Save the package produced for an input file in outputdir.
+
+    basename is the output base name of the input file (see
+    batch.expand_inputs). Return the output filename.
+    """
+    outputfile = batch.output_filename(basename, outputdir, output_format)
+    if output_format in ('json', 'ndjson'):
+        from advene.util.exporter import FlatJsonExporter, FlatNdjsonExporter
+        e = (FlatNdjsonExporter if output_format == 'ndjson' else FlatJsonExporter)(controller=controller)
+        e.set_source(package)
+        e.export(outputfile)
+    else:
+        package.save(outputfile)
+    return outputfile
+
+def batch_import(inputfile, basename):
+    """Import a file in a batch worker process.
+
+    basename is the output base name of the input file (see
+    batch.expand_inputs). Return a status dict.
+    """
+    return batch.timed_call(_batch_import, inputfile, basename)
+
+def pipeline_batch_import(controller, importer_class, inputs, option_list, template_package,
+                          outputdir, output_format, pipelines=None, summary='-'):
+    """Batch import with Gstreamer-based importers, in the current process.
+
+    Up to `pipelines` analysis pipelines run concurrently (see
+    advene.util.gstimporter.AnalysisScheduler). This avoids the
+    per-process initialization of batch_import, and frame processing
+    is done in worker threads. inputs is a dict mapping input
+    filenames to output base names (see batch.expand_inputs). Return
+    the summary data.
+    """
+    from advene.util.gstimporter import AnalysisScheduler
+    c = controller
+    status = {}
+
+    def job_callback(importer, inputfile):
+        s = status[inputfile]
+        if importer.start_time is not None and importer.end_time is not None:
+            s['duration'] = importer.end_time - importer.start_time
+        try:
+            if importer.error is not None:
+                raise Exception(importer.error)
+            s['output'] = _batch_save(c, importer.package, inputs[inputfile], outputdir, output_format)
+            s['status'] = 'ok'
+        except Exception as e:
+            logger.debug("Error when processing %s", inputfile, exc_info=True)
+            s['status'] = 'error'
+            s['error'] = str(e) or e.__class__.__name__
+        logger.info("[%d/%d] %s %s: %s", len(scheduler.done), len(inputs), importer_class.name, inputfile, s['status'])
+        # Release the package
+        c.remove_package(importer.package)
+
+    def create_importer(n, inputfile):
+        # Packages are created when their analysis starts, so that
+        # only running analyses hold a package.
+        alias = "batch%d" % n
+        try:
+            c.load_package(template_package, alias=alias, activate=False)
+            package = c.packages[alias]
+            if helper.is_video_file(inputfile):
+                c.set_default_media(inputfile, package)
+            i = importer_class(package=package, controller=c)
+            if option_list:
+                i.process_options(option_list)
+        except Exception as e:
+            logger.debug("Cannot create the package for %s", inputfile, exc_info=True)
+            status[inputfile]['error'] = str(e) or e.__class__.__name__
+            return None
+        return i
+
+    t = time.time()
+    scheduler = AnalysisScheduler(jobs=pipelines, job_callback=job_callback)
+    for n, inputfile in enumerate(inputs):
+        status[inputfile] = { 'input': inputfile,
+                              'status': 'error',
+                              'duration': 0 }
+        scheduler.add_lazy(lambda n=n, f=inputfile: create_importer(n, f), inputfile)
+    scheduler.run()
+    return batch.write_summary([ status[inputfile] for inputfile in inputs ],
+                               summary=summary, label=importer_class.name,
+                               jobs=scheduler.jobs, duration=time.time() - t)
+
 def main():
     logging.basicConfig(level=logging.INFO)
     if os.environ.get('ADVENE_DEBUG'):
@@ -709,10 +931,21 @@ template_package=path.azp" option. The given package will be loaded
 before the import takes place.
 
 If no output file is specified, then data will be dumped to stdout in a JSON format.
+If the output file is "-" (or has a .ndjson/.jsonl extension), data
+will be written as newline-delimited JSON, one annotation per line.
+An input file "-" reads data from stdin (only for JSON and NDJSON
+importers, which must then be explicitly specified).
+
+%s
+In batch mode, the output format is specified by the "-o
+batch_format=azp" option (azp, xml, json or ndjson). For Gstreamer-based
+filters, the "-o pipelines=N" option runs N analysis pipelines
+concurrently in a single process instead of using worker processes.
 
 Available filters:
   * %s
         """ % (USAGE,
+               batch.BATCH_USAGE,
                "\n  * ".join(sorted(i.name.replace(' ', '_')
                                     for i in controller.advene.util.importer.IMPORTERS))))
         sys.exit(0)
@@ -732,7 +965,11 @@ Available filters:
     # Rebuild filter option string from config.data.options.options dict
     option_list = [ (f"--{k}={v}" if v else f"--{k}")
                     for (k, v) in config.data.options.options.items()
-                    if k != 'template_package' ]
+                    if k != 'template_package'
+                    and k != 'batch_format'
+                    and k != 'pipelines'
+                    and k not in batch.BATCH_OPTIONS ]
+    outputdir, jobs, summary = batch.batch_options(config.data.options.options)
 
     # If template_package is None, then the controller will use the
     # standard template package
@@ -747,6 +984,40 @@ Available filters:
         sys.stderr.write('\rProgress %02d%% - %s' % (int(100 * value), label))
         return True
 
+    if outputdir is not None:
+        # Batch mode
+        if filtername == 'auto':
+            name = filtername
+        else:
+            cl = [ f.name for f in controller.advene.util.importer.IMPORTERS if f.name.startswith(filtername) ]
+            if len(cl) != 1:
+                logger.error("No unique matching importer starting with %s", filtername)
+                sys.exit(1)
+            name = cl[0]
+        output_format = config.data.options.options.get('batch_format') or 'azp'
+        try:
+            inputs = batch.expand_inputs(config.data.args[1:])
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        os.makedirs(outputdir, exist_ok=True)
+        pipelines = config.data.options.options.get('pipelines')
+        if pipelines and filtername != 'auto':
+            from advene.util.gstimporter import GstImporter
+            importer_class = [ f for f in controller.advene.util.importer.IMPORTERS if f.name == name ][0]
+            if issubclass(importer_class, GstImporter):
+                data = pipeline_batch_import(c, importer_class, inputs, option_list, template_package,
+                                             outputdir, output_format,
+                                             pipelines=int(pipelines), summary=summary)
+                sys.exit(1 if data['failed'] else 0)
+            logger.warning("%s is not a Gstreamer-based filter. Ignoring the pipelines option.", name)
+        data = batch.run_batch(inputs, batch_import,
+                               initializer=batch_init,
+                               initargs=(name, option_list, template_package,
+                                         outputdir, output_format),
+                               jobs=jobs, summary=summary, label=name)
+        sys.exit(1 if data['failed'] else 0)
+
     if filtername == 'auto':
         i = get_importer(inputfile, package=c.package, controller=c, callback=progress)
     elif filtername == 'list':
@@ -777,11 +1048,20 @@ Available filters:
 
     # Serialize data as JSON to stdout
     def json_serialize(p, filename="-"):
-        from advene.util.exporter import FlatJsonExporter
-        e = FlatJsonExporter(controller=c)
+        from advene.util.exporter import FlatJsonExporter, FlatNdjsonExporter
+        if filename == '-' or is_ndjson(filename):
+            e = FlatNdjsonExporter(controller=c)
+        else:
+            e = FlatJsonExporter(controller=c)
         e.set_source(p)
         e.export(filename or '-')
 
+    def is_ndjson(filename):
+        return filename.endswith('.ndjson') or filename.endswith('.jsonl')
+
+    def is_json(filename):
+        return filename in ('', '-') or filename.endswith('.json') or is_ndjson(filename)
+
     reqs = i.check_requirements()
     if reqs:
         # Not all requirements are met. Display some information.
@@ -794,7 +1074,7 @@ Available filters:
         from gi.repository import GLib
         mainloop = GLib.MainLoop()
         def end_callback():
-            if outputfile == '' or outputfile.endswith('.json'):
+            if is_json(outputfile):
                 json_serialize(i.package, outputfile)
             else:
                 i.package.save(outputfile)
@@ -804,7 +1084,7 @@ Available filters:
         mainloop.run()
     else:
         i.process_file(inputfile)
-        if outputfile == '' or outputfile.endswith('.json'):
+        if is_json(outputfile):
             json_serialize(i.package, outputfile)
         else:
             i.package.save(outputfile)
@@ -27,6 +27,7 @@ from gettext import gettext as _
 
 import argparse
 import filecmp
+import hashlib
 import itertools
 import os
 import shutil
@@ -56,6 +57,29 @@ from advene.model.view import View
 from advene.model.query import Query
 import advene.util.helper as helper
 
+def element_fingerprint(el):
+    """Return a content fingerprint for the given annotation or relation.
+
+    The fingerprint covers the element class, its type, fragment or
+    members, author/date, content, tags and metadata, so that two
+    elements with the same id and the same fingerprint can be
+    considered identical without further comparison.
+    """
+    items = [ el.__class__.__name__, el.type.id ]
+    if isinstance(el, Annotation):
+        items.append("%d-%d" % (el.fragment.begin, el.fragment.end))
+    else:
+        items.extend(a.id for a in el.members)
+    items.extend((el.author or "", el.date or "",
+                  el.content.mimetype or "", el.content.data or ""))
+    items.extend(sorted(el.tags))
+    items.extend("%s %s=%s" % m for m in sorted(el.listMetaData()))
+    h = hashlib.sha1()
+    for i in items:
+        h.update(str(i).encode('utf-8'))
+        h.update(b'\0')
+    return h.digest()
+
 class Differ:
     """Returns a structure diff of two packages.
     """
@@ -67,6 +91,62 @@ class Differ:
         # key is the id in the source package, the value the (new) id
         # in the destination package.
         self.translated_ids = {}
+        # Index of destination elements, by id. It is built on first
+        # use and updated by the copy_* methods.
+        self._destination_index = None
+
+    def destination_index(self):
+        """Return the id -> element index of the destination package.
+        """
+        if self._destination_index is None:
+            index = {}
+            # Reverse order of Package.get_element_by_id lookups, so
+            # that the first bundles take precedence.
+            for bundle in (self.destination.relations,
+                           self.destination.queries,
+                           self.destination.annotations,
+                           self.destination.relationTypes,
+                           self.destination.annotationTypes,
+                           self.destination.views,
+                           self.destination.schemas):
+                for e in bundle:
+                    index[e.id] = e
+            self._destination_index = index
+        return self._destination_index
+
+    def get_destination_element(self, i, clazz=None):
+        """Return the destination element with id i.
+
+        If clazz is specified, the element must be an instance of clazz.
+        """
+        el = self.destination_index().get(i)
+        if clazz is not None and not isinstance(el, clazz):
+            return None
+        return el
+
+    def register_destination_element(self, el):
+        """Update the destination index with a new element.
+        """
+        if self._destination_index is not None:
+            self._destination_index[el.id] = el
+
+    def unchanged_ids(self, elements):
+        """Return the set of ids of elements which are identical in the destination.
+
+        The comparison is done through fingerprints, so that
+        unchanged elements can be skipped without a detailed
+        comparison.
+        """
+        index = self.destination_index()
+        source_fp = set()
+        dest_fp = set()
+        for s in elements:
+            d = index.get(s.id)
+            if d is None or not isinstance(d, type(s)):
+                continue
+            source_fp.add( (s.id, element_fingerprint(s)) )
+            dest_fp.add( (d.id, element_fingerprint(d)) )
+        return set(i for (i, fp) in source_fp & dest_fp)
 
     def diff(self):
         """Iterator returning a changelist for all elements.
@@ -130,7 +210,7 @@ class Differ:
 
     def diff_schemas(self):
         for s in self.source.schemas:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.get_destination_element(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_schema(s),
@@ -151,7 +231,7 @@ class Differ:
 
     def diff_annotation_types(self):
         for s in self.source.annotationTypes:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.get_destination_element(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_annotation_type(s),
@@ -175,7 +255,7 @@ class Differ:
 
     def diff_relation_types(self):
         for s in self.source.relationTypes:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.get_destination_element(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_relation_type(s),
@@ -202,8 +282,11 @@ class Differ:
                        lambda e: str(e))
 
     def diff_annotations(self):
+        unchanged = self.unchanged_ids(self.source.annotations)
         for s in self.source.annotations:
-            d=self.destination.get_element_by_id(s.id)
+            if s.id in unchanged:
+                continue
+            d=self.get_destination_element(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_annotation(s),
@@ -248,8 +331,11 @@ class Differ:
                        lambda e: str(e))
 
     def diff_relations(self):
+        unchanged = self.unchanged_ids(self.source.relations)
         for s in self.source.relations:
-            d=self.destination.get_element_by_id(s.id)
+            if s.id in unchanged:
+                continue
+            d=self.get_destination_element(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_relation(s),
@@ -293,7 +379,7 @@ class Differ:
 
     def diff_views(self):
         for s in self.source.views:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.get_destination_element(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_view(s),
@@ -326,7 +412,7 @@ class Differ:
 
     def diff_queries(self):
         for s in self.source.queries:
-            d=self.destination.get_element_by_id(s.id)
+            d=self.get_destination_element(s.id)
             if d is None:
                 yield ('new', s, None,
                        lambda s, d: self.copy_query(s),
@@ -390,7 +476,7 @@ class Differ:
         return
 
     def copy_schema(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.get_destination_element(s.id):
             id_=self.destination._idgenerator.get_id(Schema)
         else:
             id_ = s.id
@@ -404,10 +490,11 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.schemas.append(el)
+        self.register_destination_element(el)
         return el
 
     def copy_annotation_type(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.get_destination_element(s.id):
             id_=self.destination._idgenerator.get_id(AnnotationType)
         else:
             id_ = s.id
@@ -415,7 +502,7 @@ class Differ:
         self.translated_ids[s.id]=id_
 
         # Find parent, and create it if necessary
-        sch=helper.get_id(self.destination.schemas, s.schema.id)
+        sch=self.get_destination_element(s.schema.id, Schema)
         if not sch:
             # Create it
             sch=helper.get_id(self.source.schemas, s.schema.id)
@@ -428,10 +515,11 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         sch.annotationTypes.append(el)
+        self.register_destination_element(el)
         return el
 
     def copy_relation_type(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.get_destination_element(s.id):
             id_=self.destination._idgenerator.get_id(RelationType)
         else:
             id_ = s.id
@@ -439,7 +527,7 @@ class Differ:
         self.translated_ids[s.id]=id_
 
         # Find parent, and create it if necessary
-        sch=helper.get_id(self.destination.schemas, s.schema.id)
+        sch=self.get_destination_element(s.schema.id, Schema)
         if not sch:
             # Create it
             sch=helper.get_id(self.source.schemas, s.schema.id)
@@ -450,6 +538,7 @@ class Differ:
         el.title=s.title or id_
         el.mimetype=s.mimetype
         sch.relationTypes.append(el)
+        self.register_destination_element(el)
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         # Handle membertypes, ensure that annotation types are defined
@@ -460,7 +549,7 @@ class Differ:
             if not m.startswith('#'):
                 logger.error("Cannot handle non-fragment membertypes %s", m)
                 continue
-            at=helper.get_id(self.destination.annotationTypes, m[1:])
+            at=self.get_destination_element(m[1:], AnnotationType)
             if not at:
                 # The annotation type does not exist. Create it.
                 at=helper.get_id(self.source.annotationTypes, m[1:])
@@ -478,10 +567,11 @@ class Differ:
             # Handle translated ids
             if i in self.translated_ids:
                 i=self.translated_ids[i]
-            a=helper.get_id(self.destination.annotations, i)
+            a=self.get_destination_element(i, Annotation)
             if a is None:
                 raise "Error: missing annotation %s" % i
             d.members.append(a)
+        d.updateIndex()
         return d
 
     def copy_annotation(self, s, generate_id=False):
@@ -492,7 +582,7 @@ class Differ:
 
         Try to keep track of the occurences of its id, to fix them later on.
         """
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.get_destination_element(s.id):
             id_ = self.destination._idgenerator.get_id(Annotation)
         else:
             id_ = s.id
@@ -500,7 +590,7 @@ class Differ:
         self.translated_ids[s.id]=id_
 
         # Find parent, and create it if necessary
-        at=helper.get_id(self.destination.annotationTypes, self.translated_ids.get(s.type.id, s.type.id))
+        at=self.get_destination_element(self.translated_ids.get(s.type.id, s.type.id), AnnotationType)
         if not at:
             # The annotation type does not exist. Create it.
             at=self.copy_annotation_type(helper.get_id(self.source.annotationTypes,
@@ -517,17 +607,18 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.annotations.append(el)
+        self.register_destination_element(el)
         return el
 
     def copy_relation(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.get_destination_element(s.id):
             id_=self.destination._idgenerator.get_id(Relation)
         else:
             id_ = s.id
         self.destination._idgenerator.add(id_)
         self.translated_ids[s.id]=id_
 
-        rt=helper.get_id(self.destination.relationTypes, self.translated_ids.get(s.type.id, s.type.id))
+        rt=self.get_destination_element(self.translated_ids.get(s.type.id, s.type.id), RelationType)
         if not rt:
             # The annotation type does not exist. Create it.
             rt=self.copy_relation_type(helper.get_id(self.source.relationTypes,
@@ -540,7 +631,7 @@ class Differ:
             if i in self.translated_ids:
                 i=self.translated_ids[i]
 
-            a=helper.get_id(self.destination.annotations, i)
+            a=self.get_destination_element(i, Annotation)
             if not a:
                 a=self.copy_annotation(sa)
             members.append(a)
@@ -553,13 +644,14 @@ class Differ:
         el.content.data=s.content.data
         el.tags = s.tags
         self.destination.relations.append(el)
+        self.register_destination_element(el)
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         #el.title=s.title or ''
         return el
 
     def copy_query(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.get_destination_element(s.id):
             id_=self.destination._idgenerator.get_id(Query)
         else:
             id_ = s.id
@@ -576,10 +668,11 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.queries.append(el)
+        self.register_destination_element(el)
         return el
 
     def copy_view(self, s, generate_id=False):
-        if generate_id or self.destination.get_element_by_id(s.id):
+        if generate_id or self.get_destination_element(s.id):
             id_=self.destination._idgenerator.get_id(View)
         else:
             id_ = s.id
@@ -602,6 +695,7 @@ class Differ:
         for (namespace, name, value) in s.listMetaData():
             el.setMetaData(namespace, name, value)
         self.destination.views.append(el)
+        self.register_destination_element(el)
         return el
 
     def create_resource(self, s, d):
@@ -627,7 +721,8 @@ class Differ:
 def merge_package(refname, to_be_merged, outputname=None, debug=False, dry_run=False, include=None, exclude=None, callback=None):
     """Merge packages to_be_merged into refname, producing outputname.
 
-    refname can be either a package or a package URI/path.
+    refname can be either a package or a package URI/path. Likewise,
+    to_be_merged items can be either packages or package URIs/paths.
 
     If include is specified, then it is a list of the only action names that should be merged.
 
@@ -687,7 +782,10 @@ def merge_package(refname, to_be_merged, outputname=None, debug=False, dry_run=F
             break
         # Reset id generator
         dest._idgenerator = Generator(dest)
-        source = Package(uri=sourcename)
+        if isinstance(sourcename, Package):
+            source = sourcename
+        else:
+            source = Package(uri=sourcename)
         differ = Differ(source, dest)
         diff = differ.diff()
         if debug:
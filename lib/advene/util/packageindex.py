@@ -0,0 +1,331 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Package corpus index.
+
+Package summaries (title, metadata, annotation statistics per type)
+are read from META-INF/statistics.xml when it holds them, else they
+are computed by a streaming parse of the package content, without
+loading the whole package.
+
+PackageIndex keeps the summaries in a persistent index, keyed by
+package path, size and modification time, and computes the missing
+ones in a pool of worker processes.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import concurrent.futures
+import json
+import os
+import re
+import zipfile
+
+import advene.core.config as config
+from advene.model.package import StatisticsHandler
+import advene.util.helper as helper
+from advene.util.xmlstream import XMLStream, element_text, find_child
+
+# Version of the index file format
+INDEX_VERSION = 1
+PACKAGE_EXTENSIONS = ('.azp', '.xml')
+DC_NS = 'http://purl.org/dc/elements/1.1/'
+
+# Element name -> name of the container of such elements
+CONTAINERS = {
+    'schema': 'schemas',
+    'annotation': 'annotations',
+    'relation': 'annotations',
+    'annotation-type': 'annotation-types',
+    'relation-type': 'relation-types',
+    'query': 'queries',
+    'view': 'views',
+}
+
+def file_key(fname):
+    """Return the (size, modification time) key of the file.
+    """
+    st = os.stat(fname)
+    return [ st.st_size, st.st_mtime_ns ]
+
+def find_packages(names):
+    """Return the package filenames from a list of files or directories.
+    """
+    for name in names:
+        if os.path.isdir(name):
+            for root, dirs, files in os.walk(name):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.lower().endswith(PACKAGE_EXTENSIONS):
+                        yield os.path.join(root, f)
+        else:
+            yield name
+
+def completions(meta):
+    """Return the completions list defined in annotation type metadata.
+    """
+    comp = meta.get('%s#completions' % config.data.namespace, '')
+    if ',' in comp:
+        # Comma-separated list
+        return re.split(r'\s*,\s*', comp)
+    else:
+        # Consider a space-separated list
+        return comp.split()
+
+def read_statistics(fname):
+    """Return the data of the META-INF/statistics.xml file of a .azp package.
+
+    Return None if the package has no statistics.
+    """
+    with zipfile.ZipFile(fname, 'r') as z:
+        try:
+            f = z.open('META-INF/statistics.xml')
+        except KeyError:
+            return None
+        with f:
+            return StatisticsHandler().parse_file(f)
+
+def statistics_summary(fname):
+    """Return the package summary from its statistics.
+
+    Return None if the statistics do not describe annotation types.
+    """
+    data = read_statistics(fname)
+    if data is None or 'annotationtypes' not in data:
+        return None
+    return {
+        'uri': fname,
+        'title': data.get('title'),
+        'meta': data.get('meta', {}),
+        'media': data.get('media', ''),
+        'stats': data['stats'],
+        'annotation_count': data.get('annotation', 0),
+        'annotationtype_count': data.get('annotation_type', 0),
+        'schema_count': data.get('schema', 0),
+        'annotationtypes': [ dict(at, package_uri=fname) for at in data['annotationtypes'] ],
+    }
+
+def element_meta(element):
+    """Return the metadata of a meta element as a "ns#name" -> value dict.
+    """
+    meta = {}
+    for child in element:
+        tag = child.tag
+        if tag.startswith('{'):
+            ns, name = tag[1:].split('}', 1)
+            tag = '%s#%s' % (ns, name)
+        meta[tag] = element_text(child)
+    return meta
+
+def element_title(element, meta):
+    return element.get('{%s}title' % DC_NS) or meta.get('%s#title' % DC_NS)
+
+def parse_content(uri, source):
+    """Summarize the package content.xml from a binary stream.
+    """
+    tags = set(CONTAINERS) | set(CONTAINERS.values()) | set(('package', 'import', 'meta', 'content'))
+    stack = []
+    # Element name -> metadata of the current element
+    metas = {}
+    package_meta = {}
+    package_title = None
+    counts = dict( (name, 0) for name in CONTAINERS )
+    # Schema id -> title
+    schemas = {}
+    schema_id = None
+    # Annotation types, in definition order
+    types = []
+    # Type reference -> list of (duration, content data)
+    annotations = {}
+    data = ""
+    for event, name, elem in XMLStream(source, tags, tags):
+        if event == 'start':
+            stack.append(name)
+            if name == 'schema':
+                schema_id = elem.get('id')
+            elif name == 'annotation':
+                data = ""
+            continue
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if name == 'meta':
+            if parent == 'package':
+                package_meta = element_meta(elem)
+            elif parent in CONTAINERS:
+                metas[parent] = element_meta(elem)
+        elif name == 'content' and parent == 'annotation':
+            data = element_text(elem)
+        elif name == 'package':
+            package_title = element_title(elem, package_meta)
+        elif CONTAINERS.get(name) == parent:
+            counts[name] += 1
+            meta = metas.pop(name, {})
+            if name == 'annotation':
+                fragment = find_child(elem, 'millisecond-fragment')
+                if fragment is not None:
+                    duration = int(fragment.get('end', 0)) - int(fragment.get('begin', 0))
+                else:
+                    duration = 0
+                annotations.setdefault(elem.get('type'), []).append( (duration, data) )
+            elif name == 'annotation-type':
+                types.append( {
+                    'id': elem.get('id'),
+                    'title': element_title(elem, meta),
+                    'schema_id': schema_id,
+                    'meta': meta,
+                } )
+            elif name == 'schema':
+                schemas[elem.get('id')] = element_title(elem, meta)
+
+    def statistics(items):
+        if not items:
+            return helper.get_annotations_statistics([], format='raw')
+        return helper.get_durations_statistics([ d for (d, data) in items ],
+                                               ( data for (d, data) in items ))
+
+    for at in types:
+        at['package_uri'] = uri
+        at['schema'] = schemas.get(at['schema_id'])
+        items = annotations.get('#' + at['id'], [])
+        at['count'] = len(items)
+        at['stats'] = statistics(items)
+
+    return {
+        'uri': uri,
+        'title': package_title,
+        'meta': package_meta,
+        'media': package_meta.get('%s#mediafile' % config.data.namespace, ''),
+        'stats': statistics([ item for items in annotations.values() for item in items ]),
+        'annotation_count': counts['annotation'],
+        'annotationtype_count': counts['annotation-type'],
+        'schema_count': counts['schema'],
+        'annotationtypes': types,
+    }
+
+def stream_summary(fname):
+    """Summarize the package by a streaming parse of its content.
+    """
+    if fname.lower().endswith('.azp'):
+        with zipfile.ZipFile(fname, 'r') as z, z.open('content.xml') as f:
+            return parse_content(fname, f)
+    with open(fname, 'rb') as f:
+        return parse_content(fname, f)
+
+def package_summary(fname):
+    """Return the summary of the package.
+
+    It is run in worker processes. Return an empty dict if the
+    package cannot be read.
+    """
+    logger.info('Parsing %s', fname)
+    try:
+        s = None
+        if fname.lower().endswith('.azp'):
+            s = statistics_summary(fname)
+        if s is None:
+            s = stream_summary(fname)
+    except Exception:
+        logger.error("Cannot parse %s", fname, exc_info=True)
+        return {}
+    for at in s['annotationtypes']:
+        at['completions'] = completions(at['meta'])
+    return s
+
+class PackageIndex:
+    """Persistent index of package summaries.
+
+    Entries are keyed by package path, and remain valid as long as the
+    package size and modification time do not change.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        # Path -> { 'key': file_key, 'summary': summary }
+        self.entries = {}
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.error("Cannot load index %s", self.filename, exc_info=True)
+            return
+        if data.get('version') != INDEX_VERSION:
+            logger.info("Ignoring index %s with version %s", self.filename, data.get('version'))
+            return
+        self.entries = data['entries']
+
+    def save(self):
+        """Save the index.
+
+        The index file is replaced atomically.
+        """
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({ 'version': INDEX_VERSION,
+                        'entries': self.entries }, f)
+        os.replace(tmp, self.filename)
+
+    def stale(self, paths):
+        """Return the (path, key) list of paths without a valid entry.
+        """
+        res = []
+        for path in paths:
+            try:
+                key = file_key(path)
+            except OSError:
+                logger.error("Cannot access %s", path)
+                continue
+            e = self.entries.get(path)
+            if e is None or e['key'] != key:
+                res.append( (path, key) )
+        return res
+
+    def update(self, paths, processes=None):
+        """Update the index for the given paths.
+
+        Missing or outdated entries are computed in processes worker
+        processes (by default, the number of CPUs). Entries of removed
+        files are dropped. Return the number of computed entries.
+        """
+        for path in [ p for p in self.entries if not os.path.exists(p) ]:
+            del self.entries[path]
+        stale = self.stale(paths)
+        if not stale:
+            return 0
+        names = [ path for (path, key) in stale ]
+        if processes == 1 or len(stale) == 1:
+            summaries = map(package_summary, names)
+            executor = None
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+            summaries = executor.map(package_summary, names, chunksize=4)
+        try:
+            for (path, key), summary in zip(stale, summaries):
+                self.entries[path] = { 'key': key, 'summary': summary }
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return len(stale)
+
+    def summaries(self, paths):
+        """Return the summaries for the given (indexed) paths.
+        """
+        return [ self.entries[p]['summary'] for p in paths if p in self.entries ]
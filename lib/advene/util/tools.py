@@ -25,6 +25,7 @@ logger = logging.getLogger(__name__)
 import datetime
 import functools
 import json
+import mmap
 from pathlib import Path
 try:
     from hashlib import md5, sha256
@@ -35,6 +36,7 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
 import urllib.request
 from urllib.parse import urlparse, unquote
 from urllib.request import urlopen
@@ -128,29 +130,163 @@ def mediafile2id (mediafile):
     m=md5(mediafile.encode('utf-8'))
     return m.hexdigest()
 
-def mediafile_checksum(mediafile, callback=None):
+# Size of the memory-mapped chunks hashed at once
+CHECKSUM_CHUNK_SIZE = 16 * 1024 * 1024
+# Sampled fingerprint: number and size of the hashed blocks
+FINGERPRINT_BLOCK_COUNT = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+# Suffix of the checksum cache file, stored alongside the media file
+CHECKSUM_SIDECAR_SUFFIX = '.advene-checksum'
+
+def file_checksum(fname, progress=None, cancel=None, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Return the SHA256 checksum of the file.
+
+    The file is memory-mapped and hashed by chunks. If given,
+    progress(fraction) is called after each chunk. Return None if the
+    cancel event is set.
+    """
+    h = sha256()
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # Empty files cannot be memory-mapped
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(m) as view:
+                for offset in range(0, size, chunk_size):
+                    if cancel is not None and cancel.is_set():
+                        return None
+                    h.update(view[offset:offset + chunk_size])
+                    if progress is not None:
+                        progress(min(1.0, (offset + chunk_size) / size))
+    return h.hexdigest()
+
+def file_fingerprint(fname, count=FINGERPRINT_BLOCK_COUNT, block_size=FINGERPRINT_BLOCK_SIZE):
+    """Return a sampled SHA256 fingerprint of the file.
+
+    Only the file size and count blocks (head, tail and evenly spaced
+    blocks) are hashed, so that it is fast even for huge files. It is
+    suitable for identification, not for integrity checks.
+    """
+    h = sha256()
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode())
+        if size <= count * block_size:
+            offsets = range(0, size, block_size)
+        else:
+            step = (size - block_size) / (count - 1)
+            offsets = [ int(i * step) for i in range(count) ]
+        for offset in offsets:
+            f.seek(offset)
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+def checksum_sidecar(mediafile):
+    """Return the filename of the checksum cache of mediafile.
+    """
+    return mediafile + CHECKSUM_SIDECAR_SUFFIX
+
+def read_checksum_cache(mediafile):
+    """Return the cached checksums of mediafile as a dict.
+
+    Cached values are valid only if the path, size and modification
+    time of mediafile did not change.
+    """
+    try:
+        st = os.stat(mediafile)
+        with open(checksum_sidecar(mediafile), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if (data.get('path') != os.path.abspath(mediafile)
+        or data.get('size') != st.st_size
+        or data.get('mtime') != st.st_mtime_ns):
+        return {}
+    return data.get('checksums', {})
+
+def write_checksum_cache(mediafile, **checksums):
+    """Store checksums of mediafile in its cache.
+    """
+    try:
+        st = os.stat(mediafile)
+        data = read_checksum_cache(mediafile)
+        data.update(checksums)
+        with open(checksum_sidecar(mediafile), 'w', encoding='utf-8') as f:
+            json.dump({ 'path': os.path.abspath(mediafile),
+                        'size': st.st_size,
+                        'mtime': st.st_mtime_ns,
+                        'checksums': data }, f)
+    except OSError:
+        # The media directory may be read-only
+        logger.debug("Cannot store checksum cache for %s", mediafile, exc_info=True)
+
+def mediafile_checksum(mediafile, callback=None, use_cache=True):
     """Return the SHA256 checksum of the given mediafile.
 
+    The checksum is computed in a background thread. The callback is
+    called from the calling thread, and can cancel the computation
+    by returning False. The result is cached alongside the mediafile
+    (see read_checksum_cache).
+
     @param mediafile: the name of the mediafile
     @type mediafile: string
     @return: the checksum
     @rtype: string
     """
     try:
-        size = os.path.getsize(mediafile)
+        os.path.getsize(mediafile)
     except FileNotFoundError:
         logger.error("Cannot get size of file %s", mediafile)
         return None
 
+    if use_cache:
+        checksum = read_checksum_cache(mediafile).get('sha256')
+        if checksum is not None:
+            return checksum
+
     if callback:
         callback(0, _("Computing checksum for %s") % mediafile)
-    h = sha256()
-    with open(mediafile, 'rb', buffering=0) as f:
-        for b in iter(lambda : f.read(128*1024), b''):
-            h.update(b)
-            if callback and callback(progress=f.tell() / size) is False:
-                return None
-    return h.hexdigest()
+    state = { 'progress': 0, 'checksum': None }
+    cancel = threading.Event()
+    def compute():
+        try:
+            state['checksum'] = file_checksum(mediafile,
+                                              progress=lambda p: state.__setitem__('progress', p),
+                                              cancel=cancel)
+        except (OSError, ValueError):
+            logger.error("Cannot compute checksum of %s", mediafile, exc_info=True)
+    t = threading.Thread(target=compute, name="checksum", daemon=True)
+    t.start()
+    while t.is_alive():
+        t.join(.1)
+        if callback and callback(progress=state['progress']) is False:
+            cancel.set()
+            t.join()
+            return None
+    checksum = state['checksum']
+    if checksum is not None:
+        write_checksum_cache(mediafile, sha256=checksum)
+    return checksum
+
+def mediafile_fingerprint(mediafile, use_cache=True):
+    """Return the sampled fingerprint of the given mediafile.
+
+    See file_fingerprint. The result is cached alongside the mediafile.
+    """
+    if use_cache:
+        fingerprint = read_checksum_cache(mediafile).get('fingerprint')
+        if fingerprint is not None:
+            return fingerprint
+    try:
+        fingerprint = file_fingerprint(mediafile)
+    except OSError:
+        logger.error("Cannot compute fingerprint of %s", mediafile)
+        return None
+    write_checksum_cache(mediafile, fingerprint=fingerprint)
+    return fingerprint
 
 def package2id (p):
     """Return the id of the package's mediafile.
@@ -0,0 +1,271 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Numeric value signals.
+
+Annotations with the application/x-advene-values mimetype hold a
+list of numeric values (sound enveloppe, motion...). They are stored
+as space-separated text. If the binary-values preference is set,
+long signals in AZP packages are stored as binary float64 arrays in
+the resources/values/ folder (one .npy file per annotation), and the
+annotation content references the resource. Such packages cannot be
+read by previous Advene versions, hence the opt-in.
+
+Binary arrays of very long signals come with a min/max/mean pyramid
+(stored in a -pyramid.npy file), so that a signal can be summarized
+at any resolution by reading a number of values proportional to the
+requested resolution. For shorter signals, the pyramid is built in
+memory when needed.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VALUES_MIMETYPE = 'application/x-advene-values'
+# Resource folder for binary values
+VALUES_FOLDER = 'values'
+# Minimum number of values for binary storage. Shorter signals are
+# more compact as compressed text.
+BINARY_THRESHOLD = 1024
+# Minimum number of values for storing the pyramid
+PYRAMID_THRESHOLD = 16384
+# Reduction factor between pyramid levels
+PYRAMID_FACTOR = 4
+
+def format_values(values):
+    """Return the textual representation of values.
+    """
+    return " ".join("%.02f" % v for v in values)
+
+def parse_values(data):
+    """Parse space-separated values.
+
+    Invalid values are converted to 0. Return a float64 numpy array
+    if numpy is available, else a list of floats.
+    """
+    items = data.split()
+    if numpy is not None:
+        try:
+            return numpy.array(items, dtype=numpy.float64)
+        except ValueError:
+            pass
+    def convert(v):
+        try:
+            r = float(v)
+        except ValueError:
+            r = 0
+        return r
+    l = [ convert(v) for v in items ]
+    if numpy is not None:
+        return numpy.array(l, dtype=numpy.float64)
+    return l
+
+def level_sizes(size, factor=PYRAMID_FACTOR):
+    """Return the sizes of the pyramid levels for a signal of the given size.
+
+    Level 0 is the signal itself, and is not included.
+    """
+    sizes = []
+    while size > 1:
+        size = (size + factor - 1) // factor
+        sizes.append(size)
+    return sizes
+
+def build_pyramid(values, factor=PYRAMID_FACTOR):
+    """Build the min/max/mean pyramid of values.
+
+    Return a (3, n) float32 array holding the concatenated levels
+    (see level_sizes), rows being min, max and mean.
+    """
+    values = numpy.asarray(values, dtype=numpy.float32)
+    levels = []
+    mins = maxs = means = values
+    counts = numpy.ones(len(values))
+    while len(mins) > 1:
+        starts = numpy.arange(0, len(mins), factor)
+        mins = numpy.minimum.reduceat(mins, starts)
+        maxs = numpy.maximum.reduceat(maxs, starts)
+        # Weighted mean (the last block may be shorter)
+        total = numpy.add.reduceat(means * counts, starts)
+        counts = numpy.add.reduceat(counts, starts)
+        means = total / counts
+        levels.append(numpy.vstack((mins, maxs, means)))
+    if not levels:
+        return numpy.empty((3, 0), dtype=numpy.float32)
+    return numpy.hstack(levels).astype(numpy.float32)
+
+class ValuePyramid:
+    """Multi-resolution summary of a value signal.
+
+    summary(n) returns (min, max, mean) sequences of (at most) n
+    bins covering the whole signal.
+    """
+    def __init__(self, values, pyramid=None, factor=PYRAMID_FACTOR):
+        self.values = values
+        self.factor = factor
+        self.size = len(values)
+        if numpy is not None and pyramid is None:
+            pyramid = build_pyramid(values, factor)
+        self.levels = []
+        if pyramid is not None:
+            offset = 0
+            for size in level_sizes(self.size, factor):
+                self.levels.append(pyramid[:, offset:offset + size])
+                offset += size
+
+    def __len__(self):
+        return self.size
+
+    def summary(self, n):
+        """Return (min, max, mean) for n bins (at most the signal size).
+        """
+        n = min(n, self.size)
+        if n <= 0:
+            return [], [], []
+        if numpy is None:
+            bins = [ self.values[i * self.size // n:(i + 1) * self.size // n] for i in range(n) ]
+            return ([ min(b) for b in bins ],
+                    [ max(b) for b in bins ],
+                    [ sum(b) / len(b) for b in bins ])
+        # Use the coarsest level with at least n values: its size
+        # is at most factor * n.
+        step = 1
+        mins = maxs = means = numpy.asarray(self.values, dtype=numpy.float32)
+        for level in self.levels:
+            if level.shape[1] < n:
+                break
+            mins, maxs, means = level
+            step *= self.factor
+        if len(mins) == n:
+            return mins, maxs, means
+        size = len(mins)
+        starts = (numpy.arange(n) * size) // n
+        if step > 1:
+            # Number of signal values in each level cell
+            counts = numpy.full(size, step, dtype=numpy.float64)
+            counts[-1] = self.size - step * (size - 1)
+        else:
+            counts = numpy.ones(size)
+        return (numpy.minimum.reduceat(mins, starts),
+                numpy.maximum.reduceat(maxs, starts),
+                numpy.add.reduceat(means * counts, starts) / numpy.add.reduceat(counts, starts))
+
+def resource_path(annotation):
+    """Return the resource path of the binary values of annotation.
+    """
+    return "%s/%s.npy" % (VALUES_FOLDER, annotation.id)
+
+def save_array(filename, array):
+    """Save a numpy array.
+
+    The file is replaced atomically, so that memory-mapped previous
+    versions remain valid.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        numpy.save(f, array)
+    os.replace(tmp, filename)
+
+def load_values(filename):
+    """Load binary values and their pyramid (memory-mapped).
+
+    Return a ValuePyramid.
+    """
+    values = numpy.load(filename, mmap_mode='r')
+    pyramid_file = filename[:-4] + '-pyramid.npy'
+    pyramid = None
+    if os.path.exists(pyramid_file):
+        try:
+            pyramid = numpy.load(pyramid_file, mmap_mode='r')
+        except (OSError, ValueError):
+            logger.warning("Cannot load pyramid %s", pyramid_file)
+    return ValuePyramid(values, pyramid)
+
+def remove_unused_values(package, referenced):
+    """Remove the value files that are not in the referenced paths.
+    """
+    resources = package.resources
+    if resources is None or VALUES_FOLDER not in resources:
+        return
+    folder = resources[VALUES_FOLDER]
+    folder.filenames = None
+    for name in list(folder.keys()):
+        path = '/'.join(('resources', VALUES_FOLDER, name.replace('-pyramid.npy', '.npy')))
+        if path not in referenced:
+            del folder[name]
+
+def store_package_values(package):
+    """Store the values of package annotations as binary resources.
+
+    Annotations with inline values (at least BINARY_THRESHOLD of them)
+    are converted. The pyramid is stored for signals with at least
+    PYRAMID_THRESHOLD values. Value files that are not referenced
+    anymore are removed. The package must have resources (AZP
+    package).
+    """
+    resources = package.resources
+    if numpy is None or resources is None:
+        return 0
+    resources[VALUES_FOLDER] = resources.DIRECTORY_TYPE
+    folder = resources[VALUES_FOLDER]
+    referenced = set()
+    count = 0
+    for a in package.annotations:
+        c = a.content
+        if c.mimetype != VALUES_MIMETYPE:
+            continue
+        href = c.getUri(absolute=False)
+        if href:
+            referenced.add(href)
+            continue
+        values = parse_values(c.data)
+        if len(values) < BINARY_THRESHOLD:
+            continue
+        path = resource_path(a)
+        filename = os.path.join(folder.dir_, os.path.basename(path))
+        save_array(filename, values)
+        if len(values) >= PYRAMID_THRESHOLD:
+            save_array(filename[:-4] + '-pyramid.npy', build_pyramid(values))
+        c.setUri('/'.join(('resources', path)))
+        referenced.add(c.getUri(absolute=False))
+        count += 1
+    remove_unused_values(package, referenced)
+    return count
+
+def inline_package_values(package):
+    """Store the values of package annotations as inline text.
+
+    It is necessary for formats without resources (XML), and for AZP
+    packages when binary values are not enabled. The binary value
+    files are removed.
+    """
+    count = 0
+    for a in package.annotations:
+        c = a.content
+        if c.getValuesFile() is not None:
+            c.setData(format_values(c.getValuePyramid().values))
+            count += 1
+    remove_unused_values(package, set())
+    return count
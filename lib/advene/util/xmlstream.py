@@ -0,0 +1,124 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2017 Olivier Aubert <contact@olivieraubert.net>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Streaming XML parsing.
+
+Importers of potentially large XML files use XMLStream to process
+elements as soon as they are parsed. Processed elements are then
+discarded, so that the memory usage does not depend on the file size.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import xml.etree.ElementTree as ET
+
+def local_name(tag):
+    """Return the tag name without its {namespace} prefix.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+def element_text(element):
+    """Return the text of the element and its descendants.
+    """
+    if element is None:
+        return ""
+    return "".join(element.itertext())
+
+def find_child(element, name):
+    """Return the first child with the given local name, or None.
+    """
+    for child in element:
+        if local_name(child.tag) == name:
+            return child
+    return None
+
+def find_children(element, name):
+    """Return the children with the given local name.
+    """
+    return [ child for child in element if local_name(child.tag) == name ]
+
+class XMLStream:
+    """Iterate over the elements of a XML file.
+
+    The iteration yields (event, name, element) tuples, where name is
+    the local name (without namespace) of the element tag:
+
+    - ("start", name, element) for elements whose name is in
+      start_tags. Their attributes are available, but not their
+      children.
+
+    - ("end", name, element) for elements whose name is in end_tags, once
+      they are completely parsed. The element is then cleared and
+      removed from its parent when the iteration resumes, so all
+      necessary data must be extracted from it before.
+
+    Other elements are kept in the tree until an ancestor is
+    cleared.
+    """
+    def __init__(self, source, start_tags=(), end_tags=()):
+        # source is a filename or a binary file object
+        self.source = source
+        self.file = None
+        self.start_tags = set(start_tags)
+        self.end_tags = set(end_tags)
+        self.size = None
+
+    def progress(self):
+        """Return the parsed fraction of the file (between 0 and 1).
+        """
+        if not self.size or self.file is None:
+            return 0
+        try:
+            return min(1.0, self.file.tell() / self.size)
+        except (OSError, ValueError):
+            return 0
+
+    def __iter__(self):
+        if isinstance(self.source, str):
+            self.file = open(self.source, 'rb')
+        else:
+            self.file = self.source
+        try:
+            self.size = os.fstat(self.file.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            self.size = None
+        stack = []
+        try:
+            for event, elem in ET.iterparse(self.file, events=('start', 'end')):
+                name = local_name(elem.tag)
+                if event == 'start':
+                    stack.append(elem)
+                    if name in self.start_tags:
+                        yield event, name, elem
+                    continue
+                stack.pop()
+                if name in self.end_tags:
+                    yield event, name, elem
+                    elem.clear()
+                    if stack:
+                        parent = stack[-1]
+                        # Processed elements are usually the first children
+                        if len(parent) and parent[0] is elem:
+                            del parent[0]
+                        else:
+                            parent.remove(elem)
+        finally:
+            if self.file is not self.source:
+                self.file.close()